@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+Measure the fixed per-request overhead of RestViewer.rest_to_html().
+
+Renders a tiny document many times with the render cache disabled, so
+nearly all of the time is spent setting up docutils rather than parsing.
+
+Usage: python benchmarks/bench_render.py [iterations]
+"""
+import sys
+import timeit
+
+from restview.restviewhttp import RenderCache, RestViewer
+
+
+TINY_DOCUMENT = b"""\
+Title
+=====
+
+Hello, *world*.
+"""
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    viewer = RestViewer('.')
+    viewer.render_cache = RenderCache(0)
+    viewer.rest_to_html(TINY_DOCUMENT)  # warm up imports
+    for stylesheets in ['html4css1.css,restview.css', None]:
+        viewer.stylesheets = stylesheets
+        elapsed = min(timeit.repeat(
+            lambda: viewer.rest_to_html(TINY_DOCUMENT, mtime=1),
+            number=iterations, repeat=3))
+        print("stylesheets=%-28s %7.3f ms per render"
+              % (stylesheets, elapsed / iterations * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,58 @@
 HTTP-based ReStructuredText viewer.
 """
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import ctypes
+import ctypes.util
+import datetime
+import email.utils
+import errno
 import fnmatch
+import functools
+import gzip
+import hashlib
+import heapq
+import http.client
 import http.server
+import inspect
+import io
+import json
+import math
+import mimetypes
+import multiprocessing
 import os
+import posixpath
 import re
+import select
+import shutil
+import signal
 import socket
-import socketserver
+import string
 import subprocess
 import sys
 import threading
 import time
+import traceback
 import webbrowser
 from html import escape
-from urllib.parse import parse_qs, unquote
+from html import unescape as html_unescape
+from urllib.parse import parse_qs, quote, unquote
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 import docutils.core
+import docutils.parsers
+import docutils.parsers.rst.directives.body
+import docutils.readers
+import docutils.utils
+import docutils.utils.code_analyzer
 import docutils.writers.html4css1
 import pygments
 import readme_renderer.rst as readme_rst
@@ -30,12 +67,119 @@ __version__ = '3.0.3.dev0'
 # point to /usr/share/restview
 DATA_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# Images that are served (and exported by --build) alongside the documents
+IMAGE_TYPES = ('.gif', '.png', '.jpg', '.jpeg', '.svg')
+
 
 class MyRequestHandler(http.server.BaseHTTPRequestHandler):
     """HTTP request handler that renders ReStructuredText on the fly."""
 
     server_version = "restviewhttp/" + __version__
 
+    # Keep connections open, so that a page with many images doesn't need
+    # a new connection for each one
+    protocol_version = "HTTP/1.1"
+
+    # Headers and body are sent separately, and Nagle's algorithm would
+    # hold back the body until the headers are acknowledged
+    disable_nagle_algorithm = True
+
+    # Seconds an idle connection is kept open (this also limits how long
+    # sending a request or receiving a response may stall)
+    timeout = 15
+
+    # Requests handled over one connection before it gets closed
+    max_requests_per_connection = 100
+
+    # Requests that may still follow the current one over this connection
+    requests_left = 0
+
+    # Seconds between checks whether other connections need the thread
+    # that waits for a request on an idle connection
+    idle_check_interval = 0.2
+
+    # Seconds between keepalive comments in /events streams
+    keepalive_interval = 15
+
+    # Seconds before a /polling request gives up and tells the browser to
+    # try again
+    polling_timeout = 30
+
+    # Seconds between checks whether a /polling client is still there
+    disconnect_check_interval = 1
+
+    # Number of directory listing entries sent at once; more are loaded on
+    # demand through /_api/list
+    listing_page_size = 200
+    listing_max_page_size = 1000
+
+    # Responses of these types are gzipped when the browser accepts that and
+    # they're at least gzip_min_size bytes long
+    compressible_types = ('text/', 'image/svg+xml', 'application/json')
+    gzip_min_size = 1024
+
+    # Types of files (other than documents) that are served as they are,
+    # because documents can refer to them
+    static_types = ('image/', 'audio/', 'video/', 'font/', 'text/css',
+                    'application/pdf')
+
+    def handle(self):
+        self.close_connection = True
+        self.requests_left = self.max_requests_per_connection
+        while self.requests_left > 0:
+            self.requests_left -= 1
+            try:
+                if not self.wait_for_request():
+                    break
+                self.handle_one_request()
+            except ConnectionError:
+                # The browser closed the connection
+                break
+            if self.close_connection:
+                break
+
+    def wait_for_request(self):
+        """Wait until the browser sends a request over the connection.
+
+        Returns False if it doesn't within the timeout, or if other
+        connections are waiting for a free thread meanwhile: an idle
+        connection shouldn't keep the thread from them.
+        """
+        deadline = time.monotonic() + self.timeout
+        while not self.has_buffered_input():
+            if self.server.has_backlog():
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select(
+                [self.connection], [], [],
+                min(remaining, self.idle_check_interval))
+            if readable:
+                # A request, or the browser closed the connection
+                return True
+        return True
+
+    def has_buffered_input(self):
+        """Check whether self.rfile has read more than it returned so far.
+
+        That happens when the browser sends a request right after the
+        previous one.
+        """
+        self.connection.settimeout(0)
+        try:
+            # Returns what's buffered, or tries a non-blocking read
+            return bool(self.rfile.peek(1))
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def end_headers(self):
+        # An idle connection would keep a thread from other connections
+        if not self.close_connection and (self.requests_left <= 0
+                                          or self.server.has_backlog()):
+            self.send_header("Connection", "close")
+        super().end_headers()
+
     def do_GET(self):
         content = self.do_GET_or_HEAD()
         if content:
@@ -72,33 +216,60 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
                 return self.handle_list(root)
         elif self.path.startswith('/polling?'):
             query = parse_qs(self.path.partition('?')[-1])
-            pathname = query['pathname'][0]
-            if pathname == '/' and command:
-                pathnames = []
-            elif pathname == '/' and isinstance(root, str):
-                pathnames = [root]
-            else:
-                pathnames = [self.translate_path(pathname)]
-            if watch:
-                pathnames += watch
+            pathnames = self.get_watched_paths(query['pathname'][0])
             old_mtime = query['mtime'][0]
             return self.handle_polling(pathnames, old_mtime)
+        elif self.path.startswith('/events?'):
+            query = parse_qs(self.path.partition('?')[-1])
+            pathname = query['pathname'][0]
+            pathnames = self.get_watched_paths(pathname)
+            old_mtime = query.get('mtime', [None])[0]
+            if query.get('body', ['0'])[0] == '1':
+                return self.handle_events(pathnames, old_mtime, pathname)
+            else:
+                return self.handle_events(pathnames, old_mtime)
+        elif self.path == '/_api/stats':
+            return self.handle_stats()
+        elif self.path.startswith('/_static/'):
+            return self.handle_static(self.path[len('/_static/'):])
+        elif self.path == '/search' or self.path.startswith('/search?'):
+            query = parse_qs(self.path.partition('?')[-1])
+            return self.handle_search(query.get('q', [''])[0])
+        elif self.path.startswith('/_api/list?'):
+            query = parse_qs(self.path.partition('?')[-1])
+            try:
+                offset = int(query.get('offset', ['0'])[0])
+                limit = int(query.get('limit', [self.listing_page_size])[0])
+            except ValueError:
+                self.send_error(400, "Bad request")
+                return
+            return self.handle_api_list(query.get('dir', [''])[0], offset, limit)
         elif self.path == '/favicon.ico':
-            return self.handle_image(self.server.renderer.favicon_path,
-                                     'image/x-icon')
-        elif self.path.endswith('.gif'):
-            return self.handle_image(self.translate_path(), 'image/gif')
-        elif self.path.endswith('.png'):
-            return self.handle_image(self.translate_path(), 'image/png')
-        elif self.path.endswith('.jpg') or self.path.endswith('.jpeg'):
-            return self.handle_image(self.translate_path(), 'image/jpeg')
-        elif self.path.endswith('.svg'):
-            return self.handle_image(self.translate_path(), 'image/svg+xml')
+            return self.handle_file(self.server.renderer.favicon_path,
+                                    'image/x-icon')
         elif self.path.endswith('.txt') or self.path.endswith('.rst'):
             return self.handle_rest_file(self.translate_path(), watch)
         else:
+            ctype = mimetypes.guess_type(self.path)[0]
+            if ctype and ctype.startswith(self.static_types):
+                return self.handle_file(self.translate_path(), ctype)
             self.send_error(501, "File type not supported: %s" % self.path)
 
+    def get_watched_paths(self, pathname):
+        """Return the files that affect the page at pathname."""
+        root = self.server.renderer.root
+        command = self.server.renderer.command
+        watch = self.server.renderer.watch
+        if pathname == '/' and command:
+            pathnames = []
+        elif pathname == '/' and isinstance(root, str):
+            pathnames = [root]
+        else:
+            pathnames = [self.translate_path(pathname)]
+        if watch:
+            pathnames += watch
+        return pathnames
+
     def get_latest_mtime(self, filenames, latest_mtime=None):
         for path in filenames:
             try:
@@ -111,26 +282,162 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
         return latest_mtime
 
     def handle_polling(self, paths, old_mtime):
-        # TODO: use inotify if available
-        while True:
-            mtime = self.get_latest_mtime(paths)
-            if mtime is None:
-                # Sometimes when you save a file in a text editor it stops
-                # existing for a brief moment.
-                # See https://github.com/mgedmin/restview/issues/11
-                time.sleep(0.1)
-                continue
-            # Compare as strings: the JS treats our value as a cookie
-            if str(mtime) != str(old_mtime):
-                try:
-                    self.send_response(200)
-                    self.send_header("Cache-Control", "no-cache, no-store, max-age=0")
-                    self.end_headers()
-                except Exception as e:
-                    self.log_error('%s (client closed "%s" before acknowledgement)', e, self.path)
-                finally:
-                    return
-            time.sleep(0.2)
+        if not self.server.start_waiting():
+            return self.send_busy()
+        try:
+            status = self.wait_for_polling(paths, old_mtime)
+        finally:
+            self.server.stop_waiting()
+        if status is None:
+            self.close_connection = True
+        else:
+            self.send_polling_response(status)
+
+    def wait_for_polling(self, paths, old_mtime):
+        """Wait until one of the paths changes or the time runs out.
+
+        Returns the status code for the response, or None if the client
+        has gone away.
+        """
+        renderer = self.server.renderer
+        watcher = renderer.watcher
+        deadline = time.monotonic() + self.polling_timeout
+        with renderer.parking('polling'), watcher.watching(paths):
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # 204 No Content tells the browser to poll again
+                    return 204
+                timeout = min(remaining, self.disconnect_check_interval)
+                if watcher.wait_for_change(paths, old_mtime, timeout=timeout) is not None:
+                    return 200
+                if self.client_disconnected():
+                    return None
+
+    def send_busy(self):
+        """Tell the browser to try again later."""
+        self.send_response(503)
+        self.send_header("Retry-After", str(self.server.retry_after))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_polling_response(self, status):
+        try:
+            self.send_response(status)
+            self.send_header("Cache-Control", "no-cache, no-store, max-age=0")
+            if status != 204:
+                self.send_header("Content-Length", "0")
+            self.end_headers()
+        except Exception as e:
+            self.close_connection = True
+            self.log_error('%s (client closed "%s" before acknowledgement)', e, self.path)
+
+    def client_disconnected(self):
+        """Check whether the client has closed the connection."""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
+
+    def handle_events(self, paths, old_mtime, pathname=None):
+        """Notify the browser about changes with Server-Sent Events.
+
+        Sends a "changed" event every time one of the paths changes, with
+        the new rendered page for pathname, if it's given.  Keeps going
+        until the browser goes away.
+        """
+        # Browsers send the ID of the last event they saw when they reconnect
+        old_mtime = self.headers.get('Last-Event-ID') or old_mtime
+        if not self.server.start_waiting():
+            return self.send_busy()
+        try:
+            self.send_events_headers()
+            if self.command != 'HEAD':
+                self.send_events(paths, old_mtime, pathname)
+        finally:
+            self.server.stop_waiting()
+
+    def send_events(self, paths, old_mtime, pathname=None):
+        try:
+            with contextlib.closing(
+                    self.iter_events(paths, old_mtime, pathname)) as events:
+                for event in events:
+                    self.wfile.write(event)
+                    self.wfile.flush()
+        except (OSError, ValueError):
+            # The browser closed the connection (ValueError happens when
+            # the server closes the socket file on shutdown).
+            pass
+
+    def iter_events(self, paths, old_mtime, pathname=None):
+        """Wait for changes and yield the events to send, forever."""
+        renderer = self.server.renderer
+        watcher = renderer.watcher
+        with renderer.parking('events'), watcher.watching(paths):
+            while True:
+                mtime = watcher.wait_for_change(
+                    paths, old_mtime, timeout=self.keepalive_interval)
+                if mtime is None:
+                    yield b': keepalive\n\n'
+                else:
+                    html = self.render_page(pathname) if pathname else None
+                    yield self.format_event('changed', html, event_id=mtime)
+                    old_mtime = mtime
+
+    def send_events_headers(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache, no-store, max-age=0")
+        # The stream ends when the connection does
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+    @staticmethod
+    def format_event(event, data=None, event_id=None):
+        """Format a Server-Sent Event.
+
+            >>> MyRequestHandler.format_event('changed', 'a\\nb', event_id=42)
+            b'id: 42\\nevent: changed\\ndata: a\\ndata: b\\n\\n'
+
+        """
+        lines = []
+        if event_id is not None:
+            lines.append('id: %s' % event_id)
+        lines.append('event: %s' % event)
+        data = (data or '').replace('\r\n', '\n').replace('\r', '\n')
+        lines += ['data: %s' % line for line in data.split('\n')]
+        return ('\n'.join(lines) + '\n\n').encode('UTF-8')
+
+    def render_page(self, pathname):
+        """Render the ReStructuredText document shown at pathname.
+
+        Returns None if pathname is not a document.
+        """
+        renderer = self.server.renderer
+        root = renderer.root
+        try:
+            if pathname == '/' and renderer.command:
+                stdout, stderr, returncode, mtime = self.run_command(
+                    renderer.command, renderer.watch)
+                if not stdout:
+                    return self.render_command_error(
+                        renderer.command, returncode, stderr, mtime=mtime)
+                return renderer.rest_to_html(stdout, mtime=mtime)
+            if pathname == '/' and isinstance(root, str):
+                filename = root
+            else:
+                filename = self.translate_path(pathname)
+            if os.path.isdir(filename) or not filename.endswith(('.txt', '.rst')):
+                return None
+            data, mtime, st = self.read_rest_file(filename, renderer.watch)
+            return renderer.rest_to_html(data, mtime=mtime, filename=filename,
+                                         stat=st)
+        except RenderFailure as e:
+            return e.html
+        except OSError as e:
+            self.log_error("%s", e)
+            return None
 
     def translate_path(self, path=None):
         root = self.server.renderer.root
@@ -144,133 +451,498 @@ class MyRequestHandler(http.server.BaseHTTPRequestHandler):
             root = os.path.dirname(root)
         return os.path.join(root, path)
 
-    def handle_image(self, filename, ctype):
+    def handle_file(self, filename, ctype):
+        """Serve a file, or the byte range of it asked for.
+
+        The file is sent with sendfile() instead of being read into memory,
+        unless it gets compressed.
+        """
         try:
-            with open(filename, 'rb') as f:
-                data = f.read()
+            f = open(filename, 'rb')
         except IOError:
             self.send_error(404, "File not found: %s" % self.path)
-        else:
-            self.send_response(200)
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+            if self.is_not_modified(etag, st.st_mtime):
+                return self.send_not_modified(
+                    etag, st.st_mtime, vary=self.is_compressible(ctype))
+            try:
+                byte_range = self.get_range(st.st_size, etag, st.st_mtime)
+            except ValueError:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%d" % st.st_size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if byte_range is None and self.use_gzip(ctype, st.st_size):
+                cache = self.server.renderer.render_cache
+                cache_key = ('gzip', filename, etag)
+                data = cache.get(cache_key)
+                if data is None and self.command != 'HEAD':
+                    data = gzip.compress(f.read(), mtime=0)
+                    cache.put(cache_key, data, len(data))
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Encoding", "gzip")
+                if data is not None:
+                    # HEAD doesn't compress the file just to tell its size
+                    self.send_header("Content-Length", str(len(data)))
+                self.send_header("Vary", "Accept-Encoding")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_validators(etag, st.st_mtime, weak=True)
+                self.end_headers()
+                return data
+            start, stop = byte_range or (0, st.st_size)
+            self.send_response(206 if byte_range else 200)
             self.send_header("Content-Type", ctype)
-            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Content-Length", str(stop - start))
+            if byte_range:
+                self.send_header("Content-Range", "bytes %d-%d/%d"
+                                 % (start, stop - 1, st.st_size))
+            self.send_header("Accept-Ranges", "bytes")
+            if self.is_compressible(ctype):
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_validators(etag, st.st_mtime)
             self.end_headers()
-            return data
+            if self.command != 'HEAD' and stop > start:
+                self.send_file(f, start, stop - start)
+
+    def send_file(self, f, offset, count):
+        self.connection.sendfile(f, offset, count)
+
+    def get_range(self, size, etag, last_modified):
+        """Return the (start, stop) byte range the browser asked for.
+
+        Returns None if the whole file should be sent.
+        """
+        value = self.headers.get('Range')
+        if value is None:
+            return None
+        if_range = self.headers.get('If-Range')
+        if if_range is not None and if_range.strip() not in (
+                etag, self.date_time_string(last_modified)):
+            # The browser has an older version, so send the new one
+            return None
+        return self.parse_range(value, size)
+
+    @staticmethod
+    def parse_range(value, size):
+        """Parse the value of a Range header.
+
+        Returns None for ranges that restview ignores (e.g. multiple
+        ranges), which means sending the whole file.  Raises ValueError
+        for ranges outside the file.
+
+            >>> MyRequestHandler.parse_range('bytes=0-99', 1000)
+            (0, 100)
+            >>> MyRequestHandler.parse_range('bytes=900-', 1000)
+            (900, 1000)
+            >>> MyRequestHandler.parse_range('bytes=-100', 1000)
+            (900, 1000)
+            >>> MyRequestHandler.parse_range('bytes=500-1999', 1000)
+            (500, 1000)
+            >>> MyRequestHandler.parse_range('bytes=0-1,5-6', 1000)
+            >>> MyRequestHandler.parse_range('bytes=9-0', 1000)
+            >>> MyRequestHandler.parse_range('lines=1-2', 1000)
+            >>> MyRequestHandler.parse_range('bytes=a-z', 1000)
+            >>> MyRequestHandler.parse_range('bytes=1000-', 1000)
+            Traceback (most recent call last):
+              ...
+            ValueError: range not satisfiable: bytes=1000-
+
+        """
+        unit, _, spec = value.partition('=')
+        first, dash, last = spec.strip().partition('-')
+        if unit.strip().lower() != 'bytes' or ',' in spec or not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                stop = int(last) + 1 if last else size
+            else:
+                start = size - int(last)
+                stop = size
+        except ValueError:
+            return None
+        if stop <= start and first and last:
+            return None
+        start, stop = max(start, 0), min(stop, size)
+        if start >= stop:
+            raise ValueError('range not satisfiable: %s' % value)
+        return start, stop
+
+    def is_compressible(self, ctype):
+        return ctype.startswith(self.compressible_types)
+
+    def use_gzip(self, ctype, size):
+        return (self.is_compressible(ctype) and size >= self.gzip_min_size
+                and self.accepts_gzip())
+
+    def accepts_gzip(self):
+        """Check whether the browser accepts gzipped responses."""
+        for coding in self.headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            if name.strip().lower() in ('gzip', 'x-gzip'):
+                try:
+                    return float(params.strip().partition('q=')[2] or 1) > 0
+                except ValueError:
+                    return False
+        return False
+
+    def send_body_headers(self, body, ctype, cache_key=None):
+        """Send Content-Type, Content-Length and related headers for body.
+
+        Compresses the body if it's worth it and the browser accepts
+        gzip.  Compressed bodies are kept in the render cache under
+        cache_key, if given.
+
+        Returns the body to send and its Content-Encoding (or None).
+        """
+        encoding = None
+        if self.use_gzip(ctype, len(body)):
+            body = self.compress_body(body, cache_key)
+            encoding = 'gzip'
+        self.send_header("Content-Type", ctype)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        if self.is_compressible(ctype):
+            self.send_header("Vary", "Accept-Encoding")
+        return body, encoding
+
+    def compress_body(self, body, cache_key=None):
+        cache = self.server.renderer.render_cache
+        compressed = cache.get(cache_key) if cache_key is not None else None
+        if compressed is None:
+            compressed = gzip.compress(body, mtime=0)
+            if cache_key is not None:
+                cache.put(cache_key, compressed, len(compressed))
+        return compressed
+
+    def is_not_modified(self, etag, last_modified=None):
+        """Check whether the browser's cached copy is still current.
+
+        If-None-Match takes precedence over If-Modified-Since.
+        """
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since is None or last_modified is None:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=datetime.timezone.utc)
+        # HTTP dates have a resolution of one second
+        return int(last_modified) <= since.timestamp()
+
+    def send_validators(self, etag, last_modified=None, weak=False):
+        # A compressed body is not byte-for-byte the same as the original
+        self.send_header("ETag", 'W/' + etag if weak else etag)
+        if last_modified is not None:
+            self.send_header("Last-Modified",
+                             self.date_time_string(last_modified))
+
+    def send_not_modified(self, etag, last_modified=None, mtime=None,
+                          vary=False):
+        self.send_response(304)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_validators(etag, last_modified)
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
+        if mtime is not None:
+            self.send_header("X-Restview-Mtime", str(mtime))
+        self.end_headers()
+
+    def read_rest_file(self, filename, watch=None):
+        """Read a file; return its contents, mtime and os.stat() result.
+
+        The mtime also accounts for the files in watch.
+        """
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            mtime = st.st_mtime
+            if watch:
+                mtime = self.get_latest_mtime(watch, mtime)
+            return f.read(), mtime, st
 
     def handle_rest_file(self, filename, watch=None):
         try:
-            with open(filename, 'rb') as f:
-                mtime = os.fstat(f.fileno()).st_mtime
-                if watch:
-                    mtime = self.get_latest_mtime(watch, mtime)
-                return self.handle_rest_data(f.read(), mtime=mtime, filename=filename)
+            data, mtime, st = self.read_rest_file(filename, watch)
         except IOError as e:
             self.log_error("%s", e)
             self.send_error(404, "File not found: %s" % self.path)
+        else:
+            return self.handle_rest_data(data, mtime=mtime, filename=filename,
+                                         stat=st)
+
+    def run_command(self, command, watch=None):
+        """Run a command; return its stdout, stderr, exit code and mtime.
+
+        The mtime is that of the files in watch.
+        """
+        mtime = self.get_latest_mtime(watch) if watch else None
+        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            self.log_error("'%s' terminated with %s", command, p.returncode)
+        if stderr:
+            self.log_error("stderr from '%s':\n%s", command, stderr)
+        return stdout, stderr, p.returncode, mtime
 
     def handle_command(self, command, watch=None):
         try:
-            mtime = self.get_latest_mtime(watch) if watch else None
-            p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE)
-            stdout, stderr = p.communicate()
-            if p.returncode != 0:
-                self.log_error("'%s' terminated with %s", command, p.returncode)
-            if stderr:
-                self.log_error("stderr from '%s':\n%s", command, stderr)
-            if not stdout:
-                return self.handle_error(command, p.returncode, stderr, mtime=mtime)
-            else:
-                return self.handle_rest_data(stdout, mtime=mtime)
+            stdout, stderr, returncode, mtime = self.run_command(command, watch)
         except OSError as e:
             self.log_error("%s", e)
             self.send_error(500, "Command execution failed")
+        else:
+            if not stdout:
+                return self.handle_error(command, returncode, stderr, mtime=mtime)
+            else:
+                return self.handle_rest_data(stdout, mtime=mtime)
 
-    def handle_rest_data(self, data, mtime=None, filename=None):
-        html = self.server.renderer.rest_to_html(data, mtime=mtime,
-                                                 filename=filename)
+    def handle_rest_data(self, data, mtime=None, filename=None, stat=None):
+        renderer = self.server.renderer
+        etag, last_modified = renderer.get_validators(
+            data, mtime=mtime, filename=filename, stat=stat)
+        if etag is not None and self.is_not_modified(etag, last_modified):
+            return self.send_not_modified(etag, last_modified, mtime=mtime,
+                                          vary=True)
+        try:
+            html = renderer.rest_to_html(data, mtime=mtime, filename=filename,
+                                         stat=stat)
+        except RenderFailure as e:
+            # The browser shouldn't keep showing e.g. a timeout once the
+            # document can be rendered again
+            return self.send_error_page(e.html, mtime=mtime)
+        if etag is None:
+            # Now we know which files the document includes
+            etag, last_modified = renderer.get_validators(
+                data, mtime=mtime, filename=filename, stat=stat)
         if isinstance(html, str):
             html = html.encode('UTF-8')
         self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=UTF-8")
-        self.send_header("Content-Length", str(len(html)))
-        self.send_header("Cache-Control", "no-cache, no-store, max-age=0")
+        html, encoding = self.send_body_headers(
+            html, "text/html; charset=UTF-8",
+            cache_key=('gzip', etag) if etag is not None else None)
+        self.send_header("Cache-Control", "no-cache")
+        if etag is not None:
+            self.send_validators(etag, last_modified, weak=bool(encoding))
         if mtime is not None:
             self.send_header("X-Restview-Mtime", str(mtime))
         self.end_headers()
         return html
 
-    def handle_error(self, command, retcode, stderr, mtime=None):
-        html = self.server.renderer.render_exception(
+    def render_command_error(self, command, retcode, stderr, mtime=None):
+        return self.server.renderer.render_exception(
             title=command,
             error='Process returned error code %s.' % retcode,
-            source=stderr or '(no output)',
+            source=stderr or b'(no output)',
             mtime=mtime)
+
+    def handle_error(self, command, retcode, stderr, mtime=None):
+        html = self.render_command_error(command, retcode, stderr, mtime=mtime)
+        return self.send_error_page(html, mtime=mtime)
+
+    def send_error_page(self, html, mtime=None):
         if isinstance(html, str):
             html = html.encode('UTF-8')
         self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=UTF-8")
-        self.send_header("Content-Length", str(len(html)))
+        html, encoding = self.send_body_headers(html, "text/html; charset=UTF-8")
         self.send_header("Cache-Control", "no-cache, no-store, max-age=0")
         if mtime is not None:
             self.send_header("X-Restview-Mtime", str(mtime))
         self.end_headers()
         return html
 
-    def collect_files(self, dirname):
-        if not dirname.endswith(os.path.sep):
-            dirname += os.path.sep
-        files = []
-        for dirpath, dirnames, filenames in os.walk(dirname):
-            dirnames[:] = [dn for dn in dirnames
-                           if not dn.startswith('.')
-                           and not dn.endswith('.egg-info')]
-            for fn in filenames:
-                if fn.endswith('.txt') or fn.endswith('.rst'):
-                    prefix = dirpath[len(dirname):]
-                    files.append(os.path.join(prefix, fn))
-        files.sort(key=str.lower)
-        return files
+    def handle_stats(self):
+        return self.send_json(self.server.renderer.get_stats())
 
-    def handle_dir(self, dirname):
-        files = [(fn.replace(os.path.sep, '/'), fn) for fn in self.collect_files(dirname)]
-        html = self.render_dir_listing("RST files in %s" % os.path.abspath(dirname), files)
-        if isinstance(html, str):
-            html = html.encode('UTF-8', 'replace')
+    def handle_static(self, name):
+        data = self.server.renderer.get_static_file(name)
+        if data is None:
+            self.send_error(404, "File not found: %s" % self.path)
+            return
         self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=UTF-8")
-        self.send_header("Content-Length", str(len(html)))
+        data, encoding = self.send_body_headers(
+            data, "text/css; charset=UTF-8", cache_key=('gzip', name))
+        # The file name is a hash of the contents, so it never changes
+        self.send_header("Cache-Control", "public, max-age=31536000, immutable")
         self.end_headers()
-        return html
+        return data
+
+    def send_json(self, data):
+        data = json.dumps(data, indent=2, sort_keys=True).encode('UTF-8')
+        self.send_response(200)
+        data, encoding = self.send_body_headers(data, "application/json")
+        self.send_header("Cache-Control", "no-cache, no-store, max-age=0")
+        self.end_headers()
+        return data
+
+    def collect_files(self, dirname):
+        return self.server.renderer.get_directory_index(dirname).list_files()
+
+    def list_directory(self, dirname, prefix='', subdir='', offset=0,
+                       limit=None):
+        """List one page of a directory in the tree under dirname.
+
+        subdir is relative to dirname and uses forward slashes, prefix is
+        prepended to the directory IDs and links (e.g. '0/' for the first
+        directory in a list).  Returns a dict for the /_api/list JSON, or
+        None if there's no such directory.
+        """
+        index = self.server.renderer.get_directory_index(dirname)
+        listing = index.list_dir(os.path.normpath(subdir) if subdir else '')
+        if listing is None:
+            return None
+        subdirnames, filenames = listing
+        if limit is None:
+            limit = self.listing_page_size
+        names = ([(name, True) for name in subdirnames]
+                 + [(name, False) for name in filenames])
+        base = prefix + (subdir + '/' if subdir else '')
+        entries = []
+        for name, is_dir in names[offset:offset + limit]:
+            if is_dir:
+                entries.append({'name': name, 'dir': base + name})
+            else:
+                entries.append({'name': name, 'href': quote(base + name)})
+        next_offset = offset + limit
+        return {
+            'dir': base.rstrip('/'),
+            'offset': offset,
+            'total': len(names),
+            'entries': entries,
+            'next': next_offset if next_offset < len(names) else None,
+        }
+
+    def resolve_listing_dir(self, dir_id):
+        """Map a /_api/list directory ID to list_directory() arguments.
+
+        Returns (dirname, prefix, subdir), or None.
+        """
+        root = self.server.renderer.root
+        if isinstance(root, str):
+            dirname, prefix, subdir = root, '', dir_id
+        else:
+            idx, _, subdir = dir_id.partition('/')
+            if not idx.isdigit() or int(idx) >= len(root):
+                return None
+            dirname, prefix = root[int(idx)], idx + '/'
+        if not os.path.isdir(dirname):
+            return None
+        return dirname, prefix, subdir
+
+    def handle_api_list(self, dir_id, offset=0, limit=None):
+        if limit is None:
+            limit = self.listing_page_size
+        offset = max(offset, 0)
+        limit = min(max(limit, 1), self.listing_max_page_size)
+        location = self.resolve_listing_dir(dir_id)
+        listing = None
+        if location is not None:
+            listing = self.list_directory(*location, offset=offset, limit=limit)
+        if listing is None:
+            self.send_error(404, "Directory not found: %s" % dir_id)
+            return
+        return self.send_json(listing)
+
+    def handle_dir(self, dirname):
+        listing = self.list_directory(dirname)
+        if listing is None:
+            listing = {'dir': '', 'entries': [], 'next': None}
+        html = self.render_dir_listing("RST files in %s" % os.path.abspath(dirname), listing)
+        return self.send_html(html)
 
     def handle_list(self, list_of_files_or_dirs):
-        files = []
+        entries = []
         for idx, fn in enumerate(list_of_files_or_dirs):
             if os.path.isdir(fn):
-                files.extend([('%s/%s' % (idx, f.replace(os.path.sep, '/')),
-                               os.path.join(fn, f))
-                              for f in self.collect_files(fn)])
+                # Expanded on page load
+                entries.append({'name': fn, 'dir': str(idx), 'open': True})
             else:
-                files.append(('%s/%s' % (idx, os.path.basename(fn)),
-                              fn))
-        html = self.render_dir_listing("RST files", files)
+                entries.append({'name': fn,
+                                'href': quote('%s/%s' % (idx, os.path.basename(fn)))})
+        listing = {'dir': '', 'entries': entries, 'next': None}
+        html = self.render_dir_listing("RST files", listing)
+        return self.send_html(html)
+
+    def send_html(self, html):
         if isinstance(html, str):
             html = html.encode('UTF-8', 'replace')
         self.send_response(200)
-        self.send_header("Content-Type", "text/html; charset=UTF-8")
-        self.send_header("Content-Length", str(len(html)))
+        html, encoding = self.send_body_headers(html, "text/html; charset=UTF-8")
         self.end_headers()
         return html
 
-    def render_dir_listing(self, title, files):
-        files = ''.join([FILE_TEMPLATE.replace('$href', escape(href))
-                                      .replace('$file', escape(fn))
-                         for href, fn in files])
-        return (DIR_TEMPLATE.replace('$title', escape(title))
-                            .replace('$files', files))
+    def render_dir_listing(self, title, listing):
+        files = ''.join([self.render_listing_entry(entry)
+                         for entry in listing['entries']])
+        if listing['next'] is not None:
+            files += MORE_TEMPLATE.substitute(
+                dir=escape(listing['dir']), offset=listing['next'],
+                count=listing['total'] - listing['next'])
+        return DIR_TEMPLATE.substitute(title=escape(title), files=files)
+
+    def handle_search(self, query):
+        renderer = self.server.renderer
+        total, matches = renderer.search(query)
+        results = ''.join([
+            RESULT_TEMPLATE.substitute(
+                href=escape(href), file=escape(unquote(href)),
+                snippet=self.render_snippet(index.snippet(relpath, query)))
+            for href, index, relpath in matches])
+        if not renderer.search_indexes:
+            status = "Search is not available."
+        elif total == 1:
+            status = "1 document found."
+        else:
+            status = "%d documents found." % total
+        if not all(index.ready for prefix, index in renderer.search_indexes):
+            status += " Still indexing, results may be incomplete."
+        if any(index.skipped for prefix, index in renderer.search_indexes):
+            status += " The search index is full, some documents were not indexed."
+        html = SEARCH_TEMPLATE.substitute(
+            title=escape("Search results for %s" % query),
+            query=escape(query), status=escape(status), results=results)
+        return self.send_html(html)
+
+    @staticmethod
+    def render_snippet(snippet):
+        """Render a (before, match, after) tuple as HTML.
+
+            >>> MyRequestHandler.render_snippet(('... a <b>', 'c', 'd'))
+            '... a &lt;b&gt; <mark>c</mark> d'
+            >>> MyRequestHandler.render_snippet(None)
+            ''
+
+        """
+        if snippet is None:
+            return ''
+        before, match, after = snippet
+        return '%s <mark>%s</mark> %s' % (escape(before), escape(match),
+                                          escape(after))
+
+    def render_listing_entry(self, entry):
+        if 'dir' in entry:
+            return SUBDIR_TEMPLATE.substitute(
+                dir=escape(entry['dir']), name=escape(entry['name']),
+                open=' open' if entry.get('open') else '')
+        else:
+            return FILE_TEMPLATE.substitute(href=escape(entry['href']),
+                                            file=escape(entry['name']))
 
 
-DIR_TEMPLATE = """\
+DIR_TEMPLATE = string.Template("""\
 <!DOCTYPE html>
 <html>
 <head>
@@ -278,100 +950,2062 @@ DIR_TEMPLATE = """\
 </head>
 <body>
 <h1>$title</h1>
+<form action="/search"><input type="search" name="q" placeholder="Search"></form>
 <ul>
 $files</ul>
+<script type="text/javascript">
+function listing_entry(entry) {
+    var li = document.createElement('li');
+    if (entry.dir !== undefined) {
+        var details = document.createElement('details');
+        var summary = document.createElement('summary');
+        details.setAttribute('data-dir', entry.dir);
+        summary.textContent = entry.name + '/';
+        details.appendChild(summary);
+        details.appendChild(document.createElement('ul'));
+        li.appendChild(details);
+    } else {
+        var a = document.createElement('a');
+        a.href = entry.href;
+        a.textContent = entry.name;
+        li.appendChild(a);
+    }
+    return li;
+}
+function more_button(dir, offset, count) {
+    var li = document.createElement('li');
+    var button = document.createElement('button');
+    button.setAttribute('data-dir', dir);
+    button.setAttribute('data-offset', offset);
+    button.textContent = count + ' more';
+    li.appendChild(button);
+    return li;
+}
+function load_listing(ul, dir, offset) {
+    var req = new XMLHttpRequest();
+    req.onload = function() {
+        if (req.status != 200) return;
+        var listing = JSON.parse(req.responseText);
+        listing.entries.forEach(function(entry) {
+            ul.appendChild(listing_entry(entry));
+        });
+        if (listing.next !== null) {
+            ul.appendChild(more_button(listing.dir, listing.next,
+                                       listing.total - listing.next));
+        }
+    };
+    req.open('GET', '/_api/list?dir=' + encodeURIComponent(dir) +
+                    '&offset=' + offset);
+    req.send();
+}
+document.addEventListener('toggle', function(event) {
+    var details = event.target;
+    if (details.open && !details.hasAttribute('data-loaded')) {
+        details.setAttribute('data-loaded', '');
+        load_listing(details.querySelector('ul'),
+                     details.getAttribute('data-dir'), 0);
+    }
+}, true);
+document.addEventListener('click', function(event) {
+    var button = event.target;
+    if (button.tagName == 'BUTTON' && button.hasAttribute('data-offset')) {
+        var li = button.parentNode, ul = li.parentNode;
+        ul.removeChild(li);
+        load_listing(ul, button.getAttribute('data-dir'),
+                     button.getAttribute('data-offset'));
+    }
+});
+</script>
 </body>
 </html>
-"""
+""")
 
-FILE_TEMPLATE = """\
+FILE_TEMPLATE = string.Template("""\
   <li><a href="$href">$file</a></li>
+""")
+
+STATIC_DIR_TEMPLATE = string.Template("""\
+<!DOCTYPE html>
+<html>
+<head>
+<title>$title</title>
+</head>
+<body>
+<h1>$title</h1>
+<ul>
+$files</ul>
+</body>
+</html>
+""")
+
+SEARCH_TEMPLATE = string.Template("""\
+<!DOCTYPE html>
+<html>
+<head>
+<title>$title</title>
+</head>
+<body>
+<h1>$title</h1>
+<form action="/search"><input type="search" name="q" value="$query"></form>
+<p>$status</p>
+<ul>
+$results</ul>
+</body>
+</html>
+""")
+
+RESULT_TEMPLATE = string.Template("""\
+  <li><a href="$href">$file</a><br>$snippet</li>
+""")
+
+SUBDIR_TEMPLATE = string.Template("""\
+  <li><details data-dir="$dir"$open><summary>$name/</summary><ul></ul></details></li>
+""")
+
+MORE_TEMPLATE = string.Template("""\
+  <li><button data-dir="$dir" data-offset="$offset">$count more</button></li>
+""")
+
+AJAX_STR = """
+<script type="text/javascript">
+var mtime = '%s';
+var poll = null;
+var events = null;
+function replace_elements(old_elements, new_elements) {
+    for (var i = old_elements.length - 1; i >= 0; i--) {
+        old_elements[i].remove();
+    }
+    // convert HTMLCollection to an array so that
+    // items don't disappear from under us when I append
+    // them to a different DOM tree
+    new_elements = [].slice.call(new_elements);
+    for (var i = 0; i < new_elements.length; i++) {
+        document.head.appendChild(new_elements[i]);
+    }
+}
+function get_hrefs(links) {
+    return [].map.call(links, function (link) {
+        return link.getAttribute('href');
+    }).join(' ');
+}
+function update_page(doc) {
+    document.title = doc.title;
+    document.body.innerHTML = doc.body.innerHTML;
+    replace_elements(document.getElementsByTagName('style'),
+                     doc.getElementsByTagName('style'));
+    var old_links = document.querySelectorAll('link[rel=stylesheet]');
+    var new_links = doc.querySelectorAll('link[rel=stylesheet]');
+    // linked stylesheets are only swapped when they change, to avoid
+    // reloading them and the flash of unstyled content
+    if (get_hrefs(old_links) != get_hrefs(new_links)) {
+        replace_elements(old_links, new_links);
+    }
+}
+function reload_page() {
+    var reload = new XMLHttpRequest();
+    reload.onreadystatechange = function () {
+        if (this.readyState == 4 && this.status == 200) {
+            update_page(this.responseXML);
+            mtime = this.getResponseHeader('X-Restview-Mtime');
+            if (mtime && !events) {
+                start_polling();
+            }
+        }
+    }
+    reload.open('GET', location.pathname, true);
+    reload.responseType = 'document';
+    reload.send();
+}
+function start_polling() {
+    poll = new XMLHttpRequest();
+    poll.onreadystatechange = function () {
+        if (this.readyState == 4 && this.status == 200) {
+            reload_page();
+        } else if (this.readyState == 4 && this.status == 204) {
+            // nothing changed yet
+            start_polling();
+        } else if (this.readyState == 4 && this.status == 503) {
+            // the server is busy
+            var delay = this.getResponseHeader('Retry-After') || 5;
+            setTimeout(start_polling, delay * 1000);
+        }
+    }
+    poll.open('HEAD', '/polling?pathname=' + location.pathname + '&mtime=' + mtime, true);
+    poll.send(null);
+}
+function start_events() {
+    events = new EventSource('/events?pathname=' + location.pathname + '&mtime=' + mtime + '&body=1');
+    events.addEventListener('changed', function (event) {
+        if (event.data) {
+            update_page(new DOMParser().parseFromString(event.data, 'text/html'));
+        } else {
+            reload_page();
+        }
+    });
+    events.onerror = function () {
+        // browsers give up on errors like 503 Service Unavailable instead
+        // of reconnecting
+        if (events.readyState == EventSource.CLOSED) {
+            events = null;
+            setTimeout(start_polling, 5000);
+        }
+    };
+}
+window.onload = function () {
+    setTimeout(function () {
+        if (window.EventSource) {
+            start_events();
+        } else {
+            start_polling();
+        }
+    }, 0);
+}
+window.onbeforeunload = function () {
+    if (events) {
+        events.close();
+    }
+    if (poll) {
+        poll.abort();
+    }
+}
+</script>
 """
 
-AJAX_STR = """
-<script type="text/javascript">
-var mtime = '%s';
-var poll = null;
-window.onload = function () {
-    setTimeout(function () {
-        poll = new XMLHttpRequest();
-        poll.onreadystatechange = function () {
-            if (this.readyState == 4 && this.status == 200) {
-                var reload = new XMLHttpRequest();
-                reload.onreadystatechange = function () {
-                    if (this.readyState == 4 && this.status == 200) {
-                        document.title = this.responseXML.title;
-                        document.body.innerHTML = this.responseXML.body.innerHTML;
-                        var old_styles = document.getElementsByTagName('style');
-                        var new_styles = this.responseXML.getElementsByTagName('style');
-                        for (var i = old_styles.length - 1; i >= 0; i--) {
-                            old_styles[i].remove();
-                        }
-                        // convert HTMLCollection to an array so that
-                        // items don't disappear from under us when I append
-                        // them to a different DOM tree
-                        new_styles = [].slice.call(new_styles);
-                        for (var i = 0; i < new_styles.length; i++) {
-                            document.head.appendChild(new_styles[i]);
-                        }
-                        mtime = this.getResponseHeader('X-Restview-Mtime');
-                        if (mtime) {
-                            poll.open('HEAD', '/polling?pathname=' + location.pathname + '&mtime=' + mtime, true);
-                            poll.send();
-                        }
-                    }
-                }
-                reload.open('GET', location.pathname, true);
-                reload.responseType = 'document';
-                reload.send();
-            }
-        }
-        poll.open('HEAD', '/polling?pathname=' + location.pathname + '&mtime=' + mtime, true);
-        poll.send(null);
-    }, 0);
-}
-window.onbeforeunload = function () {
-    poll.abort();
-}
-</script>
-"""
+ERROR_TEMPLATE = """\
+<!DOCTYPE html>
+<html>
+<head>
+<title>$title</title>
+<style type="text/css">
+pre.error {
+    border-left: 1ex solid red;
+    padding-left: 1.5em;
+    padding-top: 1em;
+    padding-bottom: 1em;
+    color: red;
+    background: #fff8f8;
+}
+pre > .highlight {
+    display: block;
+    color: red;
+    background: #fff8f8;
+}
+</style>
+</head>
+<body>
+<h1>$title</h1>
+<pre class="error">
+$error
+</pre>
+<pre>
+$source
+</pre>
+</body>
+</html>
+"""
+
+
+class Inotify(object):
+    """Minimal ctypes wrapper for the Linux inotify API.
+
+    Watches directories rather than files, because text editors often save
+    files by writing a new file and renaming it over the old one.
+    """
+
+    # from <sys/inotify.h>
+    IN_MODIFY = 0x0002
+    IN_ATTRIB = 0x0004
+    IN_CLOSE_WRITE = 0x0008
+    IN_MOVED_FROM = 0x0040
+    IN_MOVED_TO = 0x0080
+    IN_CREATE = 0x0100
+    IN_DELETE = 0x0200
+    IN_DELETE_SELF = 0x0400
+    IN_MOVE_SELF = 0x0800
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM
+                  | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+                  | IN_MOVE_SELF)
+
+    _libc = None
+
+    @classmethod
+    def load_libc(cls):
+        """Return the C library if it supports inotify, or None."""
+        if cls._libc is None:
+            libc = False
+            if sys.platform.startswith('linux'):
+                try:
+                    libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                       use_errno=True)
+                    libc.inotify_init1.argtypes = [ctypes.c_int]
+                    libc.inotify_add_watch.argtypes = [
+                        ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+                    libc.inotify_rm_watch.argtypes = [ctypes.c_int,
+                                                      ctypes.c_int]
+                except (OSError, AttributeError, TypeError):
+                    libc = False
+            cls._libc = libc
+        return cls._libc or None
+
+    @classmethod
+    def watching(cls, paths):
+        """Start watching the directories of the given files.
+
+        Returns None if inotify is not available.
+        """
+        libc = cls.load_libc()
+        if libc is None:
+            return None
+        try:
+            inotify = cls(libc)
+        except OSError:
+            # Perhaps fs.inotify.max_user_instances was reached
+            return None
+        try:
+            dirnames = {os.path.dirname(os.path.abspath(p)) for p in paths}
+            for dirname in sorted(dirnames):
+                inotify.add_watch(dirname)
+        except OSError:
+            inotify.close()
+            return None
+        return inotify
+
+    def __init__(self, libc):
+        self.libc = libc
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def wait(self, timeout=None):
+        """Wait until something happens in one of the watched directories.
+
+        Returns False if nothing happened before the timeout.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        # We don't care about the details, so discard all pending events
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:  # pragma: nocover
+                raise
+        return True
+
+    def rm_watch(self, wd):
+        # Fails if the directory is gone, but then the watch is gone too
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class FileWatcher(object):
+    """Keeps track of file modification times for all polling clients.
+
+    A single background thread checks the files (waiting for inotify events
+    when it can) and wakes up the request handlers waiting for changes, so
+    the cost of watching files doesn't grow with the number of open tabs.
+    """
+
+    use_inotify = True
+
+    # Seconds between modification time checks when inotify is not
+    # available.
+    poll_interval = 0.2
+
+    # Seconds between modification time checks with inotify, which doesn't
+    # notice changes made by other machines on network filesystems.
+    recheck_interval = 5
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.mtimes = {}
+        self.refcounts = collections.Counter()
+        self.dir_refcounts = collections.Counter()
+        self.watch_descriptors = {}
+        self.inotify = None
+        self.thread = None
+        self.stat_calls = 0
+        self.listeners = []
+
+    def start(self):
+        if self.use_inotify:
+            self.inotify = Inotify.watching([])
+        self.thread = threading.Thread(target=self.run, name='file watcher',
+                                       daemon=True)
+        self.thread.start()
+
+    @contextlib.contextmanager
+    def watching(self, paths):
+        """Context manager that subscribes to changes of paths."""
+        self.subscribe(paths)
+        try:
+            yield self
+        finally:
+            self.unsubscribe(paths)
+
+    def subscribe(self, paths):
+        with self.condition:
+            if self.thread is None:
+                self.start()
+            for path in paths:
+                self.refcounts[path] += 1
+                if self.refcounts[path] == 1:
+                    self.mtimes[path] = self.stat(path)
+                    self.add_dir(os.path.dirname(os.path.abspath(path)))
+            self.condition.notify_all()
+
+    def unsubscribe(self, paths):
+        with self.condition:
+            for path in paths:
+                self.refcounts[path] -= 1
+                if not self.refcounts[path]:
+                    del self.refcounts[path]
+                    del self.mtimes[path]
+                    self.remove_dir(os.path.dirname(os.path.abspath(path)))
+
+    def add_dir(self, dirname):
+        self.dir_refcounts[dirname] += 1
+        if self.dir_refcounts[dirname] == 1:
+            self.add_watch(dirname)
+
+    def add_watch(self, dirname):
+        if self.inotify is not None:
+            try:
+                self.watch_descriptors[dirname] = self.inotify.add_watch(dirname)
+            except OSError:
+                # Directory doesn't exist (yet?), fall back to polling
+                pass
+
+    def remove_dir(self, dirname):
+        self.dir_refcounts[dirname] -= 1
+        if not self.dir_refcounts[dirname]:
+            del self.dir_refcounts[dirname]
+            wd = self.watch_descriptors.pop(dirname, None)
+            if wd is not None:
+                self.inotify.rm_watch(wd)
+
+    def stat(self, path):
+        self.stat_calls += 1
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def add_listener(self, callback):
+        """Call callback() from the watcher thread whenever a file changes."""
+        with self.condition:
+            self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        with self.condition:
+            self.listeners.remove(callback)
+
+    def get_latest_mtime(self, paths):
+        mtimes = [self.mtimes.get(path) for path in paths]
+        mtimes = [mtime for mtime in mtimes if mtime is not None]
+        return max(mtimes) if mtimes else None
+
+    def wait_for_change(self, paths, old_mtime, timeout=None):
+        """Wait until the latest modification time of paths changes.
+
+        The paths must be subscribed to.  Returns the new modification time,
+        or None if it didn't change before the timeout.
+        """
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                mtime = self.get_latest_mtime(paths)
+                # Sometimes when you save a file in a text editor it stops
+                # existing for a brief moment, so ignore missing files.
+                # See https://github.com/mgedmin/restview/issues/11
+                # Compare as strings: the JS treats our value as a cookie
+                if mtime is not None and str(mtime) != str(old_mtime):
+                    return mtime
+                if timeout is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+
+    def run(self):
+        while True:
+            self.wait_for_events()
+            self.refresh()
+
+    def wait_for_events(self):
+        with self.condition:
+            while not self.refcounts:
+                self.condition.wait()
+            for dirname in self.dir_refcounts:
+                if dirname not in self.watch_descriptors:
+                    self.add_watch(dirname)
+            polling = (self.inotify is None
+                       or len(self.watch_descriptors) < len(self.dir_refcounts))
+        if polling:
+            time.sleep(self.poll_interval)
+        else:
+            self.inotify.wait(self.recheck_interval)
+
+    def refresh(self):
+        """Check all watched files and wake up waiters if any changed."""
+        with self.condition:
+            paths = list(self.mtimes)
+        mtimes = [(path, self.stat(path)) for path in paths]
+        with self.condition:
+            changed = False
+            for path, mtime in mtimes:
+                if path in self.mtimes and self.mtimes[path] != mtime:
+                    self.mtimes[path] = mtime
+                    changed = True
+            if changed:
+                self.condition.notify_all()
+                for callback in self.listeners:
+                    callback()
+
+    def stats(self):
+        return {
+            'files': len(self.mtimes),
+            'directories': len(self.dir_refcounts),
+            'subscribers': sum(self.refcounts.values()),
+            'inotify': self.inotify is not None,
+            'stat_calls': self.stat_calls,
+        }
+
+
+class DirectoryIndex(object):
+    """In-memory index of the ReStructuredText files in a directory tree.
+
+    The index remembers the files and subdirectories of every directory
+    together with the directory's modification time.  Creating, removing or
+    renaming a file changes the modification time of the directory that
+    contains it, so bringing the index up to date takes one stat() call per
+    directory, and only the directories that changed get listed again.
+    """
+
+    # Directory modification times less than this many seconds old are
+    # not trusted: on filesystems with coarse timestamps a file created
+    # right after we listed the directory might not change its mtime.
+    racy_interval = 2
+
+    def __init__(self, root):
+        self.root = root
+        # relative dirname -> (st_mtime_ns or None, filenames, subdirnames)
+        self.dirs = {}
+        self.files = None
+        # relative dirnames that contain files, directly or in subdirectories
+        self.nonempty_dirs = set()
+        self.scans = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def is_interesting_dir(name):
+        return not name.startswith('.') and not name.endswith('.egg-info')
+
+    @staticmethod
+    def is_interesting_file(name):
+        return name.endswith('.txt') or name.endswith('.rst')
+
+    def scan(self, dirname, mtime):
+        """List a directory, returning an entry for self.dirs."""
+        self.scans += 1
+        filenames = []
+        subdirnames = []
+        try:
+            with os.scandir(os.path.join(self.root, dirname)) as entries:
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                        is_link = is_dir and entry.is_symlink()
+                    except OSError:
+                        continue
+                    if is_link:
+                        # Like os.walk(), don't follow symlinks to
+                        # directories, which could loop forever
+                        continue
+                    if is_dir:
+                        if self.is_interesting_dir(entry.name):
+                            subdirnames.append(entry.name)
+                    elif self.is_interesting_file(entry.name):
+                        filenames.append(entry.name)
+        except OSError:
+            mtime = None
+        if mtime is not None and time.time_ns() - mtime < self.racy_interval * 1e9:
+            mtime = None
+        return (mtime, tuple(filenames), tuple(subdirnames))
+
+    def refresh(self):
+        """Bring the index up to date.
+
+        Returns True if any files were added or removed since last time.
+        """
+        changed = False
+        dirs = {}
+        pending = ['']
+        while pending:
+            dirname = pending.pop()
+            try:
+                mtime = os.stat(os.path.join(self.root, dirname)).st_mtime_ns
+            except OSError:
+                continue
+            entry = self.dirs.get(dirname)
+            if entry is None or entry[0] is None or entry[0] != mtime:
+                entry = self.scan(dirname, mtime)
+                changed = changed or entry[1:] != self.dirs.get(dirname, ())[1:]
+            dirs[dirname] = entry
+            pending.extend(os.path.join(dirname, subdir) for subdir in entry[2])
+        changed = changed or dirs.keys() != self.dirs.keys()
+        self.dirs = dirs
+        return changed
+
+    def update(self):
+        """Bring the index and the lists derived from it up to date."""
+        if self.refresh() or self.files is None:
+            files = []
+            nonempty_dirs = set()
+            for dirname, (mtime, filenames, subdirnames) in self.dirs.items():
+                if not filenames:
+                    continue
+                files.extend(os.path.join(dirname, fn) for fn in filenames)
+                while dirname not in nonempty_dirs:
+                    nonempty_dirs.add(dirname)
+                    if not dirname:
+                        break
+                    dirname = os.path.dirname(dirname)
+            files.sort(key=str.lower)
+            self.files = files
+            self.nonempty_dirs = nonempty_dirs
+
+    def list_files(self):
+        """Return a sorted list of file names relative to the root."""
+        with self._lock:
+            self.update()
+            return list(self.files)
+
+    def list_dir(self, dirname=''):
+        """Return the sorted subdirectories and files of a directory.
+
+        dirname is relative to the root.  Subdirectories without any files
+        are left out.  Returns None if there's no such directory (or it's
+        one of those).
+        """
+        with self._lock:
+            self.update()
+            entry = self.dirs.get(dirname)
+            if entry is None or dirname and dirname not in self.nonempty_dirs:
+                return None
+            mtime, filenames, subdirnames = entry
+            subdirnames = [name for name in subdirnames
+                           if os.path.join(dirname, name) in self.nonempty_dirs]
+            return (sorted(subdirnames, key=str.lower),
+                    sorted(filenames, key=str.lower))
+
+    def stats(self):
+        return {
+            'directories': len(self.dirs),
+            'files': len(self.files or ()),
+            'scans': self.scans,
+        }
+
+
+class SearchIndex(object):
+    """In-memory inverted index of the documents in a directory tree.
+
+    Maps every word to the documents that contain it, and how many times.
+    Documents are reindexed when their modification time or size changes.
+    The text itself isn't kept; search result snippets are read from the
+    files.
+
+    Documents that don't fit in ``max_size`` bytes (as estimated by
+    ``estimate_size``) are left out of the index until they change.
+    """
+
+    WORD_RE = re.compile(r'\w{2,64}')
+
+    # Rough memory cost of a word occurrence in a document on top of the
+    # word itself: a dict entry in the postings and a tuple item in docs
+    # (measured with tracemalloc on CPython 3.11)
+    posting_size = 80
+
+    def __init__(self, directory_index, max_size):
+        self.directory_index = directory_index
+        self.max_size = max_size
+        self.size = 0
+        # relpath -> ((st_mtime_ns, st_size), words)
+        self.docs = {}
+        # word -> {relpath: count}
+        self.postings = {}
+        # relpath -> (st_mtime_ns, st_size) of documents that didn't fit
+        self.skipped = {}
+        self.ready = False
+        self._lock = threading.Lock()
+
+    @property
+    def root(self):
+        return self.directory_index.root
+
+    @classmethod
+    def get_words(cls, text):
+        return cls.WORD_RE.findall(text.lower())
+
+    def estimate_size(self, word):
+        if word in self.postings:
+            return self.posting_size
+        return self.posting_size + sys.getsizeof(word) + sys.getsizeof({})
+
+    def read_words(self, relpath):
+        try:
+            with open(os.path.join(self.root, relpath), 'rb') as f:
+                text = f.read().decode('UTF-8', 'replace')
+        except OSError:
+            return None
+        return collections.Counter(self.get_words(text))
+
+    def refresh(self):
+        """Index new and changed documents and forget removed ones."""
+        files = self.directory_index.list_files()
+        for relpath in set(self.docs).difference(files):
+            with self._lock:
+                self.remove(relpath)
+        for relpath in set(self.skipped).difference(files):
+            del self.skipped[relpath]
+        for relpath in files:
+            try:
+                st = os.stat(os.path.join(self.root, relpath))
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size)
+            if self.docs.get(relpath, (None,))[0] == stamp:
+                continue
+            if self.skipped.get(relpath) == stamp:
+                continue
+            counts = self.read_words(relpath)
+            if counts is None:
+                continue
+            with self._lock:
+                self.remove(relpath)
+                self.add(relpath, stamp, counts)
+        self.ready = True
+
+    def add(self, relpath, stamp, counts):
+        size = sum(self.estimate_size(word) for word in counts)
+        if self.size + size > self.max_size:
+            self.skipped[relpath] = stamp
+            return
+        self.skipped.pop(relpath, None)
+        for word, count in counts.items():
+            self.postings.setdefault(word, {})[relpath] = count
+        self.docs[relpath] = (stamp, tuple(counts))
+        self.size += size
+
+    def remove(self, relpath):
+        doc = self.docs.pop(relpath, None)
+        if doc is None:
+            return
+        for word in doc[1]:
+            postings = self.postings[word]
+            del postings[relpath]
+            if not postings:
+                del self.postings[word]
+                self.size -= sys.getsizeof(word) + sys.getsizeof({})
+            self.size -= self.posting_size
+
+    def search(self, query, limit=None):
+        """Find documents containing all the words in query.
+
+        Returns the number of matching documents and a list of
+        (score, relpath) tuples for the best ``limit`` matches, best first.
+        Rarer words contribute more to the score.
+        """
+        words = set(self.get_words(query))
+        if not words:
+            return 0, []
+        with self._lock:
+            postings = sorted((self.postings.get(word, {}) for word in words),
+                              key=len)
+            n_docs = len(self.docs)
+            matches = [
+                (sum(p[relpath] * math.log(1 + n_docs / len(p))
+                     for p in postings), relpath)
+                for relpath in postings[0]
+                if all(relpath in p for p in postings[1:])
+            ]
+        if limit is None:
+            matches.sort(reverse=True)
+            return len(matches), matches
+        return len(matches), heapq.nlargest(limit, matches)
+
+    def snippet(self, relpath, query, context=80):
+        """Return the text around the first match of query in a document.
+
+        Returns a (before, match, after) tuple, or None.
+        """
+        words = set(self.get_words(query))
+        if not words:
+            return None
+        try:
+            with open(os.path.join(self.root, relpath), 'rb') as f:
+                text = f.read().decode('UTF-8', 'replace')
+        except OSError:
+            return None
+        pattern = r'\b(%s)\b' % '|'.join(map(re.escape, sorted(words)))
+        m = re.search(pattern, text, re.IGNORECASE)
+        if m is None:
+            return None
+        before = ' '.join(text[max(m.start() - context, 0):m.start()].split())
+        after = ' '.join(text[m.end():m.end() + context].split())
+        return before, m.group(), after
+
+    def stats(self):
+        return {
+            'documents': len(self.docs),
+            'words': len(self.postings),
+            'skipped': len(self.skipped),
+            'size': self.size,
+            'max_size': self.max_size,
+            'ready': self.ready,
+        }
+
+
+class RenderFailure(Exception):
+    """Rendering failed for reasons that have nothing to do with the document.
+
+    E.g. it took too long or its worker process died.  html is the error
+    page to show; it doesn't get cached, so the next request tries again.
+    """
+
+    def __init__(self, html):
+        super().__init__(html)
+        self.html = html
+
+
+class RenderWorkerPool(object):
+    """Worker processes that render documents, one document at a time.
+
+    Unlike a ProcessPoolExecutor, this knows which process handles which
+    call, so a render that takes too long gets its own worker killed and
+    replaced without disturbing renders in the other workers.
+    """
+
+    def __init__(self, workers, mp_context, initializer, initargs=()):
+        self.mp_context = mp_context
+        self.initializer = initializer
+        self.initargs = initargs
+        self.condition = threading.Condition()
+        self.closed = False
+        self.busy = []
+        self.idle = [self.start_worker() for n in range(workers)]
+
+    def start_worker(self):
+        conn, child_conn = self.mp_context.Pipe()
+        process = self.mp_context.Process(
+            target=run_render_worker, name='render worker', daemon=True,
+            args=(child_conn, self.initializer, self.initargs))
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    @staticmethod
+    def stop_worker(worker):
+        process, conn = worker
+        conn.close()
+        process.kill()
+        process.join()
+
+    def call(self, fn, *args, timeout=None):
+        """Call fn(*args) in a worker process and return the result.
+
+        Raises concurrent.futures.TimeoutError if that takes longer than
+        timeout seconds, and concurrent.futures.BrokenExecutor if the
+        worker process dies.
+        """
+        with self.condition:
+            while not self.idle and not self.closed:
+                self.condition.wait()
+            if self.closed:
+                raise concurrent.futures.BrokenExecutor(
+                    'The render pool has been shut down')
+            worker = self.idle.pop()
+            self.busy.append(worker)
+        done = False
+        try:
+            process, conn = worker
+            try:
+                conn.send((fn, args))
+                ready = conn.poll(timeout)
+                if ready:
+                    ok, result = conn.recv()
+            except (EOFError, OSError):
+                raise concurrent.futures.BrokenExecutor(
+                    'A render worker process died')
+            if not ready:
+                raise concurrent.futures.TimeoutError()
+            done = True
+        finally:
+            self.release(worker, done)
+        if not ok:
+            raise result
+        return result
+
+    def release(self, worker, reuse=True):
+        if not reuse:
+            # The worker might be stuck or dead
+            self.stop_worker(worker)
+        with self.condition:
+            self.busy.remove(worker)
+            if self.closed:
+                if reuse:
+                    self.stop_worker(worker)
+                return
+            self.idle.append(worker if reuse else self.start_worker())
+            self.condition.notify()
+
+    def shutdown(self):
+        """Stop the worker processes; calls in progress fail."""
+        with self.condition:
+            self.closed = True
+            workers, self.idle = self.idle, []
+            busy = list(self.busy)
+            self.condition.notify_all()
+        for worker in workers:
+            self.stop_worker(worker)
+        for process, conn in busy:
+            # call() notices and stops it
+            process.kill()
+
+
+class RenderCache(object):
+    """Size-bounded LRU cache of rendered HTML pages.
+
+    Entries are evicted, least recently used first, whenever the total size
+    of the cached values exceeds ``max_size`` bytes.  A ``max_size`` of 0
+    disables caching.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size):
+        with self._lock:
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                old_size = self._entries.popitem(last=False)[1][1]
+                self.size -= old_size
+
+    def peek(self, key):
+        """Look up a key without counting it as a use."""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry is not None else None
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self.size,
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class RenderContext(object):
+    """Docutils settings and stylesheets prepared for rendering.
+
+    Setting up a docutils option parser and reading the stylesheets from
+    disk takes longer than rendering a small document, so RestViewer does
+    it once and reuses the result for every document.
+
+    With ``link_stylesheets`` the stylesheets are linked as /_static/ files
+    named after a hash of their contents instead of being embedded into
+    every page.  The contents of those files are in ``static_files``.
+    """
+
+    def __init__(self, settings_overrides, link_stylesheets=False):
+        reader = docutils.readers.get_reader_class('standalone')()
+        parser = docutils.parsers.get_parser_class('restructuredtext')()
+        publisher = docutils.core.Publisher(reader, parser, self.new_writer())
+        defaults = dict(settings_overrides)
+        # Propagate exceptions, like docutils.core.publish_string() does
+        defaults.setdefault('traceback', True)
+        self.settings = publisher.get_settings(**defaults)
+        self.stylesheet_paths = []
+        if self.settings.embed_stylesheet:
+            self.stylesheet_paths = docutils.utils.get_stylesheet_list(self.settings)
+        self.stylesheet_stamps = self.get_stamps(self.stylesheet_paths)
+        embedded = {}
+        for path in self.stylesheet_paths:
+            try:
+                with open(path, encoding='UTF-8') as f:
+                    embedded[path] = f.read()
+            except OSError:
+                # Let docutils report the error when rendering
+                pass
+        self.settings.restview_embedded_stylesheets = embedded
+        self.static_files = {}
+        if link_stylesheets:
+            self.settings.restview_stylesheet_links = {
+                path: self.add_static_file(css)
+                for path, css in embedded.items()
+            }
+            self.settings.restview_pygments_stylesheet = self.add_static_file(
+                SyntaxHighlightingHTMLTranslator.formatter_styles)
+
+    def add_static_file(self, css):
+        """Make a stylesheet available under /_static/; return its URL."""
+        data = css.encode('UTF-8')
+        name = hashlib.blake2b(data, digest_size=10).hexdigest() + '.css'
+        self.static_files[name] = data
+        return '/_static/' + name
+
+    @staticmethod
+    def get_stamps(paths):
+        stamps = []
+        for path in paths:
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def is_stale(self):
+        """Check whether any of the embedded stylesheets has changed."""
+        return self.get_stamps(self.stylesheet_paths) != self.stylesheet_stamps
+
+    @staticmethod
+    def new_writer():
+        writer = docutils.writers.html4css1.Writer()
+        if pygments is not None:
+            writer.translator_class = SyntaxHighlightingHTMLTranslator
+        return writer
+
+    def new_settings(self):
+        # docutils modifies the settings object while rendering
+        settings = copy.copy(self.settings)
+        settings.record_dependencies = docutils.utils.DependencyList()
+        return settings
+
+
+class SiteBuilder(object):
+    """Exports what a RestViewer shows into a static website.
+
+    Pages are written next to their directory listings (index.html) as
+    filename.rst.html, together with the images they refer to.  A manifest
+    of the source files' modification times, sizes and fingerprints (and
+    the modification times and sizes of the files they include) lets the
+    next build skip the pages that haven't changed.
+    """
+
+    manifest_name = '.restview-build.json'
+
+    def __init__(self, viewer, outdir):
+        self.viewer = viewer
+        self.outdir = outdir
+        # (source filename, output path relative to outdir)
+        self.pages = []
+        # output path relative to outdir -> HTML
+        self.listings = {}
+        self.rendered = 0
+        self.unchanged = 0
+        self.errors = 0
+
+    def output_path(self, relpath):
+        return os.path.join(self.outdir, *relpath.split('/'))
+
+    def collect(self):
+        """Find the pages and directory listings to build."""
+        root = self.viewer.root
+        if isinstance(root, str):
+            if os.path.isdir(root):
+                self.add_dir(root, '')
+            else:
+                self.pages.append((root, 'index.html'))
+            return
+        entries = []
+        for idx, fn in enumerate(root):
+            if os.path.isdir(fn):
+                self.add_dir(fn, '%d/' % idx)
+                entries.append(('%d/index.html' % idx, fn))
+            else:
+                page = '%d/%s.html' % (idx, os.path.basename(fn))
+                self.pages.append((fn, page))
+                entries.append((page, fn))
+        self.add_listing('index.html', "RST files", entries)
+
+    def add_dir(self, dirname, prefix):
+        index = self.viewer.get_directory_index(dirname)
+        title = os.path.basename(os.path.abspath(dirname))
+        pending = ['']
+        while pending:
+            subdir = pending.pop()
+            listing = index.list_dir(subdir)
+            if listing is None:
+                continue
+            subdirnames, filenames = listing
+            base = prefix + ''.join(
+                part + '/' for part in subdir.split(os.path.sep) if part)
+            for fn in filenames:
+                self.pages.append((os.path.join(dirname, subdir, fn),
+                                   base + fn + '.html'))
+            pending.extend(os.path.join(subdir, name) for name in subdirnames)
+            entries = ([(name + '/index.html', name + '/')
+                        for name in subdirnames]
+                       + [(fn + '.html', fn) for fn in filenames])
+            where = '/'.join([title] + subdir.split(os.path.sep)).rstrip('/')
+            self.add_listing(base + 'index.html', "RST files in %s" % where,
+                             entries)
+
+    def add_listing(self, relpath, title, entries):
+        files = ''.join([FILE_TEMPLATE.substitute(href=escape(quote(href)),
+                                                  file=escape(label))
+                         for href, label in entries])
+        self.listings[relpath] = STATIC_DIR_TEMPLATE.substitute(
+            title=escape(title), files=files)
+
+    def load_manifest(self):
+        try:
+            with open(os.path.join(self.outdir, self.manifest_name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        filename = os.path.join(self.outdir, self.manifest_name)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(filename + '.tmp', filename)
+
+    def build(self):
+        """Build the static site; skip pages that didn't change.
+
+        Returns True if all the files could be read.
+        """
+        self.collect()
+        os.makedirs(self.outdir, exist_ok=True)
+        old_manifest = self.load_manifest()
+        settings = repr((__version__, self.viewer.settings_key()))
+        old_pages = {}
+        if old_manifest.get('settings') == settings:
+            old_pages = old_manifest.get('pages', {})
+        pages = {}
+        todo = []
+        for filename, relpath in self.pages:
+            try:
+                st = os.stat(filename)
+            except OSError as e:
+                print("%s: %s" % (filename, e.strerror), file=sys.stderr)
+                self.errors += 1
+                continue
+            stamp = [st.st_mtime_ns, st.st_size]
+            entry = old_pages.get(relpath)
+            if (entry is not None and entry['source'] == filename
+                    and os.path.exists(self.output_path(relpath))
+                    and self.dependencies_unchanged(entry)
+                    and (entry['stamp'] == stamp
+                         or entry['fingerprint'] == self.fingerprint(filename))):
+                pages[relpath] = dict(entry, stamp=stamp)
+                self.unchanged += 1
+            else:
+                todo.append((filename, relpath, stamp))
+        results = self.viewer.map_in_workers(
+            'build_page', [(filename, self.output_path(relpath))
+                           for filename, relpath, stamp in todo])
+        for (filename, relpath, stamp), result in zip(todo, results):
+            if result is None:
+                print("%s: can't read the file" % filename, file=sys.stderr)
+                self.errors += 1
+                continue
+            fingerprint, images, dependencies = result
+            pages[relpath] = {'source': filename, 'stamp': stamp,
+                              'fingerprint': fingerprint, 'images': images,
+                              'dependencies': [list(dep_stamp)
+                                               for dep_stamp in dependencies]}
+            self.rendered += 1
+        outputs = set(pages) | set(self.listings)
+        for relpath, entry in pages.items():
+            outputs.update(self.copy_images(entry['source'], relpath,
+                                            entry['images']))
+        for relpath, html in self.listings.items():
+            self.write_if_changed(self.output_path(relpath),
+                                  html.encode('UTF-8'))
+        for relpath in set(old_manifest.get('outputs', [])) - outputs:
+            try:
+                os.unlink(self.output_path(relpath))
+            except OSError:
+                pass
+        self.save_manifest({'settings': settings, 'pages': pages,
+                            'outputs': sorted(outputs)})
+        return not self.errors
+
+    def dependencies_unchanged(self, entry):
+        """Check whether the files a page includes are still the same."""
+        if 'dependencies' not in entry:
+            # Built by an older restview, which didn't record them
+            return False
+        stamps = self.viewer.get_dependency_stamps(
+            path for path, mtime, size in entry['dependencies'])
+        return [list(stamp) for stamp in stamps] == entry['dependencies']
+
+    def fingerprint(self, filename):
+        try:
+            with open(filename, 'rb') as f:
+                return self.viewer.fingerprint(f.read(), filename=filename)
+        except OSError:
+            return None
+
+    def copy_images(self, filename, relpath, images):
+        """Copy the images a page refers to; return their output paths."""
+        outputs = []
+        for src in images:
+            source = os.path.join(os.path.dirname(filename), *src.split('/'))
+            output = posixpath.normpath(
+                posixpath.join(posixpath.dirname(relpath), src))
+            target = self.output_path(output)
+            try:
+                st = os.stat(source)
+            except OSError:
+                continue
+            outputs.append(output)
+            try:
+                old = os.stat(target)
+            except OSError:
+                pass
+            else:
+                if (old.st_mtime_ns, old.st_size) == (st.st_mtime_ns, st.st_size):
+                    continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copy2(source, target)
+        return outputs
+
+    @staticmethod
+    def write_if_changed(filename, data):
+        try:
+            with open(filename, 'rb') as f:
+                if f.read() == data:
+                    return
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+
+class WarningCollector(object):
+    """File-like object that collects docutils warnings."""
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, message):
+        self.messages.append(message.rstrip('\n'))
+
+
+# Sent when all threads are busy and too many connections wait for one
+BUSY_RESPONSE = ('HTTP/1.1 503 Service Unavailable\r\n'
+                 'Retry-After: %d\r\n'
+                 'Content-Length: 0\r\n'
+                 'Connection: close\r\n'
+                 '\r\n')
+
+
+class ThreadingHTTPServer(http.server.HTTPServer):
+    """HTTP server that handles connections in a pool of threads.
+
+    Up to max_workers threads handle connections, and up to max_queued
+    connections wait for a free thread; any more get 503 Service
+    Unavailable.  Threads waiting for changes (/polling and /events) don't
+    count towards max_workers, so open browser tabs can't starve the
+    rest, but there may be only max_waiting of them.  Threads waiting for
+    the next request on a kept-alive connection close it when other
+    connections are waiting for a thread.
+    """
+
+    # Threads handling connections
+    max_workers = 32
+
+    # Connections waiting for a free thread
+    max_queued = 64
+
+    # Requests waiting for changes
+    max_waiting = 1000
+
+    # Seconds a browser should wait before trying again after a 503
+    retry_after = 5
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.reuse_port = reuse_port
+        # server_close() needs these if binding the socket fails
+        self.pool_lock = threading.Condition()
+        self.pending = collections.deque()
+        self.workers = 0
+        self.idle_workers = 0
+        self.waiting = 0
+        self.closed = False
+        super().__init__(server_address, RequestHandlerClass)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        with self.pool_lock:
+            self.pending.append((request, client_address))
+            busy = self.get_backlog() > self.max_queued
+            if busy:
+                self.pending.pop()
+            else:
+                self.pool_lock.notify()
+                self.add_worker_if_needed()
+        if busy:
+            self.reject_request(request)
+
+    def add_worker_if_needed(self):
+        # Call with pool_lock held
+        if (self.idle_workers < len(self.pending)
+                and self.workers < self.max_workers):
+            self.workers += 1
+            self.idle_workers += 1
+            threading.Thread(target=self.work, name='request',
+                             daemon=True).start()
+
+    def work(self):
+        while True:
+            with self.pool_lock:
+                while not self.pending and not self.closed:
+                    self.pool_lock.wait()
+                if self.closed:
+                    self.workers -= 1
+                    self.idle_workers -= 1
+                    return
+                request, client_address = self.pending.popleft()
+                self.idle_workers -= 1
+            self.process_request_thread(request, client_address)
+            with self.pool_lock:
+                if self.workers > self.max_workers:
+                    # Another thread took over while this one was waiting
+                    # for changes
+                    self.workers -= 1
+                    return
+                self.idle_workers += 1
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def reject_request(self, request):
+        """Tell the browser to try again later and close the connection."""
+        request.setblocking(False)
+        try:
+            # Read the request if it's there already, or closing the socket
+            # would reset the connection before the browser sees the
+            # response
+            request.recv(65536)
+        except OSError:
+            pass
+        try:
+            request.sendall((BUSY_RESPONSE % self.retry_after).encode())
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def get_backlog(self):
+        """Return the number of connections waiting for a busy thread.
+
+        Connections that an idle thread (or a new one) is about to pick up
+        don't count.
+        """
+        spare = max(self.max_workers - self.workers, 0) + self.idle_workers
+        return max(len(self.pending) - spare, 0)
+
+    def has_backlog(self):
+        """Check whether connections are waiting for a free thread."""
+        return self.get_backlog() > 0
+
+    def start_waiting(self):
+        """Note that the current thread is going to wait for changes.
+
+        Returns False if too many threads are waiting already.  Another
+        thread can handle connections meanwhile.
+        """
+        with self.pool_lock:
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            self.workers -= 1
+            self.add_worker_if_needed()
+            return True
+
+    def stop_waiting(self):
+        with self.pool_lock:
+            self.waiting -= 1
+            self.workers += 1
+
+    def server_close(self):
+        super().server_close()
+        with self.pool_lock:
+            self.closed = True
+            pending, self.pending = self.pending, collections.deque()
+            self.pool_lock.notify_all()
+        for request, client_address in pending:
+            self.shutdown_request(request)
+
+
+class PrereadConnection(object):
+    """A client socket whose request has already been read from it.
+
+    Request handlers read the request from this instead of the socket.
+    Everything else is passed through to the socket.  requests_left is
+    the number of requests the client may still send over the connection.
+    """
+
+    def __init__(self, sock, request, requests_left=0):
+        self.sock = sock
+        self.request = request
+        self.requests_left = requests_left
+
+    def makefile(self, *args, **kw):
+        # StreamRequestHandler only makes a file for reading, since it
+        # writes straight to the socket; restview only handles GET and
+        # HEAD, which have no body
+        return io.BytesIO(self.request)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class AsyncConnection(PrereadConnection):
+    """A client socket used from an asyncio event loop.
+
+    Whatever the request handler writes is buffered until drain().
+    """
+
+    def __init__(self, sock, request, loop, requests_left=0):
+        super().__init__(sock, request, requests_left)
+        self.loop = loop
+        self.buffer = bytearray()
+        self.unread = b''
+
+    def settimeout(self, timeout):
+        # The event loop needs the socket to stay non-blocking; the server
+        # takes care of timeouts
+        pass
+
+    def sendall(self, data):
+        self.buffer += data
+
+    async def drain(self):
+        data, self.buffer = bytes(self.buffer), bytearray()
+        await self.loop.sock_sendall(self.sock, data)
+
+    async def wait_closed(self):
+        """Wait until the client closes its end of the connection.
+
+        Whatever the client sends meanwhile is kept in self.unread.
+        """
+        try:
+            while True:
+                data = await self.loop.sock_recv(self.sock, 65536)
+                if not data:
+                    break
+                self.unread += data
+        except OSError:
+            pass
+
+
+class PrereadRequestHandlerMixin(object):
+    """Makes a request handler handle just the request the server read.
+
+    AsyncHTTPServer reads the next request on the connection itself.
+    """
+
+    def handle(self):
+        self.requests_left = self.connection.requests_left
+        self.handle_one_request()
+
+
+class AsyncRequestHandlerMixin(PrereadRequestHandlerMixin):
+    """Makes a request handler wait for changes in a coroutine.
+
+    Instead of blocking the thread, handle_polling() and handle_events()
+    leave a coroutine in self.coroutine for AsyncHTTPServer to run.
+    """
+
+    coroutine = None
+    disconnect = None
+
+    async def wait_for_change(self, paths, old_mtime, timeout):
+        """Wait until the latest modification time of paths changes.
+
+        Returns the new modification time, or None after the timeout.
+        Raises ConnectionResetError if the browser goes away meanwhile.
+        """
+        if self.disconnect is None:
+            self.disconnect = asyncio.ensure_future(
+                self.connection.wait_closed())
+        change = asyncio.ensure_future(
+            self.server.wait_for_change(paths, old_mtime, timeout))
+        await asyncio.wait([change, self.disconnect],
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not change.done():
+            change.cancel()
+            raise ConnectionResetError('client disconnected')
+        return change.result()
+
+    def handle_polling(self, paths, old_mtime):
+        if not self.server.start_waiting():
+            return self.send_busy()
+        self.coroutine = self.handle_polling_async(paths, old_mtime)
+
+    async def handle_polling_async(self, paths, old_mtime):
+        renderer = self.server.renderer
+        with renderer.parking('polling'), renderer.watcher.watching(paths):
+            try:
+                mtime = await self.wait_for_change(paths, old_mtime,
+                                                   self.polling_timeout)
+            except ConnectionResetError:
+                self.close_connection = True
+                return
+        # 204 No Content tells the browser to poll again
+        self.send_polling_response(204 if mtime is None else 200)
+
+    def handle_events(self, paths, old_mtime, pathname=None):
+        if not self.server.start_waiting():
+            return self.send_busy()
+        self.coroutine = self.handle_events_async(paths, old_mtime, pathname)
+
+    async def handle_events_async(self, paths, old_mtime, pathname=None):
+        # Browsers send the ID of the last event they saw when they reconnect
+        old_mtime = self.headers.get('Last-Event-ID') or old_mtime
+        self.send_events_headers()
+        if self.command == 'HEAD':
+            return
+        renderer = self.server.renderer
+        try:
+            with renderer.parking('events'), renderer.watcher.watching(paths):
+                await self.connection.drain()
+                while True:
+                    mtime = await self.wait_for_change(
+                        paths, old_mtime, self.keepalive_interval)
+                    if mtime is None:
+                        self.wfile.write(b': keepalive\n\n')
+                    else:
+                        html = None
+                        if pathname:
+                            html = await self.server.loop.run_in_executor(
+                                self.server.executor, self.render_page,
+                                pathname)
+                        self.wfile.write(self.format_event('changed', html,
+                                                           event_id=mtime))
+                        old_mtime = mtime
+                    await self.connection.drain()
+        except OSError:
+            # The browser closed the connection
+            pass
+
+    def finish(self):
+        # AsyncHTTPServer calls this again when the coroutine is done
+        if self.coroutine is None:
+            if self.disconnect is not None:
+                self.disconnect.cancel()
+            super().finish()
+
+
+class AsyncHTTPServer(object):
+    """HTTP server that runs on an asyncio event loop.
+
+    Requests that wait for changes (/polling and /events) are handled by
+    coroutines, so open browser tabs don't need a thread each.  Everything
+    else is handled by the request handler class as usual, in a thread pool.
+    Has the same API as ThreadingHTTPServer as far as RestViewer is
+    concerned.
+    """
+
+    # Threads for handling requests other than waiting for changes
+    max_workers = 32
+
+    # Requests waiting for a free thread; any more get 503 Service
+    # Unavailable
+    max_queued = 64
+
+    # Requests waiting for changes
+    max_waiting = 1000
+
+    # Seconds a browser should wait before trying again after a 503
+    retry_after = 5
+
+    # Limit on the size of the request line and headers, in bytes
+    max_request_size = 65536
+
+    def __init__(self, server_address, RequestHandlerClass, reuse_port=False):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.PrereadRequestHandlerClass = type(
+            'Preread' + RequestHandlerClass.__name__,
+            (PrereadRequestHandlerMixin, RequestHandlerClass), {})
+        self.AsyncRequestHandlerClass = type(
+            'Async' + RequestHandlerClass.__name__,
+            (AsyncRequestHandlerMixin, RequestHandlerClass), {})
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                # Let other processes listen on the same port
+                self.socket.setsockopt(socket.SOL_SOCKET,
+                                       socket.SO_REUSEPORT, 1)
+            self.socket.bind(server_address)
+            self.socket.listen(socket.SOMAXCONN)
+        except OSError:
+            self.socket.close()
+            raise
+        self.socket.setblocking(False)
+        self.executor = None
+        self.loop = None
+        self.changed = None
+        self.stopped = None
+        self.tasks = set()
+        self.busy = 0
+        self.waiting = 0
+
+    def serve_forever(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix='request')
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    def shutdown(self):
+        """Stop serve_forever(); call this from a different thread."""
+        self.loop.call_soon_threadsafe(self.stopped.set_result, None)
+
+    def server_close(self):
+        self.socket.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def has_backlog(self):
+        """Check whether requests are waiting for a free thread."""
+        return self.busy > self.max_workers
+
+    def start_waiting(self):
+        """Note that a request is going to wait for changes.
+
+        Returns False if too many requests are waiting already.
+        """
+        if self.waiting >= self.max_waiting:
+            return False
+        self.waiting += 1
+        return True
+
+    def stop_waiting(self):
+        self.waiting -= 1
+
+    async def serve(self):
+        self.changed = asyncio.Event()
+        self.stopped = self.loop.create_future()
+        watcher = self.renderer.watcher
+        watcher.add_listener(self.notify_change)
+        accepting = asyncio.ensure_future(self.accept_connections())
+        try:
+            await self.stopped
+        finally:
+            watcher.remove_listener(self.notify_change)
+            tasks = [accepting] + list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def accept_connections(self):
+        while True:
+            conn, client_address = await self.loop.sock_accept(self.socket)
+            task = self.loop.create_task(
+                self.handle_connection(conn, client_address))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def notify_change(self):
+        # Called from the file watcher thread
+        self.loop.call_soon_threadsafe(self.wake_up_waiters)
+
+    def wake_up_waiters(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait_for_change(self, paths, old_mtime, timeout):
+        """Wait until the latest modification time of paths changes.
+
+        The coroutine version of FileWatcher.wait_for_change().
+        """
+        watcher = self.renderer.watcher
+        deadline = self.loop.time() + timeout
+        while True:
+            changed = self.changed
+            mtime = watcher.wait_for_change(paths, old_mtime, timeout=0)
+            remaining = deadline - self.loop.time()
+            if mtime is not None or remaining <= 0:
+                return mtime
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def read_request(self, conn, data=b''):
+        """Read the request line and headers.
+
+        data is what has been received after the previous request.  Returns
+        the request and whatever the client has sent after it.
+        """
+        while True:
+            end = re.search(b'\r?\n\r?\n', data)
+            if end is not None:
+                return data[:end.end()], data[end.end():]
+            if len(data) > self.max_request_size:
+                return data, b''
+            chunk = await self.loop.sock_recv(conn, 65536)
+            if not chunk:
+                return data, b''
+            data += chunk
+
+    def waits_for_changes(self, request):
+        """Check whether a request is for /polling or /events."""
+        words = request.split(b'\n', 1)[0].split()
+        if len(words) < 2:
+            return False
+        path = unquote(words[1].decode('latin-1'))
+        return path.startswith(('/polling?', '/events?'))
+
+    async def handle_connection(self, conn, client_address):
+        timeout = self.RequestHandlerClass.timeout
+        requests_left = self.RequestHandlerClass.max_requests_per_connection
+        data = b''
+        keep_alive = True
+        try:
+            while keep_alive and requests_left > 0:
+                requests_left -= 1
+                try:
+                    request, data = await asyncio.wait_for(
+                        self.read_request(conn, data), timeout)
+                except asyncio.TimeoutError:
+                    return
+                if not request:
+                    return
+                if self.waits_for_changes(request):
+                    keep_alive, unread = await self.handle_waiting_request(
+                        conn, client_address, request, requests_left)
+                    data += unread
+                elif self.busy >= self.max_workers + self.max_queued:
+                    await self.loop.sock_sendall(
+                        conn, (BUSY_RESPONSE % self.retry_after).encode())
+                    return
+                else:
+                    self.busy += 1
+                    conn.setblocking(True)
+                    try:
+                        keep_alive = await self.loop.run_in_executor(
+                            self.executor, self.handle_request, conn,
+                            client_address, request, requests_left)
+                    finally:
+                        self.busy -= 1
+                    conn.setblocking(False)
+        except OSError:
+            pass
+        except Exception:
+            self.handle_error(client_address)
+        finally:
+            self.close_connection(conn)
+
+    def handle_error(self, client_address):
+        """Report an unexpected exception, like socketserver does."""
+        print('-' * 40, file=sys.stderr)
+        print('Exception occurred during processing of request from',
+              client_address, file=sys.stderr)
+        traceback.print_exc()
+        print('-' * 40, file=sys.stderr)
+
+    def handle_request(self, conn, client_address, request, requests_left=0):
+        """Handle a request in a worker thread.
+
+        Returns True if the connection should be kept open.
+        """
+        handler = self.PrereadRequestHandlerClass(
+            PrereadConnection(conn, request, requests_left), client_address,
+            self)
+        return not handler.close_connection
+
+    async def handle_waiting_request(self, conn, client_address, request,
+                                     requests_left=0):
+        """Handle a request that waits for changes.
+
+        Returns whether the connection should be kept open, and whatever
+        the client sent while the request waited.
+        """
+        connection = AsyncConnection(conn, request, self.loop, requests_left)
+        handler = self.AsyncRequestHandlerClass(connection, client_address,
+                                                self)
+        if handler.coroutine is not None:
+            try:
+                await handler.coroutine
+            finally:
+                self.stop_waiting()
+                handler.coroutine = None
+                handler.finish()
+        if handler.disconnect is not None:
+            # Make sure it stops reading from the socket before the next
+            # request is read
+            await asyncio.wait([handler.disconnect])
+        await connection.drain()
+        return not handler.close_connection, connection.unread
+
+    @staticmethod
+    def close_connection(conn):
+        try:
+            conn.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+        conn.close()
+
+
+class ClosingIterator(object):
+    """An iterable that calls a function when the WSGI server closes it."""
+
+    def __init__(self, iterable, on_close):
+        self.iterable = iterable
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+    def close(self):
+        try:
+            self.iterable.close()
+        finally:
+            self.on_close()
+
+
+class WSGIRequestHandlerMixin(object):
+    """Makes a request handler handle a WSGI request.
+
+    The request comes from the WSGI environ instead of a socket.  The
+    response status and headers are collected for start_response(), and
+    the body ends up in self.wfile, or in self.body if it's a file or an
+    event stream that shouldn't be read into memory.
+    """
+
+    def __init__(self, environ, server):
+        self.environ = environ
+        self.server = server
+        self.client_address = (environ.get('REMOTE_ADDR', ''), 0)
+        self.command = environ['REQUEST_METHOD']
+        # do_GET_or_HEAD() expects the path as the browser sent it
+        self.path = quote(environ.get('PATH_INFO', '').encode('latin-1'))
+        if environ.get('QUERY_STRING'):
+            self.path += '?' + environ['QUERY_STRING']
+        self.request_version = environ.get('SERVER_PROTOCOL', 'HTTP/1.0')
+        self.requestline = '%s %s %s' % (self.command, self.path,
+                                         self.request_version)
+        self.headers = self.get_headers(environ)
+        self.close_connection = True
+        self.status = None
+        self.response_headers = []
+        self.wfile = io.BytesIO()
+        self.body = None
+        method = getattr(self, 'do_' + self.command, None)
+        if method is None:
+            self.send_error(501, "Unsupported method (%r)" % self.command)
+        else:
+            method()
+
+    @staticmethod
+    def get_headers(environ):
+        headers = http.client.HTTPMessage()
+        for key, value in environ.items():
+            if key.startswith('HTTP_'):
+                headers[key[len('HTTP_'):].replace('_', '-').title()] = value
+        return headers
+
+    def send_response(self, code, message=None):
+        # The WSGI server logs requests and adds the Server and Date headers
+        self.send_response_only(code, message)
+
+    def send_response_only(self, code, message=None):
+        # send_error() passes its message, which may be too long or not
+        # even Latin-1, so the status gets the standard reason phrase
+        self.status = '%d %s' % (code, self.responses.get(code, ('',))[0])
+
+    def send_header(self, keyword, value):
+        # Connection management is up to the WSGI server
+        if keyword.lower() != 'connection':
+            self.response_headers.append((keyword, value))
+
+    def end_headers(self):
+        pass
+
+    def log_message(self, format, *args):
+        self.environ['wsgi.errors'].write('%s\n' % (format % args))
+
+    def client_disconnected(self):
+        # WSGI has no way of telling; /polling requests time out anyway
+        return False
+
+    def send_file(self, f, offset, count):
+        # handle_file() closes f when it returns
+        f = os.fdopen(os.dup(f.fileno()), 'rb')
+        self.body = ClosingIterator(self.read_file(f, offset, count), f.close)
+
+    @staticmethod
+    def read_file(f, offset, count, blocksize=65536):
+        f.seek(offset)
+        while count > 0:
+            data = f.read(min(count, blocksize))
+            if not data:
+                break
+            count -= len(data)
+            yield data
+
+    def handle_events(self, paths, old_mtime, pathname=None):
+        # Browsers send the ID of the last event they saw when they reconnect
+        old_mtime = self.headers.get('Last-Event-ID') or old_mtime
+        if not self.server.start_waiting():
+            return self.send_busy()
+        self.send_events_headers()
+        if self.command == 'HEAD':
+            self.server.stop_waiting()
+        else:
+            self.body = ClosingIterator(
+                self.iter_events(paths, old_mtime, pathname),
+                self.server.stop_waiting)
+
+
+class WSGIApplication(object):
+    """WSGI application that serves the same pages as RestViewer.
+
+    Plays the part of the server for the request handler class, so that
+    restview can run under any WSGI server.  Requests for /polling and
+    /events keep a thread of the WSGI server busy while they wait for
+    changes, so there may be only max_waiting of them; any more get 503
+    Service Unavailable, and the browser tries again later.
+
+    Unless max_waiting is given, it is default_max_waiting, or 0 if the
+    WSGI server handles one request at a time (see wsgi.multithread),
+    since a waiting request would block it.
+    """
+
+    # Seconds a browser should wait before trying again after a 503
+    retry_after = 5
+
+    # Requests that may wait for changes under a multithreaded WSGI server;
+    # they shouldn't take up all its threads (e.g. gunicorn --threads 8)
+    default_max_waiting = 2
+
+    def __init__(self, renderer, max_waiting=None):
+        self.renderer = renderer
+        self.RequestHandlerClass = type(
+            'WSGI' + renderer.handler_class.__name__,
+            (WSGIRequestHandlerMixin, renderer.handler_class), {})
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.started = False
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not self.started:
+            self.start(environ)
+        handler = self.RequestHandlerClass(environ, self)
+        start_response(handler.status, handler.response_headers)
+        if handler.body is not None:
+            return handler.body
+        return [handler.wfile.getvalue()]
+
+    def start(self, environ):
+        # Threads and worker processes started before a WSGI server forks
+        # wouldn't exist in its worker processes, so this waits for the
+        # first request
+        with self.lock:
+            if not self.started:
+                if self.max_waiting is None:
+                    if environ.get('wsgi.multithread'):
+                        self.max_waiting = self.default_max_waiting
+                    else:
+                        self.max_waiting = 0
+                self.renderer.start_services()
+                self.started = True
+
+    def start_waiting(self):
+        """Note that a request is going to wait for changes.
+
+        Returns False if too many requests are waiting already.
+        """
+        with self.lock:
+            if self.waiting >= self.max_waiting:
+                return False
+            self.waiting += 1
+            return True
+
+    def stop_waiting(self):
+        with self.lock:
+            self.waiting -= 1
 
-ERROR_TEMPLATE = """\
-<!DOCTYPE html>
-<html>
-<head>
-<title>$title</title>
-<style type="text/css">
-pre.error {
-    border-left: 1ex solid red;
-    padding-left: 1.5em;
-    padding-top: 1em;
-    padding-bottom: 1em;
-    color: red;
-    background: #fff8f8;
-}
-pre > .highlight {
-    display: block;
-    color: red;
-    background: #fff8f8;
-}
-</style>
-</head>
-<body>
-<h1>$title</h1>
-<pre class="error">
-$error
-</pre>
-<pre>
-$source
-</pre>
-</body>
-</html>
-"""
 
+def make_wsgi_app(root, command=None, watch=None, **options):
+    """Create a WSGI application that serves documents like restview.
 
-class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    daemon_threads = True
+    The arguments are those of RestViewer; options set RestViewer
+    attributes, e.g. allowed_hosts, stylesheets or render_workers.
+    """
+    viewer = RestViewer(root, command=command, watch=watch)
+    for name, value in options.items():
+        if name.startswith('_') or not hasattr(RestViewer, name) or \
+                inspect.isroutine(getattr(RestViewer, name)):
+            raise TypeError('unknown RestViewer option: %s' % name)
+        setattr(viewer, name, value)
+    if 'cache_size' in options:
+        viewer.render_cache = RenderCache(viewer.cache_size)
+    # The default max_waiting_requests is meant for restview's own server
+    return WSGIApplication(
+        viewer, max_waiting=options.get('max_waiting_requests'))
 
 
 class RestViewer(object):
@@ -389,43 +3023,335 @@ class RestViewer(object):
     # stylesheets restview.css and oldrestview.css).
     stylesheets = 'html4css1.css,restview.css'
 
+    # Link the stylesheets (and Pygments styles) as separate files that
+    # browsers can cache instead of embedding them into every page.
+    link_stylesheets = False
+
     favicon_path = os.path.join(DATA_PATH, 'favicon.ico')
 
     report_level = None
     halt_level = None
     pypi_strict = False
 
+    # Upper limit for the total size of rendered pages kept in memory, in
+    # bytes.
+    cache_size = 32 * 1024 * 1024
+
+    # Threads handling requests, connections that may wait for a free one
+    # (any more get 503 Service Unavailable), and requests that may wait
+    # for changes at the same time.
+    request_threads = 32
+    request_queue_size = 64
+    max_waiting_requests = 1000
+
+    # Number of processes serving requests.  More than one means forking
+    # worker processes that listen on the same port (with SO_REUSEPORT),
+    # so the kernel spreads connections between them.
+    processes = 1
+
+    # Seconds to wait before restarting a worker process that died right
+    # after it was started
+    worker_restart_delay = 1
+
+    # Number of worker processes for rendering documents; 0 renders them
+    # in the request handling threads (unless a limit below is set, in which
+    # case there's one worker per CPU).
+    render_workers = 0
+
+    # Limits for rendering a single document: wall-clock time in seconds
+    # and worker process address space size in bytes.  A worker that takes
+    # too long is killed.
+    render_timeout = None
+    render_memory_limit = None
+
+    # Upper limit for the estimated memory used by the full-text search
+    # index of served directories, in bytes; 0 disables search.
+    search_index_size = 128 * 1024 * 1024
+
+    # Seconds between checks for new and changed documents to index
+    search_refresh_interval = 5
+
     def __init__(self, root, command=None, watch=None):
         self.root = root
         self.command = command
         self.watch = watch
+        self.render_cache = RenderCache(self.cache_size)
+        self.watcher = FileWatcher()
+        self.render_pool = None
+        self._render_pool_lock = threading.Lock()
+        self._render_contexts = {}
+        self.parked_requests = collections.Counter()
+        self._parked_requests_lock = threading.Lock()
+        self.directory_indexes = {}
+        self._directory_indexes_lock = threading.Lock()
+        self.search_indexes = []
+        self.search_thread = None
+        self.server = None
+        self.reserved_socket = None
+        self.worker_pids = {}
+        self.parent_pipe = None
 
     def listen(self):
         """Start listening on a TCP port.
 
         Returns the port number.
         """
-        self.server = self.server_class(self.local_address, self.handler_class)
-        self.server.renderer = self
+        if self.processes > 1:
+            self.reserved_socket = self.reserve_port()
+            self.start_workers()
+            return self.reserved_socket.getsockname()[1]
+        self.start_server(self.local_address)
         return self.server.socket.getsockname()[1]
 
+    def start_server(self, address, **kw):
+        self.server = self.server_class(address, self.handler_class, **kw)
+        self.server.renderer = self
+        self.server.max_workers = self.request_threads
+        self.server.max_queued = self.request_queue_size
+        self.server.max_waiting = self.max_waiting_requests
+        self.start_services()
+
+    def start_services(self):
+        """Start the render worker pool (if used) and the search indexer."""
+        if self.uses_render_pool():
+            self.get_render_pool()
+        self.start_search_indexer()
+
+    def reserve_port(self):
+        """Bind a socket that keeps the port for the worker processes.
+
+        The socket doesn't listen, so it doesn't get any connections.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind(self.local_address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def start_workers(self):
+        # Workers notice that the parent process is gone when this pipe
+        # gets closed
+        self.parent_pipe = os.pipe()
+        for n in range(self.processes):
+            self.start_worker()
+
+    def start_worker(self):
+        pid = os.fork()
+        if pid == 0:
+            self.run_worker()
+        self.worker_pids[pid] = time.monotonic()
+
+    def run_worker(self):
+        """Serve requests in a worker process; exit when done."""
+        status = 1
+        try:
+            self.worker_pids = {}
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.close(self.parent_pipe[1])
+            address = self.reserved_socket.getsockname()
+            self.reserved_socket.close()
+            self.reserved_socket = None
+            self.start_server(address, reuse_port=True)
+            threading.Thread(target=self.wait_for_parent, name='parent',
+                             daemon=True).start()
+            self.server.serve_forever()
+            status = 0
+        except KeyboardInterrupt:
+            status = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.close()
+            os._exit(status)
+
+    def wait_for_parent(self):
+        """Stop serving when the parent process exits."""
+        os.read(self.parent_pipe[0], 1)
+        self.server.shutdown()
+
+    def supervise_workers(self):
+        """Restart worker processes when they exit.
+
+        This function does not return.
+        """
+        # Let close() stop the workers instead of leaving them behind
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        while True:
+            pid, status = os.wait()
+            started = self.worker_pids.pop(pid, None)
+            if started is None:
+                continue
+            print("Worker process %d exited with status %d, restarting"
+                  % (pid, os.waitstatus_to_exitcode(status)), file=sys.stderr)
+            if time.monotonic() - started < self.worker_restart_delay:
+                time.sleep(self.worker_restart_delay)
+            self.start_worker()
+
+    def stop_workers(self):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.worker_pids:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.worker_pids = {}
+
     def serve(self):
         """Wait for HTTP requests and serve them.
 
         This function does not return.
         """
-        self.server.serve_forever()
+        if self.processes > 1:
+            self.supervise_workers()
+        else:
+            self.server.serve_forever()
 
     def close(self):
-        self.server.server_close()
+        if self.worker_pids:
+            self.stop_workers()
+        if self.reserved_socket is not None:
+            self.reserved_socket.close()
+            self.reserved_socket = None
+        if self.server is not None:
+            self.server.server_close()
+        if self.render_pool is not None:
+            self.render_pool.shutdown()
+            self.render_pool = None
 
-    def rest_to_html(self, rest_input, settings=None, mtime=None, filename=None):
-        """Render ReStructuredText."""
-        writer = docutils.writers.html4css1.Writer()
-        if pygments is not None:
-            writer.translator_class = SyntaxHighlightingHTMLTranslator
+    def uses_render_pool(self):
+        """Check whether documents are rendered in worker processes."""
+        return bool(self.render_workers or self.render_timeout
+                    or self.render_memory_limit)
+
+    @staticmethod
+    def get_mp_context():
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            # Forking a multithreaded server is asking for deadlocks
+            return multiprocessing.get_context('forkserver')
+        else:  # pragma: nocover
+            return multiprocessing.get_context('spawn')
+
+    def get_render_pool(self):
+        """Return the pool of worker processes, starting it if necessary."""
+        with self._render_pool_lock:
+            if self.render_pool is None:
+                workers = self.render_workers or os.cpu_count() or 1
+                self.render_pool = RenderWorkerPool(
+                    workers, self.get_mp_context(), init_render_worker,
+                    (self.__class__, self.worker_config(),
+                     self.render_memory_limit))
+            return self.render_pool
+
+    def worker_config(self):
+        """Return the settings a worker process needs to render documents."""
+        return {
+            'stylesheets': self.stylesheets,
+            'link_stylesheets': self.link_stylesheets,
+            'pypi_strict': self.pypi_strict,
+            'halt_level': self.halt_level,
+            'report_level': self.report_level,
+        }
+
+    @contextlib.contextmanager
+    def parking(self, kind):
+        """Context manager that counts requests waiting for changes."""
+        with self._parked_requests_lock:
+            self.parked_requests[kind] += 1
+        try:
+            yield
+        finally:
+            with self._parked_requests_lock:
+                self.parked_requests[kind] -= 1
+
+    def get_directory_index(self, dirname):
+        """Return the DirectoryIndex for dirname, creating it if needed."""
+        dirname = os.path.abspath(dirname)
+        with self._directory_indexes_lock:
+            try:
+                return self.directory_indexes[dirname]
+            except KeyError:
+                index = self.directory_indexes[dirname] = DirectoryIndex(dirname)
+                return index
+
+    def start_search_indexer(self):
+        """Start indexing served directories in a background thread."""
+        if self.command or not self.search_index_size:
+            return
+        if isinstance(self.root, str):
+            roots = [('', self.root)]
+        else:
+            roots = [('%d/' % idx, fn) for idx, fn in enumerate(self.root)]
+        roots = [(prefix, fn) for prefix, fn in roots if os.path.isdir(fn)]
+        if not roots:
+            return
+        max_size = self.search_index_size // len(roots)
+        self.search_indexes = [
+            (prefix, SearchIndex(self.get_directory_index(dirname), max_size))
+            for prefix, dirname in roots]
+        self.search_thread = threading.Thread(
+            target=self.run_search_indexer, name='search indexer', daemon=True)
+        self.search_thread.start()
+
+    def run_search_indexer(self):
+        while True:
+            for prefix, index in self.search_indexes:
+                index.refresh()
+            time.sleep(self.search_refresh_interval)
+
+    def search(self, query, limit=20):
+        """Search all served directories.
+
+        Returns the number of matching documents and a list of
+        (href, index, relpath) tuples for the best ``limit`` matches.
+        """
+        total = 0
+        matches = []
+        for prefix, index in self.search_indexes:
+            n, best = index.search(query, limit)
+            total += n
+            matches.extend((score, prefix, index, relpath)
+                           for score, relpath in best)
+        matches.sort(key=lambda match: match[0], reverse=True)
+        return total, [
+            (quote(prefix + relpath.replace(os.path.sep, '/')), index, relpath)
+            for score, prefix, index, relpath in matches[:limit]]
+
+    def get_stats(self):
+        """Return a dict of counters for the /_api/stats page."""
+        return {
+            # Each worker process (see --processes) has its own counters
+            'pid': os.getpid(),
+            'render_cache': self.render_cache.stats(),
+            'file_watcher': self.watcher.stats(),
+            'parked_requests': {
+                'polling': self.parked_requests['polling'],
+                'events': self.parked_requests['events'],
+            },
+            'directory_indexes': {
+                dirname: index.stats()
+                for dirname, index in self.directory_indexes.items()
+            },
+            'search_indexes': {
+                index.root: index.stats()
+                for prefix, index in self.search_indexes
+            },
+            'highlight_cache':
+                SyntaxHighlightingHTMLTranslator.highlight_cache.stats(),
+            'code_block_cache': CachingLexer.cache.stats(),
+        }
+
+    def settings_overrides(self, settings=None):
+        """Return docutils settings for the current configuration."""
         if self.stylesheets:
-            stylesheet_dirs = writer.default_stylesheet_dirs + [DATA_PATH]
+            stylesheet_dirs = (docutils.writers.html4css1.Writer.default_stylesheet_dirs
+                               + [DATA_PATH])
             if '//' not in self.stylesheets:
                 settings_overrides = {'stylesheet': None,
                                       'stylesheet_path': self.stylesheets,
@@ -449,25 +3375,389 @@ class RestViewer(object):
 
         if settings:  # hook for unit tests
             settings_overrides.update(settings)
+        return settings_overrides
+
+    def render_config(self, settings=None):
+        """Return a hashable summary of the rendering configuration."""
+        return (self.stylesheets, self.link_stylesheets, self.pypi_strict,
+                self.halt_level, self.report_level,
+                repr(sorted(settings.items())) if settings else None)
+
+    def get_render_context(self, settings=None):
+        """Return a RenderContext for the current configuration.
+
+        The context is reused until the configuration or one of the
+        embedded stylesheets changes.
+        """
+        config = self.render_config(settings)
+        context = self._render_contexts.get(config)
+        if context is None or context.is_stale():
+            context = RenderContext(self.settings_overrides(settings),
+                                    link_stylesheets=self.link_stylesheets)
+            if len(self._render_contexts) >= 8:
+                self._render_contexts.clear()
+            self._render_contexts[config] = context
+        return context
+
+    def get_static_file(self, name):
+        """Return the contents of a linked stylesheet, or None."""
+        contexts = [self.get_render_context()]
+        contexts += list(self._render_contexts.values())
+        for context in contexts:
+            if name in context.static_files:
+                return context.static_files[name]
+        return None
+
+    def settings_key(self, settings=None):
+        """Return a hashable summary of everything that affects rendering."""
+        context = self.get_render_context(settings)
+        return self.render_config(settings) + (context.stylesheet_stamps, )
+
+    def fingerprint(self, rest_input, settings=None, filename=None):
+        """Return a hash of the input and everything that affects rendering."""
+        if isinstance(rest_input, str):
+            rest_input = rest_input.encode('UTF-8')
+        h = hashlib.blake2b(rest_input, digest_size=20)
+        h.update(repr((filename, self.settings_key(settings))).encode('UTF-8'))
+        return h.hexdigest()
+
+    def cache_key(self, rest_input, settings=None, filename=None, stat=None):
+        """Return the render cache key for a document.
+
+        Files are identified by their name, size and modification time, which
+        is cheaper than hashing their contents.  Everything else (e.g. the
+        output of --execute) is identified by a hash of the input.
+        """
+        if filename is not None and stat is not None:
+            return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size,
+                    self.settings_key(settings))
+        return self.fingerprint(rest_input, settings, filename=filename)
+
+    def get_validators(self, rest_input, settings=None, mtime=None,
+                       filename=None, stat=None):
+        """Return an HTTP ETag and Last-Modified time for a page.
+
+        They describe the page rest_to_html() would return, including the
+        files the document includes.  Those are known only while the page
+        is in the render cache, so until it is rendered (or if caching is
+        disabled) both are None.  Only files have a Last-Modified time.
+
+        This is as cheap as looking the page up in the render cache.
+        """
+        key = self.cache_key(rest_input, settings, filename=filename,
+                             stat=stat)
+        entry = self.get_cached_render(key, peek=True)
+        if entry is None:
+            return None, None
+        html, stamps = entry
+        h = hashlib.blake2b(
+            repr((__version__, key, stamps, mtime)).encode('UTF-8'),
+            digest_size=16)
+        last_modified = None
+        if stat is not None and mtime is not None:
+            last_modified = max([mtime] + [dep_mtime / 1e9
+                                           for path, dep_mtime, size in stamps
+                                           if dep_mtime is not None])
+        return '"%s"' % h.hexdigest(), last_modified
+
+    @staticmethod
+    def get_dependency_stamps(paths):
+        """Return (path, mtime, size) for each of the files in paths.
+
+        The mtime and size of files that can't be found are None.
+        """
+        stamps = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                stamps.append((path, None, None))
+            else:
+                stamps.append((path, st.st_mtime_ns, st.st_size))
+        return tuple(stamps)
+
+    def get_cached_render(self, key, peek=False):
+        """Look up a page in the render cache.
+
+        Returns the HTML and the stamps of the files the document includes,
+        or None if the page isn't cached or one of those files has changed.
+        """
+        if peek:
+            entry = self.render_cache.peek(key)
+        else:
+            entry = self.render_cache.get(key)
+        if entry is None:
+            return None
+        html, stamps = entry
+        if self.get_dependency_stamps(path for path, m, s in stamps) != stamps:
+            return None
+        return entry
+
+    def rest_to_html(self, rest_input, settings=None, mtime=None, filename=None,
+                     stat=None):
+        """Render ReStructuredText.
+
+        Pass the ``os.stat()`` result of the file the input was read from as
+        ``stat`` to let restview reuse the rendered HTML until the file
+        changes.  Without it the rendered HTML is reused as long as the
+        input stays the same.  Either way it is rendered again when any of
+        the files the document includes (e.g. with ``.. include::``)
+        changes.
+
+        Raises RenderFailure if rendering fails (other than because of
+        problems in the document).
+        """
+        try:
+            if self.render_cache.max_size:
+                key = self.cache_key(rest_input, settings, filename=filename,
+                                     stat=stat)
+                entry = self.get_cached_render(key)
+                if entry is None:
+                    dependencies = []
+                    html = self.render(rest_input, settings, filename=filename,
+                                       dependencies=dependencies)
+                    entry = (html, self.get_dependency_stamps(dependencies))
+                    self.render_cache.put(key, entry,
+                                          len(html.encode('UTF-8')))
+                html = entry[0]
+            else:
+                html = self.render(rest_input, settings, filename=filename)
+        except RenderFailure as e:
+            e.html = self.inject_ajax(e.html, mtime=mtime)
+            raise
+        return self.inject_ajax(html, mtime=mtime)
+
+    def render(self, rest_input, settings=None, filename=None,
+               dependencies=None):
+        """Render ReStructuredText without the AJAX poller.
 
+        Uses a worker process if --render-workers, --render-timeout or
+        --render-memory-limit was specified.  Raises RenderFailure if
+        that fails.
+
+        The absolute paths of the files the document includes are appended
+        to the dependencies list, if one is given.
+        """
+        try:
+            if not self.uses_render_pool():
+                return self.publish(rest_input, settings, filename=filename,
+                                    dependencies=dependencies)
+            return self.render_in_pool(rest_input, settings, filename=filename,
+                                       dependencies=dependencies)
+        except concurrent.futures.TimeoutError:
+            error = ('Rendering took longer than the time limit of %s seconds.'
+                     % self.render_timeout)
+            raise RenderFailure(
+                self.render_exception('RenderTimeout', error, rest_input))
+        except MemoryError:
+            if self.render_memory_limit:
+                error = ('Rendering needed more than the memory limit of %s MB.'
+                         % (self.render_memory_limit // (1024 * 1024)))
+            else:
+                error = 'Ran out of memory while rendering.'
+            raise RenderFailure(
+                self.render_exception('MemoryError', error, rest_input))
+        except Exception as e:
+            # The document itself can't cause an exception here: publish()
+            # catches and renders those.  This is about workers dying.
+            raise RenderFailure(self.render_exception(
+                e.__class__.__name__, str(e), rest_input))
+
+    def render_in_pool(self, rest_input, settings=None, filename=None,
+                       dependencies=None):
+        html, paths = self.get_render_pool().call(
+            render_in_worker, self.__class__, self.worker_config(),
+            rest_input, settings, filename, timeout=self.render_timeout)
+        if dependencies is not None:
+            dependencies.extend(paths)
+        return html
+
+    def publish(self, rest_input, settings=None, filename=None,
+                dependencies=None):
+        """Render ReStructuredText in the current process."""
         try:
-            docutils.core.publish_string(rest_input, writer=writer,
-                                         source_path=filename,
-                                         settings_overrides=settings_overrides)
-            if self.pypi_strict:
-                clean_body = readme_rst.clean(''.join(writer.body))
-                if clean_body is None:
-                    # Unfortunately the real error was caught and discared,
-                    # without even logging :/
-                    raise ValueError("Output cleaning failed")
-                writer.body = [clean_body]
-                writer.output = writer.apply_template()
+            html = self.convert(rest_input, settings, filename=filename,
+                                dependencies=dependencies)
+        except MemoryError:
+            # Trying to render an error page is not going to help
+            raise
         except Exception as e:
             line = self.extract_line_info(e, filename)
-            html = self.render_exception(e.__class__.__name__, str(e), rest_input, mtime=mtime, line=line)
-        else:
-            html = writer.output
-        return self.inject_ajax(html, mtime=mtime)
+            html = self.render_exception(e.__class__.__name__, str(e), rest_input, line=line)
+        return html
+
+    def convert(self, rest_input, settings=None, filename=None,
+                warning_stream=None, dependencies=None):
+        """Convert ReStructuredText to HTML.
+
+        Raises an exception if the document has errors (depending on
+        halt_level and pypi_strict).  The absolute paths of the files
+        docutils read while converting are appended to dependencies.
+        """
+        context = self.get_render_context(settings)
+        writer = context.new_writer()
+        settings = context.new_settings()
+        if warning_stream is not None:
+            settings.warning_stream = warning_stream
+        try:
+            with CachingLexer.installed():
+                docutils.core.publish_string(rest_input, writer=writer,
+                                             source_path=filename,
+                                             settings=settings)
+        finally:
+            # The error page for a broken include depends on it too
+            if dependencies is not None:
+                dependencies.extend(
+                    os.path.abspath(path)
+                    for path in settings.record_dependencies.list)
+        if self.pypi_strict:
+            clean_body = readme_rst.clean(''.join(writer.body))
+            if clean_body is None:
+                # Unfortunately the real error was caught and discared,
+                # without even logging :/
+                raise ValueError("Output cleaning failed")
+            writer.body = [clean_body]
+            writer.output = writer.apply_template()
+        return writer.output
+
+    def check(self, paths):
+        """Check documents for problems and print what's wrong.
+
+        Directories are searched for .rst and .txt files.  Returns True if
+        there were no problems.
+        """
+        filenames = []
+        for path in paths:
+            if os.path.isdir(path):
+                index = self.get_directory_index(path)
+                filenames += [os.path.join(path, fn) for fn in index.list_files()]
+            else:
+                filenames.append(path)
+        ok = True
+        for messages in self.check_files(filenames):
+            for message in messages:
+                print(message)
+            ok = ok and not messages
+        return ok
+
+    def check_files(self, filenames):
+        """Check files, in worker processes if there's more than one CPU.
+
+        Yields a list of diagnostics for each file.
+        """
+        return self.map_in_workers(
+            'check_file', [(filename, ) for filename in filenames])
+
+    def map_in_workers(self, method, args_list):
+        """Call a method with each of the argument tuples in args_list.
+
+        Uses a pool of worker processes (one per CPU, or render_workers)
+        if there's more than one CPU.  Yields the results in order.
+        """
+        workers = min(self.render_workers or os.cpu_count() or 1,
+                      len(args_list))
+        if workers <= 1:
+            for args in args_list:
+                yield getattr(self, method)(*args)
+            return
+        call = functools.partial(call_in_worker, self.__class__,
+                                 self.worker_config(), method)
+        chunksize = max(1, min(64, len(args_list) // (workers * 4)))
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=self.get_mp_context(),
+                initializer=init_render_worker,
+                initargs=(self.__class__, self.worker_config(),
+                          self.render_memory_limit)) as pool:
+            yield from pool.map(call, args_list, chunksize=chunksize)
+
+    def check_file(self, filename):
+        """Check a ReStructuredText file for problems.
+
+        Returns a list of diagnostics in the 'filename:line: message'
+        format, one for each problem reported by docutils (see
+        report_level).
+        """
+        try:
+            with open(filename, 'rb') as f:
+                rest_input = f.read()
+        except OSError as e:
+            return ['%s: %s' % (filename, e.strerror)]
+        warnings = WarningCollector()
+        try:
+            self.convert(rest_input, filename=filename,
+                         warning_stream=warnings)
+        except docutils.utils.SystemMessage:
+            # Already reported to the warning stream
+            pass
+        except Exception as e:
+            line = self.extract_line_info(e, filename)
+            if line is not None:
+                warnings.messages.append(str(e))
+            else:
+                warnings.messages.append('%s: %s: %s' % (
+                    filename, e.__class__.__name__, e))
+        return warnings.messages
+
+    def build_page(self, filename, outpath):
+        """Render a file into a static HTML page.
+
+        Returns the fingerprint of the file, a list of images the page
+        refers to (as relative URLs) and the stamps of the files it
+        includes (see get_dependency_stamps()), or None if the file can't
+        be read.
+        """
+        try:
+            with open(filename, 'rb') as f:
+                rest_input = f.read()
+        except OSError:
+            return None
+        dependencies = []
+        html = self.publish(rest_input, filename=filename,
+                            dependencies=dependencies)
+        html = self.link_static_pages(html)
+        if isinstance(html, str):
+            html = html.encode('UTF-8')
+        os.makedirs(os.path.dirname(outpath), exist_ok=True)
+        with open(outpath, 'wb') as f:
+            f.write(html)
+        return (self.fingerprint(rest_input, filename=filename),
+                self.find_images(html.decode('UTF-8', 'replace')),
+                self.get_dependency_stamps(dependencies))
+
+    @staticmethod
+    def link_static_pages(html):
+        """Point links to .rst and .txt files to their static HTML pages.
+
+            >>> RestViewer.link_static_pages(
+            ...     '<a href="docs/HACKING.rst#tests">, <a href="x.txt?a">')
+            '<a href="docs/HACKING.rst.html#tests">, <a href="x.txt.html?a">'
+            >>> RestViewer.link_static_pages(
+            ...     '<a class="x" href="http://example.com/README.rst">')
+            '<a class="x" href="http://example.com/README.rst">'
+
+        """
+        return re.sub(r'(<a\b[^>]*?\bhref=")([^":#?]+[.](?:rst|txt))([#?][^"]*)?"',
+                      r'\1\2.html\3"', html)
+
+    @staticmethod
+    def find_images(html):
+        """Find local images referred to by a page.
+
+            >>> RestViewer.find_images(
+            ...     '<img alt="a" src="img/a%20b.png" /> <img src="/c.gif" />'
+            ...     '<object data="d.svg" type="image/svg+xml">'
+            ...     '<img src="http://example.com/e.jpg" /> <img src="../f.png" />')
+            ['img/a b.png', 'd.svg']
+
+        """
+        images = []
+        for src in re.findall(r'<(?:img|object)\b[^>]*?\b(?:src|data)="([^"]*)"',
+                              html):
+            src = unquote(html_unescape(src))
+            if (src.endswith(IMAGE_TYPES) and ':' not in src
+                    and not src.startswith('/') and '..' not in src):
+                images.append(src)
+        return images
 
     @staticmethod
     def extract_line_info(exception, source_path):
@@ -514,15 +3804,91 @@ class RestViewer(object):
             return markup
 
 
+# RestViewer instances in a worker process, keyed by configuration.
+_worker_viewers = {}
+
+
+def get_worker_viewer(viewer_class, config):
+    key = (viewer_class, tuple(sorted(config.items())))
+    viewer = _worker_viewers.get(key)
+    if viewer is None:
+        viewer = viewer_class(None)
+        viewer.__dict__.update(config)
+        _worker_viewers[key] = viewer
+    return viewer
+
+
+def init_render_worker(viewer_class, config, memory_limit=None):
+    """Prepare a worker process for rendering documents."""
+    if memory_limit and resource is not None:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+    get_worker_viewer(viewer_class, config).get_render_context()
+
+
+def run_render_worker(conn, initializer, initargs):
+    """Make calls for a RenderWorkerPool until it closes the connection."""
+    initializer(*initargs)
+    while True:
+        try:
+            fn, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = (True, fn(*args))
+        except Exception as e:
+            result = (False, e)
+        conn.send(result)
+
+
+def render_in_worker(viewer_class, config, rest_input, settings, filename):
+    """Render ReStructuredText in a worker process.
+
+    Returns the HTML and the files the document includes.
+    """
+    viewer = get_worker_viewer(viewer_class, config)
+    dependencies = []
+    html = viewer.publish(rest_input, settings, filename=filename,
+                          dependencies=dependencies)
+    return html, dependencies
+
+
+def call_in_worker(viewer_class, config, method, args):
+    """Call a RestViewer method in a worker process."""
+    viewer = get_worker_viewer(viewer_class, config)
+    return getattr(viewer, method)(*args)
+
+
 class SyntaxHighlightingHTMLTranslator(readme_rst.ReadMeHTMLTranslator):
     in_doctest = False
     in_text = False
     in_reference = False
     formatter_styles = formatters.HtmlFormatter(style='colorful').get_style_defs('pre')
 
+    # Pygments lexers and formatters are expensive to create, so they're
+    # shared, and since doctests rarely change between renders of a
+    # document, the highlighted HTML is cached too.
+    doctest_lexer = lexers.PythonConsoleLexer()
+    doctest_formatter = formatters.HtmlFormatter(nowrap=True)
+    highlight_cache = RenderCache(4 * 1024 * 1024)
+    _highlight_lock = threading.Lock()
+
     def __init__(self, document):
         docutils.writers.html4css1.HTMLTranslator.__init__(self, document)
-        self.body_prefix[:0] = ['<style type="text/css">\n', self.formatter_styles, '\n</style>\n']
+        link = getattr(self.settings, 'restview_pygments_stylesheet', None)
+        if link:
+            self.stylesheet.append(self.stylesheet_link % self.encode(link))
+        else:
+            self.body_prefix[:0] = ['<style type="text/css">\n', self.formatter_styles, '\n</style>\n']
+
+    def stylesheet_call(self, path, *args, **kw):
+        links = getattr(self.settings, 'restview_stylesheet_links', {})
+        if path in links:
+            return self.stylesheet_link % self.encode(links[path])
+        embedded = getattr(self.settings, 'restview_embedded_stylesheets', {})
+        if self.settings.embed_stylesheet and path in embedded:
+            return self.embedded_stylesheet % embedded[path]
+        return docutils.writers.html4css1.HTMLTranslator.stylesheet_call(
+            self, path, *args, **kw)
 
     def visit_doctest_block(self, node):
         docutils.writers.html4css1.HTMLTranslator.visit_doctest_block(self, node)
@@ -532,12 +3898,19 @@ class SyntaxHighlightingHTMLTranslator(readme_rst.ReadMeHTMLTranslator):
         docutils.writers.html4css1.HTMLTranslator.depart_doctest_block(self, node)
         self.in_doctest = False
 
+    @classmethod
+    def highlight_doctest(cls, text):
+        html = cls.highlight_cache.get(text)
+        if html is None:
+            with cls._highlight_lock:
+                html = pygments.highlight(text, cls.doctest_lexer,
+                                          cls.doctest_formatter)
+            cls.highlight_cache.put(text, html, len(text) + len(html))
+        return html
+
     def visit_Text(self, node):
         if self.in_doctest:
-            text = node.astext()
-            lexer = lexers.PythonConsoleLexer()
-            formatter = formatters.HtmlFormatter(nowrap=True)
-            self.body.append(pygments.highlight(text, lexer, formatter))
+            self.body.append(self.highlight_doctest(node.astext()))
         else:
             text = node.astext()
             self.in_text = True
@@ -586,6 +3959,72 @@ class SyntaxHighlightingHTMLTranslator(readme_rst.ReadMeHTMLTranslator):
                       r'\1<a href="\2">\2</a>', text)
 
 
+class CachingLexer(docutils.utils.code_analyzer.Lexer):
+    """Syntax highlighter for code blocks that remembers its results.
+
+    Tokenizing code with Pygments dominates the rendering time of documents
+    that are mostly code, and most code blocks don't change between renders,
+    so the tokens are cached by language, source text and highlight mode.
+    """
+
+    cache = RenderCache(8 * 1024 * 1024)
+
+    # Rough memory cost of a cached token, not counting its text
+    token_size = 150
+
+    # Renders that use this lexer for the code directive right now, and
+    # the lexer docutils had before
+    users = 0
+    users_lock = threading.Lock()
+    original = None
+
+    def __init__(self, code, language, tokennames='short'):
+        self.key = None
+        self.tokens = None
+        if language not in ('', 'text') and tokennames != 'none':
+            self.key = (language, code, tokennames)
+            self.tokens = self.cache.get(self.key)
+        if self.tokens is None:
+            super().__init__(code, language, tokennames)
+
+    def __iter__(self):
+        if self.tokens is None:
+            if self.lexer is None:
+                yield from super().__iter__()
+                return
+            self.tokens = [(tuple(classes), value)
+                           for classes, value in super().__iter__()]
+            size = (len(self.code)
+                    + self.token_size * len(self.tokens))
+            self.cache.put(self.key, self.tokens, size)
+        for classes, value in self.tokens:
+            yield list(classes), value
+
+    @classmethod
+    @contextlib.contextmanager
+    def installed(cls):
+        """Make the code directive use this lexer while rendering.
+
+        The directive looks up its lexer at module level, so this swaps it
+        there, and puts the original back when no render needs it anymore;
+        docutils stays as it was for other users in the same process.
+        """
+        body = docutils.parsers.rst.directives.body
+        with cls.users_lock:
+            if cls.users == 0:
+                cls.original = body.Lexer
+                body.Lexer = cls
+            cls.users += 1
+        try:
+            yield
+        finally:
+            with cls.users_lock:
+                cls.users -= 1
+                if cls.users == 0:
+                    body.Lexer = cls.original
+                    cls.original = None
+
+
 def parse_address(addr):
     """Parse a socket address.
 
@@ -638,6 +4077,10 @@ def get_host_name(listen_on):
         return listen_on
 
 
+def exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
 def launch_browser(url):
     """Launch the web browser for a given URL.
 
@@ -692,6 +4135,11 @@ def main():
                              ' multiple times [default: %s]'
                              % RestViewer.stylesheets,
                         action='append', dest='stylesheets', default=[])
+    parser.add_argument(
+        '--link-stylesheets',
+        help='serve the stylesheets as separate files that browsers can'
+             ' cache instead of embedding them into every page',
+        action='store_true', default=False)
     parser.add_argument(
         '--report-level',
         help='''set the "report_level" option of docutils; restview
@@ -714,6 +4162,71 @@ def main():
         '--pypi-strict',
         help='enable additional restrictions that PyPI performs',
         action='store_true', default=False)
+    parser.add_argument(
+        '--asyncio', action='store_true',
+        help='serve requests from an asyncio event loop instead of a thread'
+             ' per connection; browser tabs waiting for changes then cost'
+             ' almost nothing')
+    parser.add_argument(
+        '--threads', metavar='N',
+        help='handle up to N requests at the same time [default: %d]'
+             % RestViewer.request_threads,
+        type=int, default=RestViewer.request_threads)
+    parser.add_argument(
+        '--queue-size', metavar='N',
+        help='let up to N more requests wait for a free thread; any more'
+             ' get "503 Service Unavailable" [default: %d]'
+             % RestViewer.request_queue_size,
+        type=int, default=RestViewer.request_queue_size)
+    parser.add_argument(
+        '--max-waiting', metavar='N',
+        help='let up to N browser tabs wait for changes at the same time'
+             ' [default: %d]' % RestViewer.max_waiting_requests,
+        type=int, default=RestViewer.max_waiting_requests)
+    parser.add_argument(
+        '--processes', metavar='N',
+        help='serve requests from N processes that listen on the same port;'
+             ' the kernel spreads connections between them [default: 1]',
+        type=int, default=1)
+    parser.add_argument(
+        '--check', action='store_true',
+        help='check the files (and .rst/.txt files in the directories) for'
+             ' problems instead of serving them; exits with status 1 if'
+             ' docutils reports any problems (see --report-level)')
+    parser.add_argument(
+        '--build', metavar='OUTDIR',
+        help='write the rendered files, directory listings and images into'
+             ' a directory as a static website instead of serving them;'
+             ' only files that changed since the last build are rendered'
+             ' again')
+    parser.add_argument(
+        '--cache-size', metavar='MB',
+        help='keep up to this many megabytes of rendered pages in memory;'
+             ' 0 disables the cache [default: %d]'
+             % (RestViewer.cache_size // (1024 * 1024)),
+        type=int, default=None)
+    parser.add_argument(
+        '--search-index-size', metavar='MB',
+        help='use up to this many megabytes of memory for the full-text'
+             ' search index of served directories; 0 disables search'
+             ' [default: %d]' % (RestViewer.search_index_size // (1024 * 1024)),
+        type=int, default=None)
+    parser.add_argument(
+        '--render-workers', metavar='N',
+        help='render documents in N worker processes, so that large'
+             ' documents can be rendered in parallel [default: render'
+             ' in the server process]',
+        type=int, default=0)
+    parser.add_argument(
+        '--render-timeout', metavar='SECONDS',
+        help='give up rendering a document after this many seconds; the'
+             ' worker process rendering it gets killed',
+        type=float, default=None)
+    parser.add_argument(
+        '--render-memory-limit', metavar='MB',
+        help='limit the memory of worker processes rendering documents'
+             ' to this many megabytes',
+        type=int, default=None)
     opts = parser.parse_args(sys.argv[1:])
     args = opts.root
     if opts.long_description:
@@ -724,6 +4237,16 @@ def main():
         parser.error("at least one argument expected")
     if args and opts.execute:
         parser.error("specify a command (-e) or a file/directory, but not both")
+    if opts.check and opts.execute:
+        parser.error("--check doesn't work with a command (-e)")
+    if opts.build and opts.execute:
+        parser.error("--build doesn't work with a command (-e)")
+    if opts.build and opts.link_stylesheets:
+        parser.error("--build doesn't work with --link-stylesheets")
+    if opts.processes > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error("--processes is not supported on this platform")
+    if opts.render_memory_limit and resource is None:
+        parser.error("--render-memory-limit is not supported on this platform")
     if opts.browser is None:
         opts.browser = opts.listen is None
     if opts.execute:
@@ -734,9 +4257,32 @@ def main():
         server = RestViewer(args, watch=opts.watch)
     if opts.stylesheets:
         server.stylesheets = ','.join(opts.stylesheets)
+    if opts.asyncio:
+        server.server_class = AsyncHTTPServer
+    server.request_threads = opts.threads
+    server.request_queue_size = opts.queue_size
+    server.max_waiting_requests = opts.max_waiting
+    server.processes = opts.processes
+    server.link_stylesheets = opts.link_stylesheets
     server.report_level = opts.report_level
     server.halt_level = opts.halt_level
     server.pypi_strict = opts.pypi_strict
+    if opts.cache_size is not None:
+        server.render_cache = RenderCache(opts.cache_size * 1024 * 1024)
+    if opts.search_index_size is not None:
+        server.search_index_size = opts.search_index_size * 1024 * 1024
+    server.render_workers = opts.render_workers
+    server.render_timeout = opts.render_timeout
+    if opts.render_memory_limit:
+        server.render_memory_limit = opts.render_memory_limit * 1024 * 1024
+    if opts.check:
+        sys.exit(0 if server.check(args) else 1)
+    if opts.build:
+        builder = SiteBuilder(server, opts.build)
+        ok = builder.build()
+        print("Rendered %d pages (%d unchanged) into %s"
+              % (builder.rendered, builder.unchanged, opts.build))
+        sys.exit(0 if ok else 1)
 
     if opts.listen:
         try:
@@ -1,23 +1,67 @@
+import asyncio
+import concurrent.futures
+import contextlib
 import doctest
 import errno
+import gzip
+import http.client
+import itertools
+import json
+import math
+import multiprocessing
 import os
+import re
+import shutil
+import signal
 import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import webbrowser
 from io import StringIO
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, MagicMock, Mock, call, patch
 
+import docutils.parsers.rst.directives.body
 import docutils.utils
+import docutils.utils.code_analyzer
 
 from restview.restviewhttp import (
+    AsyncConnection,
+    AsyncHTTPServer,
+    CachingLexer,
+    DirectoryIndex,
+    FileWatcher,
+    Inotify,
     MyRequestHandler,
+    RenderCache,
+    RenderFailure,
+    RenderWorkerPool,
     RestViewer,
+    SearchIndex,
+    SiteBuilder,
+    SyntaxHighlightingHTMLTranslator,
+    ThreadingHTTPServer,
+    call_in_worker,
+    exit_on_signal,
     get_host_name,
+    init_render_worker,
     launch_browser,
     main,
+    make_wsgi_app,
+    render_in_worker,
+    run_render_worker,
 )
 
 
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
 class PopenStub(object):
 
     def __init__(self, stdout='', stderr='', retcode=0):
@@ -33,17 +77,68 @@ class PopenStub(object):
         return (self._stdout, self._stderr)
 
 
+class SlowRestViewer(RestViewer):
+
+    def publish(self, rest_input, settings=None, filename=None,
+                dependencies=None):  # pragma: nocover
+        # this runs in a worker process
+        time.sleep(30)
+
+
+class FileWatcherStub(object):
+
+    def __init__(self, changes=()):
+        self.subscribed = []
+        self.waited = []
+        self.changes = list(changes)
+
+    @contextlib.contextmanager
+    def watching(self, paths):
+        self.subscribed.append(list(paths))
+        yield self
+
+    def wait_for_change(self, paths, old_mtime, timeout=None):
+        self.waited.append((list(paths), old_mtime))
+        if self.changes:
+            mtime = self.changes.pop(0)
+            if mtime is None and timeout:
+                time.sleep(timeout)
+            return mtime
+        return 123456
+
+
+class ClosedConnectionStub(object):
+
+    def __init__(self, writes_before_closing):
+        self.data = []
+        self.writes_before_closing = writes_before_closing
+
+    def write(self, data):
+        if len(self.data) >= self.writes_before_closing:
+            raise BrokenPipeError(32, 'Broken pipe')
+        self.data.append(data)
+
+    def flush(self):
+        pass
+
+
 class MyRequestHandlerForTests(MyRequestHandler):
     def __init__(self):
         self.headers = {'Host': 'localhost'}  # request headers
+        self.command = 'GET'
         self._headers = {}  # response headers
         self.log = []
         self.server = Mock()
         self.server.renderer.command = None
         self.server.renderer.watch = None
         self.server.renderer.allowed_hosts = ['localhost']
-        self.server.renderer.rest_to_html = lambda data, mtime=None, filename=None: \
+        self.server.renderer.watcher = FileWatcherStub()
+        self.server.renderer.parking = contextlib.nullcontext
+        self.server.renderer.render_cache = RenderCache(10**6)
+        self.server.renderer.rest_to_html = lambda data, mtime=None, filename=None, stat=None: \
             'HTML for %s with AJAX poller for %s' % (data, mtime)
+        self.server.renderer.get_validators = lambda data, mtime=None, filename=None, stat=None: \
+            ('"%s-%s"' % (len(data), mtime), mtime if stat is not None else None)
         self.server.renderer.render_exception = lambda title, error, source, mtime=None: \
             'HTML for error %s: %s: %s' % (title, error, source)
 
@@ -68,13 +163,6 @@ class MyRequestHandlerForTests(MyRequestHandler):
 
 class TestMyRequestHandler(unittest.TestCase):
 
-    def _os_walk(self, dirpath):
-        dirnames = ['.svn', '.tox', 'subdir', 'mypackage.egg-info']
-        filenames = ['a.txt', 'z.rst', 'unrelated.py']
-        yield dirpath, dirnames, filenames
-        for subdir in dirnames:
-            yield os.path.join(dirpath, subdir), [], ['b.txt', 'c.py']
-
     def _raise_oserror(self, *args, **kw):
         raise OSError(errno.ENOENT, "no such file or directory")
 
@@ -91,6 +179,77 @@ class TestMyRequestHandler(unittest.TestCase):
     def filepath2(self, *names):
         return os.path.join(self.root2, *names)
 
+    def handle_connection(self, requests, has_backlog=False):
+        with socket.create_server(('localhost', 0)) as listener:
+            client = socket.create_connection(listener.getsockname())
+            self.addCleanup(client.close)
+            server, _ = listener.accept()
+        if requests is not None:
+            client.sendall(requests.encode())
+            client.shutdown(socket.SHUT_WR)
+        renderer = Mock(allowed_hosts=['localhost'])
+        renderer.get_stats.return_value = {}
+        http_server = Mock(renderer=renderer)
+        http_server.has_backlog.return_value = has_backlog
+        with server, patch.object(MyRequestHandler, 'log_message'):
+            MyRequestHandler(server, ('localhost', 12345), http_server)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def test_keep_alive(self):
+        request = 'GET /_api/stats HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        response = self.handle_connection(request * 3)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 3)
+        self.assertEqual(response.count(b'Content-Length: 2\r\n'), 3)
+        self.assertNotIn(b'Connection: close', response)
+
+    def test_keep_alive_connection_close(self):
+        request = 'GET /_api/stats HTTP/1.1\r\nHost: localhost\r\n'
+        response = self.handle_connection(
+            request + 'Connection: close\r\n\r\n' + request + '\r\n')
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 1)
+
+    def test_keep_alive_max_requests(self):
+        request = 'GET /_api/stats HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        with patch.object(MyRequestHandler, 'max_requests_per_connection', 2):
+            response = self.handle_connection(request * 3)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 2)
+        self.assertEqual(response.count(b'Connection: close\r\n'), 1)
+        self.assertTrue(response.endswith(b'Connection: close\r\n\r\n{}'))
+
+    def test_keep_alive_timeout(self):
+        with patch.object(MyRequestHandler, 'timeout', 0.01), \
+                patch.object(MyRequestHandler, 'handle_one_request') as hor:
+            response = self.handle_connection(None)
+        self.assertEqual(response, b'')
+        self.assertEqual(hor.call_count, 0)
+
+    def test_keep_alive_idle_backlog(self):
+        # Idle connections give up their thread to connections waiting for
+        # one, without waiting for the timeout
+        with patch.object(MyRequestHandler, 'handle_one_request') as hor:
+            start = time.monotonic()
+            response = self.handle_connection(None, has_backlog=True)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(response, b'')
+        self.assertEqual(hor.call_count, 0)
+
+    def test_keep_alive_connection_reset(self):
+        with patch.object(MyRequestHandler, 'handle_one_request',
+                          side_effect=ConnectionResetError):
+            response = self.handle_connection('')
+        self.assertEqual(response, b'')
+
+    def test_keep_alive_backlog(self):
+        request = 'GET /_api/stats HTTP/1.1\r\nHost: localhost\r\n\r\n'
+        response = self.handle_connection(request * 2, has_backlog=True)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 1)
+        self.assertIn(b'Connection: close\r\n', response)
+
     def test_do_GET(self):
         handler = MyRequestHandlerForTests()
         handler.path = '/a.txt'
@@ -186,6 +345,29 @@ class TestMyRequestHandler(unittest.TestCase):
         expected_fn = self.filepath('a.txt')
         self.assertEqual(body, 'Got update for %s,my.css since 12345' % expected_fn)
 
+    def test_do_GET_or_HEAD_events(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/events?pathname=/a.txt&mtime=12345'
+        handler.server.renderer.root = self.root
+        handler.handle_events = lambda fns, mt, pathname=None: \
+            'Events for %s since %s, body for %s' % (','.join(fns), mt, pathname)
+        with patch('os.path.isdir', lambda dir: dir == self.root):
+            body = handler.do_GET_or_HEAD()
+        expected_fn = self.filepath('a.txt')
+        self.assertEqual(body, 'Events for %s since 12345, body for None'
+                         % expected_fn)
+
+    def test_do_GET_or_HEAD_events_with_body(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/events?pathname=/&body=1'
+        handler.server.renderer.root = self.filepath('a.txt')
+        handler.handle_events = lambda fns, mt, pathname=None: \
+            'Events for %s since %s, body for %s' % (','.join(fns), mt, pathname)
+        body = handler.do_GET_or_HEAD()
+        expected_fn = self.filepath('a.txt')
+        self.assertEqual(body, 'Events for %s since None, body for /'
+                         % expected_fn)
+
     def test_do_GET_or_HEAD_prevent_sandbox_climbing_attacks(self):
         handler = MyRequestHandlerForTests()
         handler.path = '/polling?pathname=../../../etc/passwd&mtime=12345'
@@ -214,7 +396,18 @@ class TestMyRequestHandler(unittest.TestCase):
             handler.path = '/' + filename
             handler.server.renderer.root = self.filepath('a.txt')
             handler.server.renderer.favicon_path = self.filepath('favicon.ico')
-            handler.handle_image = lambda fn, ct: '%s (%s)' % (fn, ct)
+            handler.handle_file = lambda fn, ct: '%s (%s)' % (fn, ct)
+            body = handler.do_GET_or_HEAD()
+            self.assertEqual(body, '%s (%s)' % (self.filepath(filename), ctype))
+
+    def test_do_GET_or_HEAD_static_files(self):
+        for filename, ctype in [('a.pdf', 'application/pdf'),
+                                ('a.css', 'text/css'),
+                                ('a.mp4', 'video/mp4')]:
+            handler = MyRequestHandlerForTests()
+            handler.path = '/' + filename
+            handler.server.renderer.root = self.filepath('a.txt')
+            handler.handle_file = lambda fn, ct: '%s (%s)' % (fn, ct)
             body = handler.do_GET_or_HEAD()
             self.assertEqual(body, '%s (%s)' % (self.filepath(filename), ctype))
 
@@ -227,6 +420,63 @@ class TestMyRequestHandler(unittest.TestCase):
             body = handler.do_GET_or_HEAD()
             self.assertEqual(body, 'HTML for %s' % self.filepath(filename))
 
+    def test_do_GET_or_HEAD_stats(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/_api/stats'
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.handle_stats = lambda: 'Stats'
+        body = handler.do_GET_or_HEAD()
+        self.assertEqual(body, 'Stats')
+
+    def test_do_GET_or_HEAD_static(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/_static/0123abcd.css'
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.handle_static = lambda name: 'Static %s' % name
+        body = handler.do_GET_or_HEAD()
+        self.assertEqual(body, 'Static 0123abcd.css')
+
+    def test_do_GET_or_HEAD_search(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/search?q=hello+world'
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.handle_search = lambda query: 'Results for %s' % query
+        body = handler.do_GET_or_HEAD()
+        self.assertEqual(body, 'Results for hello world')
+
+    def test_do_GET_or_HEAD_search_no_query(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/search'
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.handle_search = lambda query: 'Results for %r' % query
+        body = handler.do_GET_or_HEAD()
+        self.assertEqual(body, "Results for ''")
+
+    def test_do_GET_or_HEAD_api_list(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/_api/list?dir=0/sub%20dir&offset=10&limit=5'
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.handle_api_list = lambda dir, offset, limit: \
+            'List %s from %d, %d' % (dir, offset, limit)
+        body = handler.do_GET_or_HEAD()
+        self.assertEqual(body, 'List 0/sub dir from 10, 5')
+
+    def test_do_GET_or_HEAD_api_list_defaults(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/_api/list?dir='
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.handle_api_list = lambda dir, offset, limit: \
+            'List %r from %d, %d' % (dir, offset, limit)
+        body = handler.do_GET_or_HEAD()
+        self.assertEqual(body, "List '' from 0, 200")
+
+    def test_do_GET_or_HEAD_api_list_bad_request(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/_api/list?dir=&offset=lots'
+        handler.server.renderer.root = self.filepath('file.txt')
+        handler.do_GET_or_HEAD()
+        self.assertEqual(handler.status, 400)
+
     def test_do_GET_or_HEAD_other_files(self):
         handler = MyRequestHandlerForTests()
         handler.path = '/a.py'
@@ -237,41 +487,191 @@ class TestMyRequestHandler(unittest.TestCase):
 
     def test_handle_polling(self):
         handler = MyRequestHandlerForTests()
-        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
-        with patch('time.sleep') as sleep:
-            stat = {filename: [Mock(st_mtime=123455), Mock(st_mtime=123456)]}
-            with patch('os.stat', lambda fn: stat[fn].pop(0)):
-                handler.handle_polling([filename], 123455)
-            sleep.assert_called_once_with(0.2)
+        handler.handle_polling(['a.txt', 'b.css'], '123455')
+        watcher = handler.server.renderer.watcher
+        self.assertEqual(watcher.subscribed, [['a.txt', 'b.css']])
+        self.assertEqual(watcher.waited, [(['a.txt', 'b.css'], '123455')])
         self.assertEqual(handler.status, 200)
         self.assertEqual(handler.headers['Cache-Control'],
                          "no-cache, no-store, max-age=0")
+        self.assertEqual(handler.headers['Content-Length'], "0")
+        self.assertEqual(handler.server.stop_waiting.call_count, 1)
+
+    def test_handle_polling_busy(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.start_waiting.return_value = False
+        handler.server.retry_after = 5
+        handler.handle_polling(['a.txt'], '123455')
+        self.assertEqual(handler.status, 503)
+        self.assertEqual(handler.headers['Retry-After'], '5')
+        self.assertEqual(handler.headers['Content-Length'], '0')
+        self.assertEqual(handler.server.renderer.watcher.waited, [])
+        self.assertEqual(handler.server.stop_waiting.call_count, 0)
+
+    def test_handle_polling_timeout(self):
+        handler = MyRequestHandlerForTests()
+        handler.polling_timeout = 0.03
+        handler.disconnect_check_interval = 0.01
+        handler.server.renderer.watcher = FileWatcherStub([None] * 100)
+        handler.client_disconnected = Mock(return_value=False)
+        handler.handle_polling(['a.txt'], '123455')
+        self.assertEqual(handler.status, 204)
+        self.assertNotIn('Content-Length', handler.headers)
+        waited = len(handler.server.renderer.watcher.waited)
+        self.assertGreater(waited, 1)
+        self.assertLess(waited, 100)
+
+    def test_handle_polling_client_goes_away(self):
+        handler = MyRequestHandlerForTests()
+        handler.disconnect_check_interval = 0.01
+        handler.server.renderer.watcher = FileWatcherStub([None] * 2)
+        handler.client_disconnected = Mock(side_effect=[False, True])
+        handler.handle_polling(['a.txt'], '123455')
+        self.assertFalse(hasattr(handler, 'status'))
+        self.assertTrue(handler.close_connection)
+        self.assertEqual(len(handler.server.renderer.watcher.waited), 2)
+
+    def test_client_disconnected(self):
+        handler = MyRequestHandlerForTests()
+        handler.connection, client = socket.socketpair()
+        self.addCleanup(handler.connection.close)
+        self.assertFalse(handler.client_disconnected())
+        client.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        self.assertFalse(handler.client_disconnected())
+        client.close()
+        handler.connection.recv(1024)
+        self.assertTrue(handler.client_disconnected())
+        handler.connection.close()
+        self.assertTrue(handler.client_disconnected())
+
+    def test_get_latest_mtime(self):
+        handler = MyRequestHandlerForTests()
+        stat = {'a.txt': Mock(st_mtime=123455), 'b.txt': Mock(st_mtime=123456)}
+        with patch('os.stat', lambda fn: stat[fn]):
+            self.assertEqual(handler.get_latest_mtime(['a.txt', 'b.txt']),
+                             123456)
+        with patch('os.stat', self._raise_oserror):
+            self.assertIsNone(handler.get_latest_mtime(['a.txt', 'b.txt']))
 
     def test_handle_polling_handles_interruptions(self):
         handler = MyRequestHandlerForTests()
         handler.path = '/polling?pathname=__init__.py&mtime=123455'
         handler.send_response = self._raise_socket_error
-        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
-        stat = {filename: [Mock(st_mtime=123456)]}
-        with patch('os.stat', lambda fn: stat[fn].pop(0)):
-            handler.handle_polling([filename], 123455)
+        handler.handle_polling(['__init__.py'], '123455')
         self.assertEqual(
             handler.log,
             ['connection reset by peer'
              ' (client closed "%s" before acknowledgement)' % handler.path])
+        self.assertTrue(handler.close_connection)
 
-    def test_handle_polling_handles_disappearing_files(self):
+    def test_handle_events(self):
         handler = MyRequestHandlerForTests()
-        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
-        with patch('time.sleep'):
-            stat = {filename: [lambda: Mock(st_mtime=123455),
-                               self._raise_oserror,
-                               lambda: Mock(st_mtime=123456)]}
-            with patch('os.stat', lambda fn: stat[fn].pop(0)()):
-                handler.handle_polling([filename], 123455)
+        handler.command = 'GET'
+        handler.keepalive_interval = 0
+        handler.server.renderer.watcher = FileWatcherStub([None, 123456])
+        handler.wfile = ClosedConnectionStub(writes_before_closing=2)
+        handler.handle_events(['a.txt'], '123455')
         self.assertEqual(handler.status, 200)
-        self.assertEqual(handler.headers['Cache-Control'],
-                         "no-cache, no-store, max-age=0")
+        self.assertEqual(handler.headers['Content-Type'], "text/event-stream")
+        self.assertEqual(handler.headers['Connection'], "close")
+        self.assertEqual(handler.wfile.data, [
+            b': keepalive\n\n',
+            b'id: 123456\nevent: changed\ndata: \n\n',
+        ])
+        self.assertEqual(handler.server.renderer.watcher.waited, [
+            (['a.txt'], '123455'),
+            (['a.txt'], '123455'),
+            (['a.txt'], 123456),
+        ])
+
+    def test_handle_events_with_body(self):
+        handler = MyRequestHandlerForTests()
+        handler.command = 'GET'
+        handler.render_page = lambda pathname: '<p>\n%s\n</p>' % pathname
+        handler.wfile = ClosedConnectionStub(writes_before_closing=1)
+        handler.handle_events(['a.txt'], '123455', '/a.txt')
+        self.assertEqual(handler.wfile.data, [
+            b'id: 123456\nevent: changed\n'
+            b'data: <p>\ndata: /a.txt\ndata: </p>\n\n',
+        ])
+
+    def test_handle_events_resume(self):
+        handler = MyRequestHandlerForTests()
+        handler.command = 'GET'
+        handler.headers['Last-Event-ID'] = '123457'
+        handler.wfile = ClosedConnectionStub(writes_before_closing=0)
+        handler.handle_events(['a.txt'], '123455')
+        self.assertEqual(handler.server.renderer.watcher.waited, [
+            (['a.txt'], '123457'),
+        ])
+
+    def test_handle_events_busy(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.start_waiting.return_value = False
+        handler.server.retry_after = 5
+        handler.handle_events(['a.txt'], '123455')
+        self.assertEqual(handler.status, 503)
+        self.assertEqual(handler.headers['Retry-After'], '5')
+        self.assertEqual(handler.server.stop_waiting.call_count, 0)
+
+    def test_handle_events_HEAD(self):
+        handler = MyRequestHandlerForTests()
+        handler.command = 'HEAD'
+        handler.handle_events(['a.txt'], '123455')
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.server.renderer.watcher.waited, [])
+
+    def test_render_page_file(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.root = self.root
+        with patch('os.path.isdir', lambda dir: dir == self.root):
+            with patch.object(MyRequestHandlerForTests, 'read_rest_file',
+                              return_value=('Hello', 1234, None)):
+                self.assertEqual(handler.render_page('/a.txt'),
+                                 'HTML for Hello with AJAX poller for 1234')
+                self.assertIsNone(handler.render_page('/a.py'))
+                self.assertIsNone(handler.render_page('/'))
+
+    def test_render_page_root_file(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.root = self.filepath('a.txt')
+        with patch.object(MyRequestHandlerForTests, 'read_rest_file',
+                          return_value=('Hello', 1234, None)):
+            self.assertEqual(handler.render_page('/'),
+                             'HTML for Hello with AJAX poller for 1234')
+
+    def test_render_page_missing_file(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.root = 'nosuchfile.txt'
+        self.assertIsNone(handler.render_page('/'))
+        self.assertEqual(handler.log,
+                         ["[Errno 2] No such file or directory: 'nosuchfile.txt'"])
+
+    def test_render_page_render_failure(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.root = self.filepath('a.txt')
+        handler.server.renderer.rest_to_html = Mock(
+            side_effect=RenderFailure('HTML for RenderTimeout'))
+        with patch.object(MyRequestHandlerForTests, 'read_rest_file',
+                          return_value=('Hello', 1234, None)):
+            self.assertEqual(handler.render_page('/'),
+                             'HTML for RenderTimeout')
+
+    def test_render_page_command(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.command = 'cat README.rst'
+        with patch('subprocess.Popen', PopenStub('data from cat README.rst')):
+            html = handler.render_page('/')
+        self.assertEqual(html, 'HTML for data from cat README.rst'
+                               ' with AJAX poller for None')
+
+    def test_render_page_command_failure(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.command = 'cat README.rst'
+        with patch('subprocess.Popen', PopenStub('', '', 1)):
+            html = handler.render_page('/')
+        self.assertEqual(html, 'HTML for error cat README.rst:'
+                               " Process returned error code 1.: b'(no output)'")
 
     def test_translate_path_when_root_is_a_file(self):
         handler = MyRequestHandlerForTests()
@@ -300,21 +700,190 @@ class TestMyRequestHandler(unittest.TestCase):
             self.assertEqual(handler.translate_path('/1/b.txt'),
                              self.filepath2('b.txt'))
 
-    def test_handle_image(self):
+    def make_file_handler(self):
         handler = MyRequestHandlerForTests()
-        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
-        body = handler.handle_image(filename, 'image/python') # ha ha
+        handler.connection, client = socket.socketpair()
+        self.addCleanup(handler.connection.close)
+        self.addCleanup(client.close)
+        return handler, client
+
+    def read_response_body(self, handler, client):
+        handler.connection.close()
+        chunks = []
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def test_handle_file(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        body = handler.handle_file(filename, 'text/css')
+        self.assertIsNone(body)
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Type'], "text/css")
+        self.assertEqual(handler.headers['Content-Length'], str(len(data)))
+        self.assertEqual(handler.headers['Accept-Ranges'], "bytes")
+        self.assertEqual(handler.headers['Vary'], "Accept-Encoding")
+        self.assertEqual(self.read_response_body(handler, client), data)
+
+    def test_handle_file_head(self):
+        handler, client = self.make_file_handler()
+        handler.command = 'HEAD'
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        handler.handle_file(filename, 'text/css')
         self.assertEqual(handler.status, 200)
-        self.assertEqual(handler.headers['Content-Type'],
-                         "image/python")
         self.assertEqual(handler.headers['Content-Length'],
-                         str(len(body)))
-        self.assertTrue(isinstance(body, bytes))
+                         str(os.stat(filename).st_size))
+        self.assertEqual(self.read_response_body(handler, client), b'')
+
+    def test_handle_file_empty(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
+        handler.handle_file(filename, 'image/python')  # ha ha
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Length'], '0')
+        self.assertNotIn('Vary', handler.headers)
+        self.assertEqual(self.read_response_body(handler, client), b'')
 
-    def test_handle_image_error(self):
+    def test_handle_file_validators(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
+        st = os.stat(filename)
+        handler.handle_file(filename, 'image/python')
+        self.assertEqual(handler.headers['ETag'],
+                         '"%x-%x"' % (st.st_mtime_ns, st.st_size))
+        self.assertEqual(handler.headers['Last-Modified'],
+                         handler.date_time_string(st.st_mtime))
+        self.assertEqual(handler.headers['Cache-Control'], "no-cache")
+
+    def test_handle_file_not_modified(self):
+        handler = MyRequestHandlerForTests()
+        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
+        st = os.stat(filename)
+        etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        handler.headers['If-None-Match'] = etag
+        body = handler.handle_file(filename, 'image/python')
+        self.assertIsNone(body)
+        self.assertEqual(handler.status, 304)
+        self.assertEqual(handler.headers['ETag'], etag)
+
+    def test_handle_file_range(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        handler.headers['Range'] = 'bytes=10-19'
+        handler.handle_file(filename, 'text/css')
+        self.assertEqual(handler.status, 206)
+        self.assertEqual(handler.headers['Content-Length'], '10')
+        self.assertEqual(handler.headers['Content-Range'],
+                         'bytes 10-19/%d' % len(data))
+        self.assertEqual(self.read_response_body(handler, client), data[10:20])
+
+    def test_handle_file_range_is_not_gzipped(self):
+        handler, client = self.make_file_handler()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        handler.headers['Range'] = 'bytes=-10'
+        handler.handle_file(filename, 'text/css')
+        self.assertEqual(handler.status, 206)
+        self.assertNotIn('Content-Encoding', handler.headers)
+        self.assertEqual(self.read_response_body(handler, client), data[-10:])
+
+    def test_handle_file_range_not_satisfiable(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        size = os.stat(filename).st_size
+        handler.headers['Range'] = 'bytes=%d-' % size
+        handler.handle_file(filename, 'text/css')
+        self.assertEqual(handler.status, 416)
+        self.assertEqual(handler.headers['Content-Range'], 'bytes */%d' % size)
+        self.assertEqual(self.read_response_body(handler, client), b'')
+
+    def test_handle_file_if_range(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        st = os.stat(filename)
+        handler.headers['Range'] = 'bytes=10-19'
+        handler.headers['If-Range'] = handler.date_time_string(st.st_mtime)
+        handler.handle_file(filename, 'text/css')
+        self.assertEqual(handler.status, 206)
+
+    def test_handle_file_if_range_changed(self):
+        handler, client = self.make_file_handler()
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        handler.headers['Range'] = 'bytes=10-19'
+        handler.headers['If-Range'] = '"old-etag"'
+        handler.handle_file(filename, 'text/css')
+        self.assertEqual(handler.status, 200)
+        self.assertNotIn('Content-Range', handler.headers)
+
+    def test_handle_file_svg_gzipped(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        body = handler.handle_file(filename, 'image/svg+xml')
+        self.assertEqual(gzip.decompress(body), data)
+        self.assertEqual(handler.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(handler.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(handler.headers['ETag'].startswith('W/"'))
+        handler.headers['If-None-Match'] = handler.headers['ETag']
+        handler.handle_file(filename, 'image/svg+xml')
+        self.assertEqual(handler.status, 304)
+        self.assertEqual(handler.headers['Vary'], 'Accept-Encoding')
+
+    def test_handle_file_svg_gzipped_head(self):
+        handler = MyRequestHandlerForTests()
+        handler.command = 'HEAD'
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        with patch('gzip.compress') as compress:
+            handler.handle_file(filename, 'image/svg+xml')
+        self.assertEqual(compress.call_count, 0)
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', handler.headers)
+
+    def test_handle_file_svg_gzipped_is_cached(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        body = handler.handle_file(filename, 'image/svg+xml')
+        for command in ['GET', 'HEAD']:
+            handler.headers = {'Accept-Encoding': 'gzip'}
+            handler.command = command
+            with patch('gzip.compress') as compress:
+                self.assertIs(handler.handle_file(filename, 'image/svg+xml'),
+                              body)
+            self.assertEqual(compress.call_count, 0)
+            self.assertEqual(handler.headers['Content-Length'],
+                             str(len(body)))
+
+    def test_handle_file_png_not_gzipped(self):
+        handler, client = self.make_file_handler()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        filename = os.path.join(os.path.dirname(__file__), 'restview.css')
+        handler.handle_file(filename, 'image/png')
+        self.assertNotIn('Content-Encoding', handler.headers)
+        self.assertNotIn('Vary', handler.headers)
+
+    def test_handle_file_error(self):
         handler = MyRequestHandlerForTests()
         handler.path = '/nosuchfile.png'
-        handler.handle_image('nosuchfile.png', 'image/png')
+        handler.handle_file('nosuchfile.png', 'image/png')
         self.assertEqual(handler.status, 404)
         self.assertEqual(handler.error_body,
                          "File not found: /nosuchfile.png")
@@ -330,7 +899,7 @@ class TestMyRequestHandler(unittest.TestCase):
         self.assertEqual(handler.headers['Content-Length'],
                          str(len(body)))
         self.assertEqual(handler.headers['Cache-Control'],
-                         "no-cache, no-store, max-age=0")
+                         "no-cache")
         self.assertTrue(body.startswith(b'HTML for'))
         self.assertTrue(body.endswith(('with AJAX poller for %s' % mtime).encode()))
 
@@ -369,7 +938,7 @@ class TestMyRequestHandler(unittest.TestCase):
         self.assertEqual(handler.headers['Content-Length'],
                          str(len(body)))
         self.assertEqual(handler.headers['Cache-Control'],
-                         "no-cache, no-store, max-age=0")
+                         "no-cache")
         self.assertEqual(body,
                          b'HTML for data from cat README.rst'
                          b' with AJAX poller for None')
@@ -399,7 +968,7 @@ class TestMyRequestHandler(unittest.TestCase):
         self.assertEqual(handler.headers['Content-Length'],
                          str(len(body)))
         self.assertEqual(handler.headers['Cache-Control'],
-                         "no-cache, no-store, max-age=0")
+                         "no-cache")
         self.assertFalse('X-Restview-Mtime' in handler.headers)
         self.assertTrue(b'hello' in body, body)
         self.assertTrue(b'blah blah' not in body, body)
@@ -436,25 +1005,406 @@ class TestMyRequestHandler(unittest.TestCase):
                          "text/html; charset=UTF-8")
         self.assertEqual(handler.headers['Content-Length'],
                          str(len(body)))
+        self.assertEqual(handler.headers['Cache-Control'],
+                         "no-cache")
+        self.assertEqual(body,
+                         b'HTML for *Hello* with AJAX poller for 1364808683')
+
+    def test_handle_rest_data_render_failure(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.rest_to_html = Mock(
+            side_effect=RenderFailure('HTML for RenderTimeout'))
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(body, b'HTML for RenderTimeout')
         self.assertEqual(handler.headers['Cache-Control'],
                          "no-cache, no-store, max-age=0")
+        self.assertEqual(handler.headers['X-Restview-Mtime'], '1364808683')
+        self.assertNotIn('ETag', handler.headers)
+
+    def test_handle_rest_data_validators(self):
+        handler = MyRequestHandlerForTests()
+        handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertEqual(handler.headers['ETag'], '"7-1364808683"')
+        # The output of a command can change even if mtime stays the same
+        self.assertNotIn('Last-Modified', handler.headers)
+
+    def test_handle_rest_data_validators_unknown(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-None-Match'] = '"7-1364808683"'
+        handler.server.renderer.get_validators = Mock(
+            side_effect=[(None, None), ('"7-1364808683"', None)])
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        # The browser's copy might be out of date: it's not in the render
+        # cache, so we don't know which files the document includes
+        self.assertEqual(handler.status, 200)
+        self.assertTrue(body.startswith(b'HTML for'))
+        self.assertEqual(handler.headers['ETag'], '"7-1364808683"')
+
+    def test_handle_rest_data_cache_disabled(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        handler.server.renderer.get_validators = Mock(
+            return_value=(None, None))
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(gzip.decompress(body),
+                         b'HTML for *Hello* with AJAX poller for 1364808683')
+        self.assertNotIn('ETag', handler.headers)
+        self.assertNotIn('Last-Modified', handler.headers)
+        self.assertEqual(len(handler.server.renderer.render_cache), 0)
+
+    def test_handle_rest_data_not_modified(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-None-Match'] = '"1-2", "7-1364808683"'
+        handler.server.renderer.rest_to_html = Mock()
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertIsNone(body)
+        self.assertEqual(handler.status, 304)
+        self.assertEqual(handler.headers['ETag'], '"7-1364808683"')
+        self.assertEqual(handler.headers['X-Restview-Mtime'], '1364808683')
+        self.assertEqual(handler.server.renderer.rest_to_html.call_count, 0)
+
+    def test_handle_rest_data_modified(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-None-Match'] = '"7-1364800000"'
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertEqual(handler.status, 200)
+        self.assertTrue(body.startswith(b'HTML for'))
+
+    def test_handle_rest_file_last_modified(self):
+        handler = MyRequestHandlerForTests()
+        filename = os.path.join(os.path.dirname(__file__), '__init__.py')
+        mtime = os.stat(filename).st_mtime
+        handler.handle_rest_file(filename)
+        last_modified = handler.date_time_string(mtime)
+        self.assertEqual(handler.headers['Last-Modified'], last_modified)
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-Modified-Since'] = last_modified
+        body = handler.handle_rest_file(filename)
+        self.assertIsNone(body)
+        self.assertEqual(handler.status, 304)
+
+    def test_handle_rest_file_included_file_changed(self):
+        tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        filename = os.path.join(tempdir, 'main.rst')
+        with open(filename, 'w') as f:
+            f.write('.. include:: inc.rst\n')
+        with open(os.path.join(tempdir, 'inc.rst'), 'w') as f:
+            f.write('first version\n')
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer = RestViewer(tempdir)
+        handler.handle_rest_file(filename)
+        etag = handler.headers['ETag']
+        with open(os.path.join(tempdir, 'inc.rst'), 'w') as f:
+            f.write('second version\n')
+        renderer = handler.server.renderer
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer = renderer
+        handler.headers['If-None-Match'] = etag
+        body = handler.handle_rest_file(filename)
+        self.assertEqual(handler.status, 200)
+        self.assertIn(b'second version', body)
+        self.assertNotEqual(handler.headers['ETag'], etag)
+
+    def test_handle_rest_data_gzipped(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip, deflate'
+        handler.gzip_min_size = 10
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertEqual(gzip.decompress(body),
+                         b'HTML for *Hello* with AJAX poller for 1364808683')
+        self.assertEqual(handler.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(handler.headers['Content-Length'], str(len(body)))
+        self.assertEqual(handler.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(handler.headers['ETag'], 'W/"7-1364808683"')
+
+    def test_handle_rest_data_gzipped_is_cached(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
+        handler.headers = {'Accept-Encoding': 'gzip'}
+        with patch('gzip.compress') as compress:
+            self.assertIs(handler.handle_rest_data("*Hello*", mtime=1364808683),
+                          body)
+        self.assertEqual(compress.call_count, 0)
+
+    def test_handle_rest_data_too_small_to_gzip(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        body = handler.handle_rest_data("*Hello*", mtime=1364808683)
         self.assertEqual(body,
                          b'HTML for *Hello* with AJAX poller for 1364808683')
+        self.assertNotIn('Content-Encoding', handler.headers)
+        self.assertEqual(handler.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(handler.headers['ETag'], '"7-1364808683"')
+
+    def test_handle_rest_data_not_modified_vary(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-None-Match'] = 'W/"7-1364808683"'
+        handler.handle_rest_data("*Hello*", mtime=1364808683)
+        self.assertEqual(handler.status, 304)
+        self.assertEqual(handler.headers['Vary'], 'Accept-Encoding')
+
+    def test_accepts_gzip(self):
+        handler = MyRequestHandlerForTests()
+        self.assertFalse(handler.accepts_gzip())
+        for value, expected in [
+            ('gzip', True),
+            ('deflate, GZIP', True),
+            ('gzip;q=0.5', True),
+            ('x-gzip', True),
+            ('gzip; q=0', False),
+            ('gzip;q=nonsense', False),
+            ('identity', False),
+            ('br', False),
+        ]:
+            handler.headers['Accept-Encoding'] = value
+            self.assertEqual(handler.accepts_gzip(), expected, value)
+
+    def test_send_json_gzipped(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['Accept-Encoding'] = 'gzip'
+        handler.gzip_min_size = 10
+        body = handler.send_json({'hello': 'world'})
+        self.assertEqual(json.loads(gzip.decompress(body)), {'hello': 'world'})
+        self.assertEqual(handler.headers['Content-Encoding'], 'gzip')
+
+    def test_is_not_modified(self):
+        handler = MyRequestHandlerForTests()
+        self.assertFalse(handler.is_not_modified('"abc"', 1364808683))
+        handler.headers['If-None-Match'] = '"abc"'
+        self.assertTrue(handler.is_not_modified('"abc"', 1364808683))
+        handler.headers['If-None-Match'] = 'W/"abc"'
+        self.assertTrue(handler.is_not_modified('"abc"', 1364808683))
+        handler.headers['If-None-Match'] = '*'
+        self.assertTrue(handler.is_not_modified('"abc"', 1364808683))
+
+    def test_is_not_modified_etag_takes_precedence(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-None-Match'] = '"xyz"'
+        handler.headers['If-Modified-Since'] = 'Mon, 01 Apr 2013 09:31:23 GMT'
+        self.assertFalse(handler.is_not_modified('"abc"', 1364808683))
+
+    def test_is_not_modified_since(self):
+        handler = MyRequestHandlerForTests()
+        handler.headers['If-Modified-Since'] = 'Mon, 01 Apr 2013 09:31:23 GMT'
+        self.assertTrue(handler.is_not_modified('"abc"', 1364808683.5))
+        self.assertFalse(handler.is_not_modified('"abc"', 1364808684))
+        self.assertFalse(handler.is_not_modified('"abc"'))
+        handler.headers['If-Modified-Since'] = 'Mon, 01 Apr 2013 09:31:23 -0000'
+        self.assertTrue(handler.is_not_modified('"abc"', 1364808683))
+        handler.headers['If-Modified-Since'] = 'yesterday'
+        self.assertFalse(handler.is_not_modified('"abc"', 1364808683))
+
+    def test_handle_stats(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.get_stats = lambda: {'render_cache': {'hits': 1}}
+        body = handler.handle_stats()
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Type'], "application/json")
+        self.assertEqual(handler.headers['Content-Length'], str(len(body)))
+        self.assertEqual(json.loads(body), {'render_cache': {'hits': 1}})
+
+    def test_handle_static(self):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.get_static_file.return_value = b'p {}'
+        body = handler.handle_static('0123abcd.css')
+        handler.server.renderer.get_static_file.assert_called_with(
+            '0123abcd.css')
+        self.assertEqual(body, b'p {}')
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Type'],
+                         "text/css; charset=UTF-8")
+        self.assertEqual(handler.headers['Content-Length'], '4')
+        self.assertIn('immutable', handler.headers['Cache-Control'])
+
+    def test_handle_static_not_found(self):
+        handler = MyRequestHandlerForTests()
+        handler.path = '/_static/0123abcd.css'
+        handler.server.renderer.get_static_file.return_value = None
+        body = handler.handle_static('0123abcd.css')
+        self.assertIsNone(body)
+        self.assertEqual(handler.status, 404)
 
     def test_collect_files(self):
         handler = MyRequestHandlerForTests()
-        with patch('os.walk', self._os_walk):
-            files = handler.collect_files('/path/to/dir')
-        self.assertEqual(files,
-                         ['a.txt', os.path.join('subdir', 'b.txt'), 'z.rst'])
+        index = handler.server.renderer.get_directory_index.return_value
+        index.list_files.return_value = ['a.txt', 'z.rst']
+        files = handler.collect_files('/path/to/dir')
+        handler.server.renderer.get_directory_index.assert_called_with('/path/to/dir')
+        self.assertEqual(files, ['a.txt', 'z.rst'])
+
+    def make_tree(self):
+        tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        for dirname in ['empty', 'subdir', os.path.join('subdir', 'more')]:
+            os.mkdir(os.path.join(tempdir, dirname))
+        for filename in ['a.txt', 'b.rst', 'c d.rst',
+                         os.path.join('subdir', 'more', 'e.rst')]:
+            with open(os.path.join(tempdir, filename), 'w'):
+                pass
+        return tempdir
+
+    def make_handler_for_tree(self, root):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.root = root
+        handler.server.renderer.get_directory_index = \
+            RestViewer(root).get_directory_index
+        return handler
+
+    def test_list_directory(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        self.assertEqual(handler.list_directory(root), {
+            'dir': '',
+            'offset': 0,
+            'total': 4,
+            'entries': [
+                {'name': 'subdir', 'dir': 'subdir'},
+                {'name': 'a.txt', 'href': 'a.txt'},
+                {'name': 'b.rst', 'href': 'b.rst'},
+                {'name': 'c d.rst', 'href': 'c%20d.rst'},
+            ],
+            'next': None,
+        })
+
+    def test_list_directory_subdir_with_prefix(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        self.assertEqual(handler.list_directory(root, '1/', 'subdir/more'), {
+            'dir': '1/subdir/more',
+            'offset': 0,
+            'total': 1,
+            'entries': [
+                {'name': 'e.rst', 'href': '1/subdir/more/e.rst'},
+            ],
+            'next': None,
+        })
+
+    def test_list_directory_pages(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        listing = handler.list_directory(root, limit=2)
+        self.assertEqual([e['name'] for e in listing['entries']],
+                         ['subdir', 'a.txt'])
+        self.assertEqual(listing['next'], 2)
+        listing = handler.list_directory(root, offset=2, limit=2)
+        self.assertEqual([e['name'] for e in listing['entries']],
+                         ['b.rst', 'c d.rst'])
+        self.assertIsNone(listing['next'])
+
+    def test_list_directory_not_found(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        self.assertIsNone(handler.list_directory(root, subdir='nosuchdir'))
+
+    def test_resolve_listing_dir(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        self.assertEqual(handler.resolve_listing_dir('subdir'),
+                         (root, '', 'subdir'))
+
+    def test_resolve_listing_dir_root_is_a_file(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(os.path.join(root, 'a.txt'))
+        self.assertIsNone(handler.resolve_listing_dir(''))
+
+    def test_resolve_listing_dir_list(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(
+            [os.path.join(root, 'a.txt'), os.path.join(root, 'subdir')])
+        self.assertEqual(handler.resolve_listing_dir('1/more'),
+                         (os.path.join(root, 'subdir'), '1/', 'more'))
+        self.assertEqual(handler.resolve_listing_dir('1'),
+                         (os.path.join(root, 'subdir'), '1/', ''))
+        self.assertIsNone(handler.resolve_listing_dir('0'))
+        self.assertIsNone(handler.resolve_listing_dir('2'))
+        self.assertIsNone(handler.resolve_listing_dir('-1'))
+        self.assertIsNone(handler.resolve_listing_dir(''))
+
+    def test_handle_api_list(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        body = handler.handle_api_list('', offset=-5, limit=0)
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Type'], "application/json")
+        listing = json.loads(body)
+        self.assertEqual(listing['offset'], 0)
+        self.assertEqual(listing['entries'],
+                         [{'name': 'subdir', 'dir': 'subdir'}])
+        self.assertEqual(listing['next'], 1)
+
+    def test_handle_api_list_default_limit(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        handler.listing_page_size = 3
+        listing = json.loads(handler.handle_api_list('subdir'))
+        self.assertEqual(listing['entries'],
+                         [{'name': 'more', 'dir': 'subdir/more'}])
+
+    def test_handle_api_list_not_found(self):
+        root = self.make_tree()
+        handler = self.make_handler_for_tree(root)
+        body = handler.handle_api_list('empty')
+        self.assertIsNone(body)
+        self.assertEqual(handler.status, 404)
+        self.assertEqual(handler.error_body, "Directory not found: empty")
+
+    def make_handler_for_search(self, *indexes):
+        handler = MyRequestHandlerForTests()
+        handler.server.renderer.search_indexes = [
+            ('', index) for index in indexes]
+        return handler
+
+    def test_handle_search(self):
+        root = self.make_tree()
+        with open(os.path.join(root, 'c d.rst'), 'w') as f:
+            f.write('Hello <world>!')
+        index = SearchIndex(DirectoryIndex(root), 10**6)
+        index.refresh()
+        handler = self.make_handler_for_search(index)
+        handler.server.renderer.search = lambda query: (
+            1, [('c%20d.rst', index, 'c d.rst')])
+        body = handler.handle_search('world')
+        self.assertEqual(handler.status, 200)
+        self.assertEqual(handler.headers['Content-Type'],
+                         "text/html; charset=UTF-8")
+        self.assertIn(b'<title>Search results for world</title>', body)
+        self.assertIn(b'<input type="search" name="q" value="world">', body)
+        self.assertIn(b'<p>1 document found.</p>', body)
+        self.assertIn(b'<li><a href="c%20d.rst">c d.rst</a><br>'
+                      b'Hello &lt; <mark>world</mark> &gt;!</li>', body)
+
+    def test_handle_search_status(self):
+        index = Mock(ready=False, skipped={'big.rst': (1, 2)})
+        handler = self.make_handler_for_search(index)
+        handler.server.renderer.search = lambda query: (0, [])
+        body = handler.handle_search('<hello>')
+        self.assertIn(b'<title>Search results for &lt;hello&gt;</title>', body)
+        self.assertIn(b'<p>0 documents found. Still indexing, results may be'
+                      b' incomplete. The search index is full, some documents'
+                      b' were not indexed.</p>', body)
+
+    def test_handle_search_not_available(self):
+        handler = self.make_handler_for_search()
+        handler.server.renderer.search = lambda query: (0, [])
+        body = handler.handle_search('hello')
+        self.assertIn(b'<p>Search is not available.</p>', body)
 
     def test_handle_dir(self):
         handler = MyRequestHandlerForTests()
-        handler.collect_files = lambda dir: ['a.txt', 'b/c.txt']
-        handler.render_dir_listing = lambda title, files: \
+        handler.list_directory = lambda dir: {
+            'dir': '', 'entries': [{'name': 'a.txt', 'href': 'a.txt'}],
+            'next': None}
+        handler.render_dir_listing = lambda title, listing: \
             "<title>%s</title>\n%s" % (
                 title,
-                '\n'.join('%s - %s' % (path, fn) for path, fn in files))
+                '\n'.join('%s - %s' % (e['href'], e['name'])
+                          for e in listing['entries']))
         body = handler.handle_dir('/path/to/dir')
         self.assertEqual(handler.status, 200)
         self.assertEqual(handler.headers['Content-Type'],
@@ -464,16 +1414,23 @@ class TestMyRequestHandler(unittest.TestCase):
         where = os.path.abspath('/path/to/dir').encode()
         self.assertEqual(body,
                          b"<title>RST files in " + where + b"</title>\n"
-                         b"a.txt - a.txt\n"
-                         b"b/c.txt - b/c.txt")
+                         b"a.txt - a.txt")
+
+    def test_handle_dir_does_not_exist(self):
+        handler = MyRequestHandlerForTests()
+        handler.list_directory = lambda dir: None
+        body = handler.handle_dir('/path/to/dir')
+        self.assertEqual(handler.status, 200)
+        self.assertIn(b'<ul>\n</ul>', body)
 
     def test_handle_list(self):
         handler = MyRequestHandlerForTests()
-        handler.collect_files = lambda dir: ['a.txt', os.path.join('b', 'c.txt')]
-        handler.render_dir_listing = lambda title, files: \
+        handler.render_dir_listing = lambda title, listing: \
             "<title>%s</title>\n%s" % (
                 title,
-                '\n'.join('%s - %s' % (path, fn) for path, fn in files))
+                '\n'.join('%s - %s' % (e.get('href') or 'dir ' + e['dir'],
+                                       e['name'])
+                          for e in listing['entries']))
         with patch('os.path.isdir', lambda fn: fn == 'subdir'):
             body = handler.handle_list([os.path.normpath('/path/to/file.txt'),
                                         'subdir'])
@@ -485,18 +1442,25 @@ class TestMyRequestHandler(unittest.TestCase):
         self.assertEqual(body,
                          b"<title>RST files</title>\n"
                          b"0/file.txt - #path#to#file.txt\n"
-                         b"1/a.txt - subdir#a.txt\n"
-                         b"1/b/c.txt - subdir#b#c.txt".replace(b"#", os.path.sep.encode()))
+                         b"dir 1 - subdir".replace(b"#", os.path.sep.encode()))
 
 
 def doctest_MyRequestHandler_render_dir_listing():
     """Test for MyRequestHandler.render_dir_listing
 
         >>> handler = MyRequestHandlerForTests()
-        >>> print(handler.render_dir_listing('Files in .', [
-        ...     ('1/README.rst', 'README.rst'),
-        ...     ('2/CHANGES.rst', 'CHANGES.rst'),
-        ... ]))
+        >>> html = handler.render_dir_listing('Files in .', {
+        ...     'dir': '1',
+        ...     'total': 5,
+        ...     'entries': [
+        ...         {'name': '/path/to/docs', 'dir': '0', 'open': True},
+        ...         {'name': 'src', 'dir': '1/src'},
+        ...         {'name': 'README.rst', 'href': '1/README.rst'},
+        ...         {'name': 'CHANGES.rst', 'href': '1/CHANGES.rst'},
+        ...     ],
+        ...     'next': 3,
+        ... })
+        >>> print(html[:html.index('<script')])
         <!DOCTYPE html>
         <html>
         <head>
@@ -504,12 +1468,14 @@ def doctest_MyRequestHandler_render_dir_listing():
         </head>
         <body>
         <h1>Files in .</h1>
+        <form action="/search"><input type="search" name="q" placeholder="Search"></form>
         <ul>
+          <li><details data-dir="0" open><summary>/path/to/docs/</summary><ul></ul></details></li>
+          <li><details data-dir="1/src"><summary>src/</summary><ul></ul></details></li>
           <li><a href="1/README.rst">README.rst</a></li>
-          <li><a href="2/CHANGES.rst">CHANGES.rst</a></li>
+          <li><a href="1/CHANGES.rst">CHANGES.rst</a></li>
+          <li><button data-dir="1" data-offset="3">2 more</button></li>
         </ul>
-        </body>
-        </html>
         <BLANKLINE>
 
     """
@@ -768,6 +1734,1471 @@ def doctest_RestViewer_inject_ajax_adds_ajax():
     """
 
 
+class TestInotifyLibc(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.object(Inotify, '_libc', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_load_libc_not_linux(self):
+        with patch('sys.platform', 'win32'), \
+                patch('ctypes.CDLL') as CDLL:
+            self.assertIsNone(Inotify.load_libc())
+            self.assertIsNone(Inotify.watching(['a.rst']))
+        self.assertEqual(CDLL.call_count, 0)
+
+    def test_load_libc_error(self):
+        with patch('sys.platform', 'linux'), \
+                patch('ctypes.CDLL', side_effect=TypeError):
+            self.assertIsNone(Inotify.load_libc())
+            # The failure is remembered
+            self.assertIsNone(Inotify.load_libc())
+
+    def test_load_libc_no_inotify(self):
+        with patch('sys.platform', 'linux'), \
+                patch('ctypes.CDLL', return_value=Mock(spec=[])):
+            self.assertIsNone(Inotify.load_libc())
+
+    def test_file_watcher_without_inotify(self):
+        watcher = FileWatcher()
+        with patch('sys.platform', 'win32'), patch('threading.Thread'):
+            watcher.start()
+        self.assertIsNone(watcher.inotify)
+        self.assertEqual(watcher.thread.start.call_count, 1)
+
+
+@unittest.skipIf(not sys.platform.startswith('linux'), "needs inotify")
+class TestInotify(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, 'a.rst')
+        with open(self.filename, 'w') as f:
+            f.write('Hello')
+
+    def test_wait(self):
+        inotify = Inotify.watching([self.filename])
+        self.addCleanup(inotify.close)
+        self.assertFalse(inotify.wait(0))
+        with open(self.filename, 'a') as f:
+            f.write(', world!')
+        self.assertTrue(inotify.wait(1))
+        self.assertFalse(inotify.wait(0))
+
+    def test_wait_atomic_rename(self):
+        inotify = Inotify.watching([self.filename])
+        self.addCleanup(inotify.close)
+        with open(self.filename + '.new', 'w') as f:
+            f.write('Goodbye')
+        inotify.wait(0)
+        os.rename(self.filename + '.new', self.filename)
+        self.assertTrue(inotify.wait(1))
+
+    def test_watching_nonexistent_directory(self):
+        filename = os.path.join(self.tempdir, 'no', 'such', 'file.rst')
+        self.assertIsNone(Inotify.watching([filename]))
+
+    def test_watching_too_many_instances(self):
+        libc = Mock()
+        libc.inotify_init1.return_value = -1
+        with patch.object(Inotify, 'load_libc', return_value=libc):
+            self.assertIsNone(Inotify.watching([self.filename]))
+
+
+class TestFileWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, 'a.rst')
+        with open(self.filename, 'w') as f:
+            f.write('Hello')
+        self.mtime = os.stat(self.filename).st_mtime
+
+    def touch(self, delay=0.1):
+        def touch():
+            time.sleep(delay)
+            os.utime(self.filename, (self.mtime + 1, self.mtime + 1))
+        thread = threading.Thread(target=touch)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def make_watcher(self, use_inotify=True):
+        watcher = FileWatcher()
+        watcher.use_inotify = use_inotify
+        watcher.poll_interval = 0.01
+        watcher.recheck_interval = 10
+        return watcher
+
+    @unittest.skipIf(not sys.platform.startswith('linux'), "needs inotify")
+    def test_wait_for_change_with_inotify(self):
+        watcher = self.make_watcher()
+        self.touch()
+        with watcher.watching([self.filename]):
+            mtime = watcher.wait_for_change([self.filename], str(self.mtime),
+                                            timeout=5)
+        self.assertEqual(mtime, self.mtime + 1)
+        self.assertTrue(watcher.stats()['inotify'])
+        self.assertLess(watcher.stats()['stat_calls'], 5)
+
+    def test_wait_for_change_without_inotify(self):
+        watcher = self.make_watcher(use_inotify=False)
+        self.touch()
+        with watcher.watching([self.filename]):
+            mtime = watcher.wait_for_change([self.filename], str(self.mtime),
+                                            timeout=5)
+        self.assertEqual(mtime, self.mtime + 1)
+        self.assertFalse(watcher.stats()['inotify'])
+
+    def test_wait_for_change_no_timeout(self):
+        watcher = self.make_watcher(use_inotify=False)
+        self.touch()
+        with watcher.watching([self.filename]):
+            mtime = watcher.wait_for_change([self.filename], str(self.mtime))
+        self.assertEqual(mtime, self.mtime + 1)
+
+    def test_wait_for_change_directory_does_not_exist(self):
+        watcher = self.make_watcher()
+        filename = os.path.join(self.tempdir, 'subdir', 'a.rst')
+
+        def create():
+            time.sleep(0.1)
+            os.mkdir(os.path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write('Hello')
+
+        thread = threading.Thread(target=create)
+        thread.start()
+        self.addCleanup(thread.join)
+        with watcher.watching([filename]):
+            mtime = watcher.wait_for_change([filename], 'None', timeout=5)
+        self.assertIsNotNone(mtime)
+
+    def test_wait_for_change_already_changed(self):
+        watcher = self.make_watcher()
+        with watcher.watching([self.filename]):
+            mtime = watcher.wait_for_change([self.filename], '12345')
+        self.assertEqual(mtime, self.mtime)
+
+    def test_wait_for_change_timeout(self):
+        watcher = self.make_watcher()
+        with watcher.watching([self.filename]):
+            mtime = watcher.wait_for_change([self.filename], str(self.mtime),
+                                            timeout=0.05)
+        self.assertIsNone(mtime)
+
+    def test_wait_for_change_ignores_missing_files(self):
+        watcher = self.make_watcher()
+        filename = os.path.join(self.tempdir, 'b.rst')
+        with watcher.watching([filename]):
+            mtime = watcher.wait_for_change([filename], '12345', timeout=0.05)
+        self.assertIsNone(mtime)
+
+    def test_subscribers_share_files(self):
+        watcher = self.make_watcher()
+        watcher.start = Mock()
+        watcher.inotify = Mock()
+        other = os.path.join(self.tempdir, 'b.rst')
+        watcher.subscribe([self.filename])
+        watcher.subscribe([self.filename, other])
+        self.assertEqual(watcher.stats(), {
+            'files': 2,
+            'directories': 1,
+            'subscribers': 3,
+            'inotify': True,
+            'stat_calls': 2,
+        })
+        self.assertEqual(watcher.inotify.add_watch.call_count, 1)
+        watcher.unsubscribe([self.filename])
+        watcher.unsubscribe([self.filename, other])
+        self.assertEqual(watcher.stats()['files'], 0)
+        self.assertEqual(watcher.stats()['directories'], 0)
+        self.assertEqual(watcher.inotify.rm_watch.call_count, 1)
+
+    def test_refresh(self):
+        watcher = self.make_watcher()
+        watcher.start = Mock()
+        watcher.subscribe([self.filename])
+        watcher.refresh()
+        self.assertEqual(watcher.mtimes, {self.filename: self.mtime})
+        os.utime(self.filename, (self.mtime + 1, self.mtime + 1))
+        watcher.refresh()
+        self.assertEqual(watcher.mtimes, {self.filename: self.mtime + 1})
+
+    def test_listeners(self):
+        watcher = self.make_watcher()
+        watcher.start = Mock()
+        listener = Mock()
+        watcher.add_listener(listener)
+        watcher.subscribe([self.filename])
+        watcher.refresh()
+        self.assertEqual(listener.call_count, 0)
+        os.utime(self.filename, (self.mtime + 1, self.mtime + 1))
+        watcher.refresh()
+        self.assertEqual(listener.call_count, 1)
+        watcher.remove_listener(listener)
+        os.utime(self.filename, (self.mtime + 2, self.mtime + 2))
+        watcher.refresh()
+        self.assertEqual(listener.call_count, 1)
+
+
+class TestThreadingHTTPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('localhost', 0), Mock())
+        self.addCleanup(self.server.server_close)
+        self.server.max_workers = 1
+        self.server.max_queued = 1
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.handled = []
+        self.server.finish_request = self.finish_request
+
+    def finish_request(self, request, client_address):
+        self.handled.append(client_address)
+        self.release.wait(5)
+
+    def connect(self, client_address):
+        server_side, client = socket.socketpair()
+        self.addCleanup(client.close)
+        self.server.process_request(server_side, client_address)
+        return client
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_pool(self):
+        clients = [self.connect(n) for n in range(2)]
+        self.wait_until(lambda: self.handled == [0])
+        self.assertEqual(self.server.workers, 1)
+        self.assertTrue(self.server.has_backlog())
+        self.release.set()
+        for client in clients:
+            # The server closes the connection when it's done
+            self.assertEqual(client.recv(1024), b'')
+        self.assertEqual(self.handled, [0, 1])
+        self.assertFalse(self.server.has_backlog())
+        self.wait_until(lambda: self.server.idle_workers == 1)
+        self.assertEqual(self.server.workers, 1)
+        self.connect(2).recv(1024)
+        self.assertEqual(self.handled, [0, 1, 2])
+        self.assertEqual(self.server.workers, 1)
+
+    def test_busy(self):
+        self.connect(0)
+        self.wait_until(lambda: self.handled == [0])
+        self.connect(1)
+        client = self.connect(2)
+        response = client.recv(1024)
+        self.assertTrue(response.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\n'))
+        self.assertEqual(client.recv(1024), b'')
+        self.assertEqual(self.handled, [0])
+
+    def test_busy_request_already_sent(self):
+        self.server.max_queued = 0
+        self.connect(0)
+        self.wait_until(lambda: self.handled == [0])
+        server_side, client = socket.socketpair()
+        self.addCleanup(client.close)
+        client.sendall(b'GET / HTTP/1.1\r\n\r\n')
+        self.server.process_request(server_side, 1)
+        self.assertIn(b' 503 ', client.recv(1024))
+
+    def test_busy_client_gone(self):
+        self.server.max_queued = 0
+        self.connect(0)
+        self.wait_until(lambda: self.handled == [0])
+        server_side, client = socket.socketpair()
+        client.close()
+        self.server.process_request(server_side, 1)
+        self.assertEqual(self.handled, [0])
+        self.assertEqual(server_side.fileno(), -1)
+
+    def test_waiting(self):
+        def finish_request(request, client_address):
+            if self.server.start_waiting():
+                self.handled.append(client_address)
+                self.release.wait(5)
+                self.server.stop_waiting()
+            else:
+                self.handled.append('busy')
+        self.server.finish_request = finish_request
+        self.server.max_waiting = 1
+        self.connect(0)
+        self.wait_until(lambda: self.handled == [0])
+        self.assertEqual(self.server.waiting, 1)
+        # The waiting thread doesn't count as a worker
+        self.assertEqual(self.server.workers, 0)
+        self.connect(1).recv(1024)
+        self.assertEqual(self.handled, [0, 'busy'])
+        self.assertEqual(self.server.workers, 1)
+        self.release.set()
+        # The thread that was waiting goes away when it's done
+        self.wait_until(lambda: self.server.waiting == 0
+                        and self.server.workers == 1
+                        and self.server.idle_workers == 1)
+
+    def test_error(self):
+        self.server.finish_request = Mock(side_effect=ValueError)
+        self.server.handle_error = Mock()
+        client = self.connect(0)
+        self.assertEqual(client.recv(1024), b'')
+        self.assertEqual(self.server.handle_error.call_count, 1)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_reuse_port(self):
+        address = ('localhost', 0)
+        server1 = ThreadingHTTPServer(address, Mock(), reuse_port=True)
+        self.addCleanup(server1.server_close)
+        address = server1.socket.getsockname()
+        server2 = ThreadingHTTPServer(address, Mock(), reuse_port=True)
+        self.addCleanup(server2.server_close)
+        self.assertEqual(server2.socket.getsockname(), address)
+
+    def test_address_in_use(self):
+        address = self.server.socket.getsockname()
+        with self.assertRaises(OSError) as cm:
+            ThreadingHTTPServer(address, Mock())
+        self.assertEqual(cm.exception.errno, errno.EADDRINUSE)
+
+    def test_idle_keep_alive_connections(self):
+        tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        viewer = RestViewer(tempdir)
+        viewer.search_index_size = 0
+        viewer.request_threads = 2
+        port = viewer.listen()
+        thread = threading.Thread(target=viewer.serve)
+        thread.start()
+        self.addCleanup(viewer.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(viewer.server.shutdown)
+        clients = []
+        with patch.object(MyRequestHandler, 'log_message'):
+            for n in range(3):
+                client = http.client.HTTPConnection('localhost', port,
+                                                    timeout=5)
+                self.addCleanup(client.close)
+                start = time.monotonic()
+                client.request('GET', '/_api/stats')
+                response = client.getresponse()
+                response.read()
+                self.assertEqual(response.status, 200)
+                clients.append(client)
+        # Two idle connections kept open by the browser don't keep the
+        # third one waiting for the keep-alive timeout
+        self.assertLess(time.monotonic() - start, MyRequestHandler.timeout / 3)
+
+    def test_server_close(self):
+        self.connect(0)
+        client = self.connect(1)
+        self.wait_until(lambda: self.handled == [0])
+        self.server.server_close()
+        self.assertEqual(client.recv(1024), b'')
+        self.release.set()
+        self.wait_until(lambda: self.server.workers == 0)
+        self.assertEqual(self.handled, [0])
+
+
+class TestAsyncHTTPServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, 'a.rst')
+        with open(self.filename, 'w') as f:
+            f.write('Hello\n=====\n')
+        self.mtime = os.stat(self.filename).st_mtime
+        self.viewer = RestViewer(self.tempdir)
+        self.viewer.server_class = AsyncHTTPServer
+        self.viewer.search_index_size = 0
+        self.viewer.watcher.poll_interval = 0.01
+        self.port = self.viewer.listen()
+        thread = threading.Thread(target=self.viewer.serve)
+        thread.start()
+        self.addCleanup(self.viewer.close)
+        self.addCleanup(thread.join)
+        self.addCleanup(self.viewer.server.shutdown)
+        # Let the server get the event loop going
+        while self.viewer.server.stopped is None:
+            time.sleep(0.01)
+        patcher = patch.object(MyRequestHandler, 'log_message')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, request):
+        client = socket.create_connection(('localhost', self.port))
+        self.addCleanup(client.close)
+        client.sendall(request.encode())
+        return client
+
+    def read_response(self, client):
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def wait_until(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def touch(self):
+        os.utime(self.filename, (self.mtime + 1, self.mtime + 1))
+
+    def test_get(self):
+        client = self.connect('GET /a.rst HTTP/1.0\r\nHost: localhost\r\n\r\n')
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'<title>Hello</title>', response)
+
+    def test_get_file(self):
+        with open(os.path.join(self.tempdir, 'a.png'), 'wb') as f:
+            f.write(b'PNG' * 1000)
+        client = self.connect('GET /a.png HTTP/1.0\r\nHost: localhost\r\n\r\n')
+        response = self.read_response(client)
+        self.assertTrue(response.endswith(b'\r\n\r\n' + b'PNG' * 1000))
+
+    def test_empty_request(self):
+        client = self.connect('')
+        client.shutdown(socket.SHUT_WR)
+        self.assertEqual(self.read_response(client), b'')
+
+    def test_oversized_request(self):
+        self.viewer.server.max_request_size = 100
+        client = self.connect('GET /a.rst HTTP/1.0\r\nX-Junk: %s' % ('x' * 200))
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 '))
+
+    def test_polling(self):
+        client = self.connect(
+            'HEAD /polling?pathname=/a.rst&mtime=%s HTTP/1.0\r\n'
+            'Host: localhost\r\n\r\n' % self.mtime)
+        self.wait_until(lambda: self.viewer.parked_requests['polling'] == 1)
+        self.touch()
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertEqual(self.viewer.parked_requests['polling'], 0)
+
+    def test_polling_timeout(self):
+        with patch.object(MyRequestHandler, 'polling_timeout', 0.1):
+            client = self.connect(
+                'HEAD /polling?pathname=/a.rst&mtime=%s HTTP/1.0\r\n'
+                'Host: localhost\r\n\r\n' % self.mtime)
+            response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 204 No Content\r\n'))
+
+    def test_polling_client_goes_away(self):
+        client = self.connect(
+            'HEAD /polling?pathname=/a.rst&mtime=%s HTTP/1.0\r\n'
+            'Host: localhost\r\n\r\n' % self.mtime)
+        self.wait_until(lambda: self.viewer.parked_requests['polling'] == 1)
+        client.close()
+        self.wait_until(lambda: self.viewer.parked_requests['polling'] == 0)
+
+    def test_polling_bad_request(self):
+        # The server may report the error as soon as the request is sent
+        with patch('sys.stderr', StringIO()) as stderr, \
+                patch('traceback.print_exc'):
+            client = self.connect('GET /polling?mtime=1 HTTP/1.0\r\n'
+                                  'Host: localhost\r\n\r\n')
+            self.assertEqual(self.read_response(client), b'')
+        self.assertIn('Exception occurred during processing of request',
+                      stderr.getvalue())
+
+    def test_polling_rejects_unknown_host(self):
+        with patch.object(MyRequestHandler, 'log_error'):
+            client = self.connect(
+                'GET /polling?pathname=/a.rst&mtime=1 HTTP/1.0\r\n'
+                'Host: example.com\r\n\r\n')
+            response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 400 '))
+
+    def test_events(self):
+        client = self.connect(
+            'GET /events?pathname=/a.rst&mtime=%s&body=1 HTTP/1.0\r\n'
+            'Host: localhost\r\n\r\n' % self.mtime)
+        headers = b''
+        while b'\r\n\r\n' not in headers:
+            headers += client.recv(65536)
+        self.assertIn(b'Content-Type: text/event-stream', headers)
+        self.touch()
+        event = headers.partition(b'\r\n\r\n')[-1]
+        while b'</html>' not in event:
+            event += client.recv(65536)
+        self.assertIn(b'event: changed\n', event)
+        self.assertIn(b'data: <title>Hello</title>', event)
+        client.close()
+        self.wait_until(lambda: self.viewer.parked_requests['events'] == 0)
+
+    def test_events_without_body(self):
+        with patch.object(MyRequestHandler, 'keepalive_interval', 0.05):
+            client = self.connect(
+                'GET /events?pathname=/a.rst&mtime=%s HTTP/1.0\r\n'
+                'Host: localhost\r\n\r\n' % self.mtime)
+            data = b''
+            while b': keepalive' not in data:
+                data += client.recv(65536)
+            self.touch()
+            while b'event: changed' not in data:
+                data += client.recv(65536)
+        self.assertIn(b'data: \n\n', data)
+
+    def test_events_head(self):
+        client = self.connect('HEAD /events?pathname=/a.rst HTTP/1.0\r\n'
+                              'Host: localhost\r\n\r\n')
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(response.endswith(b'\r\n\r\n'))
+
+    def test_waits_for_changes(self):
+        server = self.viewer.server
+        self.assertTrue(server.waits_for_changes(
+            b'GET /polling?pathname=/ HTTP/1.0\r\n\r\n'))
+        self.assertTrue(server.waits_for_changes(
+            b'GET /events%3Fpathname=/ HTTP/1.0\r\n\r\n'))
+        self.assertFalse(server.waits_for_changes(
+            b'GET /a.rst HTTP/1.0\r\n\r\n'))
+        self.assertFalse(server.waits_for_changes(b'nonsense\r\n\r\n'))
+
+    def test_address_in_use(self):
+        address = ('localhost', self.port)
+        with self.assertRaises(OSError):
+            AsyncHTTPServer(address, MyRequestHandler)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_reuse_port(self):
+        server1 = AsyncHTTPServer(('localhost', 0), MyRequestHandler,
+                                  reuse_port=True)
+        self.addCleanup(server1.server_close)
+        address = server1.socket.getsockname()
+        server2 = AsyncHTTPServer(address, MyRequestHandler, reuse_port=True)
+        self.addCleanup(server2.server_close)
+        self.assertEqual(server2.socket.getsockname(), address)
+
+    def test_keep_alive(self):
+        request = 'GET /a.rst HTTP/1.1\r\nHost: localhost\r\n'
+        client = self.connect(request + '\r\n'
+                              + request + 'Connection: close\r\n\r\n')
+        response = self.read_response(client)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 2)
+
+    def test_keep_alive_polling(self):
+        client = self.connect(
+            'GET /polling?pathname=/a.rst&mtime=%s HTTP/1.1\r\n'
+            'Host: localhost\r\n\r\n' % self.mtime)
+        self.wait_until(lambda: self.viewer.parked_requests['polling'] == 1)
+        # Whatever the browser sends while the request waits is kept
+        client.sendall(b'GET /a.rst HTTP/1.1\r\nHost: localhost\r\n'
+                       b'Connection: close\r\n\r\n')
+        self.touch()
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK\r\n'))
+        self.assertIn(b'Content-Length: 0\r\n', response)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 2)
+        self.assertIn(b'<title>Hello</title>', response)
+
+    def test_keep_alive_timeout(self):
+        with patch.object(MyRequestHandler, 'timeout', 0.1):
+            client = self.connect('GET /a.rst HTTP/1.1\r\n'
+                                  'Host: localhost\r\n\r\n')
+            response = self.read_response(client)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 1)
+        self.assertNotIn(b'Connection: close', response)
+
+    def test_keep_alive_max_requests(self):
+        with patch.object(MyRequestHandler, 'max_requests_per_connection', 1):
+            client = self.connect('GET /a.rst HTTP/1.1\r\n'
+                                  'Host: localhost\r\n\r\n')
+            response = self.read_response(client)
+        self.assertEqual(response.count(b'HTTP/1.1 200 OK\r\n'), 1)
+        self.assertIn(b'Connection: close\r\n', response)
+
+    def test_busy(self):
+        self.viewer.server.max_workers = self.viewer.server.max_queued = 0
+        client = self.connect('GET /a.rst HTTP/1.1\r\n'
+                              'Host: localhost\r\n\r\n')
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 5\r\n'))
+
+    def test_has_backlog(self):
+        server = self.viewer.server
+        self.assertFalse(server.has_backlog())
+        server.busy = server.max_workers + 1
+        self.assertTrue(server.has_backlog())
+        server.busy = 0
+
+    def test_polling_busy(self):
+        self.viewer.server.max_waiting = 0
+        client = self.connect(
+            'GET /polling?pathname=/a.rst&mtime=%s HTTP/1.1\r\n'
+            'Host: localhost\r\nConnection: close\r\n\r\n' % self.mtime)
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\n'))
+        self.assertIn(b'Retry-After: 5\r\n', response)
+
+    def test_events_busy(self):
+        self.viewer.server.max_waiting = 0
+        client = self.connect(
+            'GET /events?pathname=/a.rst HTTP/1.1\r\n'
+            'Host: localhost\r\nConnection: close\r\n\r\n')
+        response = self.read_response(client)
+        self.assertTrue(response.startswith(
+            b'HTTP/1.1 503 Service Unavailable\r\n'))
+
+    def test_connection_reset(self):
+        server = self.viewer.server
+        with patch.object(server, 'read_request',
+                          AsyncMock(side_effect=ConnectionResetError)):
+            client = self.connect('GET /a.rst HTTP/1.0\r\n\r\n')
+            self.assertEqual(self.read_response(client), b'')
+
+    def test_close_connection_not_connected(self):
+        sock = socket.socket()
+        AsyncHTTPServer.close_connection(sock)
+        self.assertEqual(sock.fileno(), -1)
+
+
+class TestAsyncConnection(unittest.TestCase):
+
+    def test_wait_closed(self):
+        loop = Mock(sock_recv=AsyncMock(side_effect=[b'junk', b'']))
+        connection = AsyncConnection(Mock(), b'', loop)
+        asyncio.run(connection.wait_closed())
+        self.assertEqual(loop.sock_recv.call_count, 2)
+
+    def test_wait_closed_error(self):
+        loop = Mock(sock_recv=AsyncMock(side_effect=ConnectionResetError))
+        connection = AsyncConnection(Mock(), b'', loop)
+        asyncio.run(connection.wait_closed())
+        self.assertEqual(loop.sock_recv.call_count, 1)
+
+
+class TestWSGIApplication(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, 'a b.rst')
+        with open(self.filename, 'w') as f:
+            f.write('Hello\n=====\n')
+        self.mtime = os.stat(self.filename).st_mtime
+        self.app = make_wsgi_app(self.tempdir, search_index_size=0)
+        self.addCleanup(self.app.renderer.close)
+
+    def request(self, path, query='', method='GET', **headers):
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'HTTP_HOST': 'localhost',
+            'wsgi.errors': StringIO(),
+            'wsgi.multithread': True,
+        }
+        environ.update(headers)
+        response = {}
+
+        def start_response(status, headers):
+            response['status'] = status
+            response['headers'] = dict(headers)
+
+        self.body = self.app(environ, start_response)
+        self.errors = environ['wsgi.errors']
+        return response['status'], response['headers']
+
+    def read_body(self, chunks=None):
+        try:
+            return b''.join(itertools.islice(self.body, chunks))
+        finally:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+
+    def test_get(self):
+        status, headers = self.request('/a b.rst')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/html; charset=UTF-8')
+        self.assertIn(b'<title>Hello</title>', self.read_body())
+        self.assertTrue(self.app.started)
+
+    def test_head(self):
+        status, headers = self.request('/a b.rst', method='HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(headers['Content-Length'], '0')
+        self.assertEqual(self.read_body(), b'')
+
+    def test_not_modified(self):
+        status, headers = self.request('/a b.rst')
+        status, headers = self.request('/a b.rst',
+                                       HTTP_IF_NONE_MATCH=headers['ETag'])
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(self.read_body(), b'')
+
+    def test_dir_listing(self):
+        status, headers = self.request('/')
+        self.assertEqual(status, '200 OK')
+        self.assertIn(b'<a href="a%20b.rst">a b.rst</a>', self.read_body())
+
+    def test_api_list(self):
+        status, headers = self.request('/_api/list', 'dir=&limit=1')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(self.read_body())['entries'],
+                         [{'name': 'a b.rst', 'href': 'a%20b.rst'}])
+
+    def test_file(self):
+        with open(os.path.join(self.tempdir, 'a.png'), 'wb') as f:
+            f.write(b'PNG' * 100000)
+        status, headers = self.request('/a.png')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Length'], '300000')
+        self.assertEqual(self.read_body(), b'PNG' * 100000)
+
+    def test_file_range(self):
+        with open(os.path.join(self.tempdir, 'a.png'), 'wb') as f:
+            f.write(b'0123456789')
+        status, headers = self.request('/a.png', HTTP_RANGE='bytes=2-5')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertEqual(headers['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(self.read_body(), b'2345')
+
+    def test_file_truncated(self):
+        with open(os.path.join(self.tempdir, 'a.png'), 'wb') as f:
+            f.write(b'0123456789')
+        status, headers = self.request('/a.png')
+        os.truncate(os.path.join(self.tempdir, 'a.png'), 5)
+        self.assertEqual(self.read_body(), b'01234')
+
+    def test_not_found(self):
+        status, headers = self.request('/b.rst')
+        self.assertEqual(status, '404 Not Found')
+        self.assertIn(b'File not found: /b.rst', self.read_body())
+        self.assertIn('No such file or directory', self.errors.getvalue())
+
+    def test_unknown_host(self):
+        status, headers = self.request('/', HTTP_HOST='evil.example.com')
+        self.assertEqual(status, '400 Bad Request')
+        self.assertNotIn('Connection', headers)
+        self.assertEqual(
+            self.errors.getvalue().splitlines()[0],
+            "Rejecting unknown Host header: 'evil.example.com'")
+
+    def test_unsupported_method(self):
+        status, headers = self.request('/', method='POST')
+        self.assertEqual(status, '501 Not Implemented')
+
+    def test_polling(self):
+        status, headers = self.request('/polling',
+                                       'pathname=/a%20b.rst&mtime=123',
+                                       method='HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.read_body(), b'')
+        self.assertEqual(self.app.waiting, 0)
+
+    def test_polling_timeout(self):
+        self.app.RequestHandlerClass.polling_timeout = 0.05
+        self.app.RequestHandlerClass.disconnect_check_interval = 0.01
+        status, headers = self.request('/polling',
+                                       'pathname=/a%20b.rst&mtime='
+                                       + str(self.mtime), method='HEAD')
+        self.assertEqual(status, '204 No Content')
+
+    def test_polling_busy(self):
+        self.app.max_waiting = 0
+        status, headers = self.request('/polling',
+                                       'pathname=/a%20b.rst&mtime=123',
+                                       method='HEAD')
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertEqual(headers['Retry-After'], '5')
+
+    def test_events(self):
+        status, headers = self.request('/events',
+                                       'pathname=/a%20b.rst&mtime=123&body=1')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['Content-Type'], 'text/event-stream')
+        self.assertNotIn('Connection', headers)
+        self.assertEqual(self.app.waiting, 1)
+        event = self.read_body(chunks=1)
+        self.assertTrue(event.startswith(b'id: %s\nevent: changed\n'
+                                         % str(self.mtime).encode()))
+        self.assertIn(b'data: <title>Hello</title>\n', event)
+        self.assertEqual(self.app.waiting, 0)
+        self.assertEqual(self.app.renderer.parked_requests['events'], 0)
+
+    def test_events_head(self):
+        status, headers = self.request('/events', 'pathname=/a%20b.rst',
+                                       method='HEAD')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(self.read_body(), b'')
+        self.assertEqual(self.app.waiting, 0)
+
+    def test_events_busy(self):
+        self.app.max_waiting = 0
+        status, headers = self.request('/events', 'pathname=/a%20b.rst')
+        self.assertEqual(status, '503 Service Unavailable')
+
+    def test_max_waiting(self):
+        self.request('/a b.rst')
+        self.assertEqual(self.app.max_waiting, 2)
+
+    def test_max_waiting_single_threaded(self):
+        status, headers = self.request('/polling',
+                                       'pathname=/a%20b.rst&mtime=123',
+                                       method='HEAD',
+                                       **{'wsgi.multithread': False})
+        self.assertEqual(status, '503 Service Unavailable')
+        self.assertEqual(self.app.max_waiting, 0)
+
+    def test_start(self):
+        self.app.renderer.start_services = Mock()
+        self.request('/a b.rst')
+        self.request('/a b.rst')
+        self.assertEqual(self.app.renderer.start_services.call_count, 1)
+
+    def test_make_wsgi_app(self):
+        app = make_wsgi_app(['a.rst', 'b.rst'], allowed_hosts=['*'],
+                            cache_size=1000, max_waiting_requests=5)
+        self.assertEqual(app.renderer.root, ['a.rst', 'b.rst'])
+        self.assertEqual(app.renderer.allowed_hosts, ['*'])
+        self.assertEqual(app.renderer.render_cache.max_size, 1000)
+        self.assertEqual(app.max_waiting, 5)
+        self.assertFalse(app.started)
+        app = make_wsgi_app('a.rst')
+        self.assertIsNone(app.max_waiting)
+
+    def test_make_wsgi_app_unknown_option(self):
+        for name in ['no_such_option', 'root', 'listen', '_render_contexts']:
+            with self.assertRaises(TypeError):
+                make_wsgi_app('.', **{name: 42})
+
+    def test_wsgi_module(self):
+        import restview.wsgi
+        self.assertIs(restview.wsgi.make_app, make_wsgi_app)
+
+
+class TestDirectoryIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        for dirname in ['.svn', '.tox', 'subdir', 'mypackage.egg-info']:
+            os.mkdir(os.path.join(self.tempdir, dirname))
+            self.create(dirname, 'b.txt')
+            self.create(dirname, 'c.py')
+        self.create('a.txt')
+        self.create('Z.rst')
+        self.create('unrelated.py')
+        self.backdate()
+
+    def create(self, *names):
+        with open(os.path.join(self.tempdir, *names), 'w'):
+            pass
+
+    def backdate(self, when=1000000000):
+        # Make the directory mtimes old enough to be trusted
+        for dirpath, dirnames, filenames in os.walk(self.tempdir):
+            os.utime(dirpath, (when, when))
+
+    def test_list_files(self):
+        index = DirectoryIndex(self.tempdir)
+        self.assertEqual(index.list_files(),
+                         ['a.txt', os.path.join('subdir', 'b.txt'), 'Z.rst'])
+        self.assertEqual(index.stats(),
+                         {'directories': 2, 'files': 3, 'scans': 2})
+
+    @unittest.skipIf(sys.platform == 'win32', "symlinks need privileges")
+    def test_list_files_symlink_loop(self):
+        os.symlink('..', os.path.join(self.tempdir, 'subdir', 'loop'))
+        os.symlink('..', os.path.join(self.tempdir, 'subdir', 'loop.rst'))
+        os.symlink('b.txt', os.path.join(self.tempdir, 'subdir', 'd.txt'))
+        self.backdate()
+        index = DirectoryIndex(self.tempdir)
+        self.assertEqual(index.list_files(),
+                         ['a.txt', os.path.join('subdir', 'b.txt'),
+                          os.path.join('subdir', 'd.txt'), 'Z.rst'])
+
+    def test_list_files_unchanged(self):
+        index = DirectoryIndex(self.tempdir)
+        files = index.list_files()
+        files.append('modifying the returned list is harmless')
+        self.assertEqual(index.list_files(),
+                         ['a.txt', os.path.join('subdir', 'b.txt'), 'Z.rst'])
+        self.assertEqual(index.scans, 2)
+
+    def test_list_files_rescans_changed_directories_only(self):
+        index = DirectoryIndex(self.tempdir)
+        index.list_files()
+        self.create('subdir', 'd.rst')
+        os.mkdir(os.path.join(self.tempdir, 'subdir', 'more'))
+        self.create('subdir', 'more', 'e.rst')
+        os.utime(os.path.join(self.tempdir, 'subdir'), (1000000001, 1000000001))
+        os.utime(os.path.join(self.tempdir, 'subdir', 'more'), (1000000001, 1000000001))
+        self.assertEqual(index.list_files(),
+                         ['a.txt', os.path.join('subdir', 'b.txt'),
+                          os.path.join('subdir', 'd.rst'),
+                          os.path.join('subdir', 'more', 'e.rst'), 'Z.rst'])
+        self.assertEqual(index.scans, 4)
+
+    def test_list_files_directory_removed(self):
+        index = DirectoryIndex(self.tempdir)
+        index.list_files()
+        shutil.rmtree(os.path.join(self.tempdir, 'subdir'))
+        self.backdate(1000000001)
+        self.assertEqual(index.list_files(), ['a.txt', 'Z.rst'])
+        self.assertEqual(index.stats()['directories'], 1)
+
+    def test_list_files_root_does_not_exist(self):
+        index = DirectoryIndex(os.path.join(self.tempdir, 'nosuchdir'))
+        self.assertEqual(index.list_files(), [])
+        self.assertEqual(index.scans, 0)
+
+    def test_list_files_recent_changes_are_rechecked(self):
+        index = DirectoryIndex(self.tempdir)
+        index.list_files()
+        self.create('new.rst')
+        self.assertIn('new.rst', index.list_files())
+        # The directory mtime is too recent to be trusted, so the
+        # directory gets listed again next time
+        self.assertIsNone(index.dirs[''][0])
+        self.assertIn('new.rst', index.list_files())
+        self.assertEqual(index.scans, 4)
+
+    def test_list_dir(self):
+        os.mkdir(os.path.join(self.tempdir, 'empty'))
+        os.mkdir(os.path.join(self.tempdir, 'subdir', 'deeper'))
+        os.mkdir(os.path.join(self.tempdir, 'subdir', 'deeper', 'est'))
+        self.create('subdir', 'deeper', 'est', 'X.rst')
+        self.backdate()
+        index = DirectoryIndex(self.tempdir)
+        self.assertEqual(index.list_dir(), (['subdir'], ['a.txt', 'Z.rst']))
+        self.assertEqual(index.list_dir('subdir'), (['deeper'], ['b.txt']))
+        self.assertEqual(index.list_dir(os.path.join('subdir', 'deeper')),
+                         (['est'], []))
+
+    def test_list_dir_not_found(self):
+        os.mkdir(os.path.join(self.tempdir, 'empty'))
+        index = DirectoryIndex(self.tempdir)
+        self.assertIsNone(index.list_dir('nosuchdir'))
+        self.assertIsNone(index.list_dir('.svn'))
+        self.assertIsNone(index.list_dir('empty'))
+
+    def test_list_dir_root(self):
+        index = DirectoryIndex(os.path.join(self.tempdir, 'subdir', 'c.py'))
+        self.assertIsNone(index.list_dir())
+        index = DirectoryIndex(os.path.join(self.tempdir, '.svn'))
+        self.assertEqual(index.list_dir(), ([], ['b.txt']))
+
+    def test_scan_directory_disappeared(self):
+        index = DirectoryIndex(self.tempdir)
+        self.assertEqual(index.scan('nosuchdir', 1000000000),
+                         (None, (), ()))
+
+    def test_scan_unreadable_entry(self):
+        index = DirectoryIndex(self.tempdir)
+        entry = Mock()
+        entry.name = 'broken'
+        entry.is_dir.side_effect = OSError(errno.EACCES, "permission denied")
+        scandir = MagicMock()
+        scandir.return_value.__enter__.return_value = [entry]
+        with patch('os.scandir', scandir):
+            self.assertEqual(index.scan('', 1000000000),
+                             (1000000000, (), ()))
+
+
+class TestSearchIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        os.mkdir(os.path.join(self.tempdir, 'subdir'))
+        self.write('a.rst', 'Hello world.  Hello again!')
+        self.write('b.txt', 'Hello there')
+        self.write(os.path.join('subdir', 'c.rst'), 'Goodbye, cruel world')
+
+    def write(self, filename, text):
+        with open(os.path.join(self.tempdir, filename), 'w') as f:
+            f.write(text)
+
+    def make_index(self, max_size=10**6):
+        return SearchIndex(DirectoryIndex(self.tempdir), max_size)
+
+    def test_search(self):
+        index = self.make_index()
+        index.refresh()
+        self.assertTrue(index.ready)
+        self.assertEqual(index.search('hello'),
+                         (2, [(2 * math.log(2.5), 'a.rst'),
+                              (math.log(2.5), 'b.txt')]))
+        self.assertEqual(index.search('WORLD  hello'),
+                         (1, [(2 * math.log(2.5) + math.log(2.5), 'a.rst')]))
+        self.assertEqual(index.search('hello nonsense'), (0, []))
+        self.assertEqual(index.search('?!'), (0, []))
+
+    def test_search_limit(self):
+        index = self.make_index()
+        index.refresh()
+        self.assertEqual(index.search('hello', limit=1),
+                         (2, [(2 * math.log(2.5), 'a.rst')]))
+
+    def test_refresh_changes(self):
+        index = self.make_index()
+        index.refresh()
+        size = index.size
+        self.write('b.txt', 'Goodbye there')
+        os.unlink(os.path.join(self.tempdir, 'a.rst'))
+        index.refresh()
+        self.assertEqual(index.search('hello'), (0, []))
+        self.assertEqual(index.search('goodbye')[0], 2)
+        self.assertNotIn('again', index.postings)
+        self.assertLess(index.size, size)
+        os.unlink(os.path.join(self.tempdir, 'b.txt'))
+        os.unlink(os.path.join(self.tempdir, 'subdir', 'c.rst'))
+        index.refresh()
+        self.assertEqual(index.docs, {})
+        self.assertEqual(index.postings, {})
+        self.assertEqual(index.size, 0)
+
+    def test_refresh_unchanged(self):
+        index = self.make_index()
+        index.refresh()
+        with patch.object(index, 'read_words') as read_words:
+            index.refresh()
+        self.assertEqual(read_words.call_count, 0)
+
+    def test_refresh_index_full(self):
+        index = self.make_index()
+        index.refresh()
+        index = self.make_index(max_size=index.size - 1)
+        index.refresh()
+        self.assertEqual(len(index.docs), 2)
+        self.assertEqual(len(index.skipped), 1)
+        self.assertLessEqual(index.size, index.max_size)
+        # Skipped documents aren't read again until they change
+        with patch.object(index, 'read_words') as read_words:
+            index.refresh()
+        self.assertEqual(read_words.call_count, 0)
+        [skipped] = index.skipped
+        os.unlink(os.path.join(self.tempdir, skipped))
+        index.refresh()
+        self.assertEqual(index.skipped, {})
+
+    def test_refresh_file_disappears(self):
+        index = SearchIndex(Mock(root=self.tempdir), 10**6)
+        index.directory_index.list_files.return_value = ['gone.rst', 'subdir']
+        index.refresh()
+        self.assertEqual(index.docs, {})
+
+    def test_snippet(self):
+        index = self.make_index()
+        self.write('a.rst', 'x' * 100 + '\n\nHello\n    world\n' + 'y' * 100)
+        self.assertEqual(index.snippet('a.rst', 'WORLD', context=14),
+                         ('xx Hello', 'world', 'yyyyyyyyyyyyy'))
+
+    def test_snippet_no_match(self):
+        index = self.make_index()
+        self.assertIsNone(index.snippet('a.rst', '...'))
+        self.assertIsNone(index.snippet('a.rst', 'hell'))
+        self.assertIsNone(index.snippet('gone.rst', 'hello'))
+
+    def test_stats(self):
+        index = self.make_index()
+        index.refresh()
+        self.assertEqual(index.stats(), {
+            'documents': 3,
+            'words': 6,
+            'skipped': 0,
+            'size': index.size,
+            'max_size': 10**6,
+            'ready': True,
+        })
+
+
+class TestSiteBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.srcdir = os.path.join(self.tempdir, 'src')
+        self.outdir = os.path.join(self.tempdir, 'out')
+        os.makedirs(os.path.join(self.srcdir, 'docs', 'img'))
+        os.mkdir(os.path.join(self.srcdir, 'empty'))
+        self.write('README.rst', 'Read CHANGES.rst\n')
+        self.write(os.path.join('docs', 'a b.rst'),
+                   '.. image:: img/pic.png\n\n.. image:: img/gone.png\n')
+        self.write(os.path.join('docs', 'img', 'pic.png'), 'PNG')
+
+    def write(self, filename, text):
+        with open(os.path.join(self.srcdir, filename), 'w') as f:
+            f.write(text)
+
+    def read(self, filename):
+        with open(os.path.join(self.outdir, filename)) as f:
+            return f.read()
+
+    def outputs(self):
+        return sorted(
+            os.path.relpath(os.path.join(dirpath, fn), self.outdir)
+            .replace(os.path.sep, '/')
+            for dirpath, dirnames, filenames in os.walk(self.outdir)
+            for fn in filenames)
+
+    def build(self, root=None, **kw):
+        viewer = RestViewer(self.srcdir if root is None else root)
+        viewer.render_workers = 1
+        viewer.__dict__.update(kw)
+        builder = SiteBuilder(viewer, self.outdir)
+        with patch('sys.stderr', StringIO()) as stderr:
+            builder.build()
+        builder.stderr = stderr.getvalue()
+        return builder
+
+    def test_build(self):
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (2, 0))
+        self.assertEqual(self.outputs(), [
+            '.restview-build.json',
+            'README.rst.html',
+            'docs/a b.rst.html',
+            'docs/img/pic.png',
+            'docs/index.html',
+            'index.html',
+        ])
+        self.assertEqual(self.read('docs/img/pic.png'), 'PNG')
+        index = self.read('index.html')
+        self.assertIn('<title>RST files in src</title>', index)
+        self.assertIn('<li><a href="docs/index.html">docs/</a></li>', index)
+        self.assertIn('<li><a href="README.rst.html">README.rst</a></li>',
+                      index)
+        self.assertIn('<li><a href="a%20b.rst.html">a b.rst</a></li>',
+                      self.read('docs/index.html'))
+        html = self.read('README.rst.html')
+        self.assertIn('<a href="CHANGES.rst.html">CHANGES.rst</a>', html)
+        self.assertNotIn('EventSource', html)
+
+    def test_build_again(self):
+        self.build()
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (0, 2))
+
+    def test_build_again_touched(self):
+        self.build()
+        filename = os.path.join(self.srcdir, 'README.rst')
+        os.utime(filename, (1000000000, 1000000000))
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (0, 2))
+        with open(os.path.join(self.outdir, SiteBuilder.manifest_name)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['pages']['README.rst.html']['stamp'],
+                         [1000000000 * 10**9, 17])
+
+    def test_build_again_changed(self):
+        self.build()
+        self.write('README.rst', 'Changed')
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (1, 1))
+        self.assertIn('Changed', self.read('README.rst.html'))
+
+    def test_build_again_included_file_changed(self):
+        self.write('inc.txt', 'first version\n')
+        self.write('a.rst', '.. include:: inc.txt\n')
+        self.build()
+        with open(os.path.join(self.outdir, SiteBuilder.manifest_name)) as f:
+            manifest = json.load(f)
+        included = os.path.join(self.srcdir, 'inc.txt')
+        st = os.stat(included)
+        self.assertEqual(manifest['pages']['a.rst.html']['dependencies'],
+                         [[included, st.st_mtime_ns, st.st_size]])
+        self.write('inc.txt', 'second version\n')
+        builder = self.build()
+        # a.rst.html and inc.txt.html
+        self.assertEqual((builder.rendered, builder.unchanged), (2, 2))
+        self.assertIn('second version', self.read('a.rst.html'))
+
+    def test_build_again_without_dependencies_in_manifest(self):
+        self.build()
+        filename = os.path.join(self.outdir, SiteBuilder.manifest_name)
+        with open(filename) as f:
+            manifest = json.load(f)
+        del manifest['pages']['README.rst.html']['dependencies']
+        with open(filename, 'w') as f:
+            json.dump(manifest, f)
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (1, 1))
+
+    def test_build_again_output_removed(self):
+        self.build()
+        os.unlink(os.path.join(self.outdir, 'README.rst.html'))
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (1, 1))
+
+    def test_build_again_different_settings(self):
+        self.build()
+        builder = self.build(pypi_strict=True)
+        self.assertEqual((builder.rendered, builder.unchanged), (2, 0))
+
+    def test_build_again_bad_manifest(self):
+        os.mkdir(self.outdir)
+        with open(os.path.join(self.outdir, SiteBuilder.manifest_name), 'w') as f:
+            f.write('{garbage')
+        builder = self.build()
+        self.assertEqual((builder.rendered, builder.unchanged), (2, 0))
+
+    def test_build_again_removes_stale_outputs(self):
+        self.build()
+        shutil.rmtree(os.path.join(self.srcdir, 'docs'))
+        with open(os.path.join(self.outdir, 'mine.txt'), 'w'):
+            pass
+        self.build()
+        self.assertEqual(self.outputs(), [
+            '.restview-build.json',
+            'README.rst.html',
+            'index.html',
+            'mine.txt',
+        ])
+
+    def test_build_again_stale_output_already_gone(self):
+        self.build()
+        os.unlink(os.path.join(self.srcdir, 'README.rst'))
+        os.unlink(os.path.join(self.outdir, 'README.rst.html'))
+        self.build()
+        self.assertNotIn('README.rst.html', self.outputs())
+
+    def test_build_single_file(self):
+        builder = self.build(os.path.join(self.srcdir, 'docs', 'a b.rst'))
+        self.assertEqual(builder.rendered, 1)
+        self.assertEqual(self.outputs(), [
+            '.restview-build.json',
+            'img/pic.png',
+            'index.html',
+        ])
+
+    def test_build_multiple_roots(self):
+        builder = self.build([os.path.join(self.srcdir, 'README.rst'),
+                              os.path.join(self.srcdir, 'docs'),
+                              os.path.join(self.srcdir, 'missing.rst')])
+        self.assertEqual(builder.rendered, 2)
+        self.assertEqual(builder.errors, 1)
+        self.assertEqual(self.outputs(), [
+            '.restview-build.json',
+            '0/README.rst.html',
+            '1/a b.rst.html',
+            '1/img/pic.png',
+            '1/index.html',
+            'index.html',
+        ])
+        self.assertIn('<a href="1/index.html">%s</a>'
+                      % os.path.join(self.srcdir, 'docs'),
+                      self.read('index.html'))
+        self.assertIn('<title>RST files in docs</title>',
+                      self.read('1/index.html'))
+        self.assertEqual(builder.stderr, '%s: No such file or directory\n'
+                         % os.path.join(self.srcdir, 'missing.rst'))
+
+    def test_add_dir_does_not_exist(self):
+        builder = SiteBuilder(RestViewer(self.srcdir), self.outdir)
+        builder.add_dir(os.path.join(self.srcdir, 'nosuchdir'), '')
+        self.assertEqual(builder.pages, [])
+        self.assertEqual(builder.listings, {})
+
+    def test_build_file_disappears(self):
+        viewer = RestViewer(self.srcdir)
+        viewer.render_workers = 1
+        viewer.build_page = Mock(return_value=None)
+        builder = SiteBuilder(viewer, self.outdir)
+        with patch('sys.stderr', StringIO()) as stderr:
+            builder.build()
+        self.assertEqual(builder.rendered, 0)
+        self.assertIn("README.rst: can't read the file", stderr.getvalue())
+
+    def test_fingerprint_file_disappears(self):
+        builder = SiteBuilder(RestViewer(self.srcdir), self.outdir)
+        self.assertIsNone(builder.fingerprint(
+            os.path.join(self.srcdir, 'nosuchfile.rst')))
+
+    def test_copy_images_unchanged(self):
+        self.build()
+        builder = SiteBuilder(RestViewer(self.srcdir), self.outdir)
+        with patch('shutil.copy2') as copy2:
+            outputs = builder.copy_images(
+                os.path.join(self.srcdir, 'docs', 'a b.rst'),
+                'docs/a b.rst.html', ['img/pic.png'])
+        self.assertEqual(outputs, ['docs/img/pic.png'])
+        self.assertEqual(copy2.call_count, 0)
+
+
+class TestRenderWorkerPool(unittest.TestCase):
+
+    def make_pool(self, workers=1):
+        pool = RenderWorkerPool(workers, RestViewer.get_mp_context(), int)
+        self.addCleanup(pool.shutdown)
+        return pool
+
+    def test_call(self):
+        pool = self.make_pool()
+        self.assertEqual(pool.call(divmod, 7, 2, timeout=10), (3, 1))
+
+    def test_call_error(self):
+        pool = self.make_pool()
+        worker = pool.idle[0]
+        with self.assertRaises(ValueError):
+            pool.call(int, 'x', timeout=10)
+        self.assertEqual(pool.idle, [worker])
+
+    def test_call_timeout(self):
+        pool = self.make_pool(workers=2)
+        other = threading.Thread(
+            target=lambda: results.append(pool.call(time.sleep, 0.5)))
+        results = []
+        other.start()
+        with self.assertRaises(concurrent.futures.TimeoutError):
+            pool.call(time.sleep, 10, timeout=0.1)
+        other.join()
+        # The render in the other worker was not disturbed
+        self.assertEqual(results, [None])
+        self.assertEqual(len(pool.idle), 2)
+        self.assertTrue(all(p.is_alive() for p, conn in pool.idle))
+
+    def test_call_worker_died(self):
+        pool = self.make_pool()
+        with self.assertRaises(concurrent.futures.BrokenExecutor):
+            pool.call(os._exit, 1, timeout=10)
+        self.assertEqual(pool.call(divmod, 7, 2, timeout=10), (3, 1))
+
+    def test_call_waits_for_idle_worker(self):
+        pool = self.make_pool()
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(pool.call(divmod, 7, 2)))
+            for n in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(3, 1)] * 3)
+
+    def test_shutdown(self):
+        pool = self.make_pool()
+        process, conn = pool.idle[0]
+        pool.shutdown()
+        self.assertFalse(process.is_alive())
+        with self.assertRaises(concurrent.futures.BrokenExecutor):
+            pool.call(divmod, 7, 2)
+
+    def test_shutdown_busy_worker(self):
+        pool = self.make_pool()
+        process, conn = pool.idle[0]
+        sent = threading.Event()
+
+        def send(obj):
+            conn.send(obj)
+            sent.set()
+
+        pool.idle[0] = (process, Mock(wraps=conn, send=send))
+        errors = []
+
+        def render():
+            try:
+                pool.call(time.sleep, 10)
+            except concurrent.futures.BrokenExecutor as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=render)
+        thread.start()
+        self.assertTrue(sent.wait(5))
+        pool.shutdown()
+        thread.join()
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(process.is_alive())
+        self.assertEqual(pool.busy, [])
+        self.assertEqual(pool.idle, [])
+
+    def test_release_after_shutdown(self):
+        pool = self.make_pool()
+        worker = pool.idle.pop()
+        pool.busy.append(worker)
+        pool.shutdown()
+        pool.release(worker)
+        process, conn = worker
+        self.assertFalse(process.is_alive())
+        self.assertEqual(pool.idle, [])
+
+
+class TestRenderCache(unittest.TestCase):
+
+    def test_get_miss(self):
+        cache = RenderCache(100)
+        self.assertIsNone(cache.get('key'))
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 0)
+
+    def test_get_hit(self):
+        cache = RenderCache(100)
+        cache.put('key', 'value', 5)
+        self.assertEqual(cache.get('key'), 'value')
+        self.assertEqual(cache.misses, 0)
+        self.assertEqual(cache.hits, 1)
+
+    def test_peek(self):
+        cache = RenderCache(100)
+        self.assertIsNone(cache.peek('key'))
+        cache.put('key', 'value', 5)
+        self.assertEqual(cache.peek('key'), 'value')
+        self.assertEqual(cache.misses, 0)
+        self.assertEqual(cache.hits, 0)
+
+    def test_put_replaces(self):
+        cache = RenderCache(100)
+        cache.put('key', 'value', 5)
+        cache.put('key', 'other value', 11)
+        self.assertEqual(cache.get('key'), 'other value')
+        self.assertEqual(cache.size, 11)
+        self.assertEqual(len(cache), 1)
+
+    def test_put_evicts_least_recently_used(self):
+        cache = RenderCache(20)
+        cache.put('a', 'A', 8)
+        cache.put('b', 'B', 8)
+        cache.get('a')
+        cache.put('c', 'C', 8)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 'C')
+        self.assertEqual(cache.size, 16)
+
+    def test_put_too_large(self):
+        cache = RenderCache(20)
+        cache.put('a', 'A', 8)
+        cache.put('b', 'B', 21)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 8)
+
+    def test_stats(self):
+        cache = RenderCache(20)
+        cache.put('a', 'A', 8)
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual(cache.stats(), {
+            'entries': 1,
+            'size': 8,
+            'max_size': 20,
+            'hits': 1,
+            'misses': 1,
+        })
+
+
 class TestRestViewer(unittest.TestCase):
 
     def test_serve(self):
@@ -776,6 +3207,157 @@ class TestRestViewer(unittest.TestCase):
         viewer.serve()
         self.assertEqual(viewer.server.serve_forever.call_count, 1)
 
+    def test_serve_processes(self):
+        viewer = RestViewer('.')
+        viewer.processes = 2
+        viewer.supervise_workers = Mock()
+        viewer.serve()
+        self.assertEqual(viewer.supervise_workers.call_count, 1)
+
+    def make_workers_viewer(self):
+        viewer = RestViewer('.')
+        viewer.processes = 2
+        viewer.start_search_indexer = Mock()
+        self.addCleanup(viewer.close)
+        return viewer
+
+    def make_pipe(self, viewer):
+        viewer.parent_pipe = os.pipe()
+        for fd in viewer.parent_pipe:
+            self.addCleanup(self.close_fd, fd)
+
+    def close_fd(self, fd):
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_listen_processes(self):
+        viewer = self.make_workers_viewer()
+        viewer.start_workers = Mock()
+        port = viewer.listen()
+        self.assertEqual(viewer.reserved_socket.getsockname()[1], port)
+        self.assertEqual(viewer.start_workers.call_count, 1)
+        self.assertIsNone(viewer.server)
+        # The worker processes can listen on the same port
+        viewer.start_server(('localhost', port), reuse_port=True)
+        self.assertEqual(viewer.server.socket.getsockname()[1], port)
+        viewer.close()
+        self.assertIsNone(viewer.reserved_socket)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_reserve_port_error(self):
+        viewer = self.make_workers_viewer()
+        with socket.create_server(('localhost', 0)) as sock:
+            viewer.local_address = sock.getsockname()
+            with patch('socket.socket.close', autospec=True,
+                       side_effect=socket.socket.close) as close:
+                with self.assertRaises(OSError):
+                    viewer.reserve_port()
+        self.assertEqual(close.call_count, 1)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs os.fork")
+    def test_start_workers(self):
+        viewer = self.make_workers_viewer()
+        with patch('os.fork', side_effect=[101, 102]):
+            viewer.start_workers()
+        for fd in viewer.parent_pipe:
+            self.addCleanup(os.close, fd)
+        self.assertEqual(sorted(viewer.worker_pids), [101, 102])
+        viewer.worker_pids = {}
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs os.fork")
+    def test_start_worker_in_worker(self):
+        viewer = self.make_workers_viewer()
+        viewer.run_worker = Mock(side_effect=SystemExit)
+        with patch('os.fork', return_value=0):
+            with self.assertRaises(SystemExit):
+                viewer.start_worker()
+        self.assertEqual(viewer.run_worker.call_count, 1)
+
+    def run_worker(self, viewer, serve_forever):
+        viewer.local_address = ('localhost', 0)
+        viewer.reserved_socket = viewer.reserve_port()
+        viewer.worker_pids = {101: 0}
+        viewer.wait_for_parent = Mock()
+        self.make_pipe(viewer)
+        with patch.object(ThreadingHTTPServer, 'serve_forever',
+                          serve_forever), \
+                patch('signal.signal') as signal, \
+                patch('os._exit') as exit:
+            viewer.run_worker()
+        signal.assert_called_once_with(15, 0)
+        self.assertEqual(viewer.worker_pids, {})
+        self.assertIsNone(viewer.reserved_socket)
+        with self.assertRaises(OSError):
+            os.write(viewer.parent_pipe[1], b'x')
+        return exit
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_run_worker(self):
+        viewer = self.make_workers_viewer()
+        exit = self.run_worker(viewer, Mock())
+        exit.assert_called_once_with(0)
+        self.assertEqual(viewer.wait_for_parent.call_count, 1)
+        self.assertEqual(viewer.server.socket.fileno(), -1)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_run_worker_interrupted(self):
+        viewer = self.make_workers_viewer()
+        exit = self.run_worker(viewer, Mock(side_effect=KeyboardInterrupt))
+        exit.assert_called_once_with(0)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_run_worker_error(self):
+        viewer = self.make_workers_viewer()
+        with patch('traceback.print_exc') as print_exc:
+            exit = self.run_worker(viewer, Mock(side_effect=ValueError))
+        exit.assert_called_once_with(1)
+        self.assertEqual(print_exc.call_count, 1)
+
+    def test_wait_for_parent(self):
+        viewer = self.make_workers_viewer()
+        viewer.server = Mock()
+        self.make_pipe(viewer)
+        os.close(viewer.parent_pipe[1])
+        viewer.wait_for_parent()
+        self.assertEqual(viewer.server.shutdown.call_count, 1)
+
+    @unittest.skipUnless(hasattr(os, 'wait'), "needs os.wait")
+    def test_supervise_workers(self):
+        viewer = self.make_workers_viewer()
+        viewer.worker_pids = {101: time.monotonic() - 60,
+                              102: time.monotonic()}
+        viewer.start_worker = Mock()
+        with patch('os.wait', side_effect=[(99, 0), (101, 256), (102, 9),
+                                           KeyboardInterrupt]), \
+                patch('signal.signal') as signal, \
+                patch('time.sleep') as sleep, \
+                patch('sys.stderr', StringIO()) as stderr:
+            with self.assertRaises(KeyboardInterrupt):
+                viewer.supervise_workers()
+        signal.assert_called_once_with(15, exit_on_signal)
+        self.assertEqual(viewer.start_worker.call_count, 2)
+        sleep.assert_called_once_with(viewer.worker_restart_delay)
+        self.assertEqual(
+            stderr.getvalue(),
+            'Worker process 101 exited with status 1, restarting\n'
+            'Worker process 102 exited with status -9, restarting\n')
+
+    @unittest.skipIf(sys.platform == 'win32', "needs POSIX commands")
+    def test_stop_workers(self):
+        viewer = self.make_workers_viewer()
+        worker = subprocess.Popen(['sleep', '60'])
+        gone = subprocess.Popen(['true'])
+        gone.wait()
+        viewer.worker_pids = {worker.pid: 0, gone.pid: 0}
+        viewer.close()
+        self.assertEqual(viewer.worker_pids, {})
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(worker.pid, 0)
+        worker.wait()
+
     def test_rest_to_html_halt_level(self):
         viewer = RestViewer('.')
         viewer.halt_level = 2
@@ -788,6 +3370,536 @@ class TestRestViewer(unittest.TestCase):
         html = viewer.rest_to_html(b'.. _unused:\n\nEtc.')
         self.assertIn('System Message: INFO/1', html)
 
+    def test_rest_to_html_caches_files(self):
+        viewer = RestViewer('.')
+        viewer.render = Mock(return_value='<body></body>')
+        st = os.stat(__file__)
+        html1 = viewer.rest_to_html(b'Hello', filename=__file__, stat=st,
+                                    mtime=1)
+        html2 = viewer.rest_to_html(b'Hello', filename=__file__, stat=st,
+                                    mtime=2)
+        self.assertEqual(viewer.render.call_count, 1)
+        self.assertIn("var mtime = '1'", html1)
+        self.assertIn("var mtime = '2'", html2)
+        self.assertEqual(viewer.render_cache.hits, 1)
+
+    def test_rest_to_html_cache_key_includes_settings(self):
+        viewer = RestViewer('.')
+        viewer.render = Mock(return_value='<body></body>')
+        st = os.stat(__file__)
+        viewer.rest_to_html(b'Hello', filename=__file__, stat=st)
+        viewer.halt_level = 2
+        viewer.rest_to_html(b'Hello', filename=__file__, stat=st)
+        viewer.rest_to_html(b'Hello', filename=__file__, stat=st,
+                            settings={'cloak_email_addresses': True})
+        self.assertEqual(viewer.render.call_count, 3)
+
+    def test_rest_to_html_caches_by_content(self):
+        viewer = RestViewer('.')
+        viewer.render = Mock(return_value='<body></body>')
+        viewer.rest_to_html(b'Hello')
+        viewer.rest_to_html(b'Hello')
+        self.assertEqual(viewer.render.call_count, 1)
+        viewer.rest_to_html(b'Hello, world')
+        self.assertEqual(viewer.render.call_count, 2)
+
+    def test_fingerprint(self):
+        viewer = RestViewer('.')
+        fp = viewer.fingerprint(b'Hello')
+        self.assertEqual(len(fp), 40)
+        self.assertEqual(viewer.fingerprint('Hello'), fp)
+        self.assertNotEqual(viewer.fingerprint(b'Hello!'), fp)
+        self.assertNotEqual(viewer.fingerprint(b'Hello', filename='a.rst'), fp)
+        self.assertNotEqual(viewer.fingerprint(b'Hello', {'x': 1}), fp)
+        viewer.pypi_strict = True
+        self.assertNotEqual(viewer.fingerprint(b'Hello'), fp)
+
+    def test_rest_to_html_cache_disabled(self):
+        viewer = RestViewer('.')
+        viewer.render_cache = RenderCache(0)
+        viewer.render = Mock(return_value='<body></body>')
+        st = os.stat(__file__)
+        viewer.rest_to_html(b'Hello', filename=__file__, stat=st)
+        viewer.rest_to_html(b'Hello', filename=__file__, stat=st)
+        self.assertEqual(viewer.render.call_count, 2)
+        self.assertEqual(viewer.render_cache.misses, 0)
+
+    def make_include_tree(self):
+        tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        with open(os.path.join(tempdir, 'main.rst'), 'w') as f:
+            f.write('.. include:: inc.rst\n')
+        with open(os.path.join(tempdir, 'inc.rst'), 'w') as f:
+            f.write('first version\n')
+        return os.path.join(tempdir, 'main.rst'), os.path.join(tempdir, 'inc.rst')
+
+    def test_rest_to_html_notices_included_file_changes(self):
+        filename, included = self.make_include_tree()
+        viewer = RestViewer('.')
+        with open(filename, 'rb') as f:
+            data = f.read()
+        st = os.stat(filename)
+        html = viewer.rest_to_html(data, filename=filename, stat=st)
+        self.assertIn('first version', html)
+        self.assertEqual(viewer.rest_to_html(data, filename=filename, stat=st),
+                         html)
+        self.assertEqual(viewer.render_cache.hits, 1)
+        with open(included, 'w') as f:
+            f.write('second version\n')
+        html = viewer.rest_to_html(data, filename=filename, stat=st)
+        self.assertIn('second version', html)
+
+    def test_get_dependency_stamps(self):
+        st = os.stat(__file__)
+        self.assertEqual(
+            RestViewer.get_dependency_stamps([__file__, '/no/such/file']),
+            ((__file__, st.st_mtime_ns, st.st_size),
+             ('/no/such/file', None, None)))
+
+    def test_publish_dependencies(self):
+        filename, included = self.make_include_tree()
+        viewer = RestViewer('.')
+        dependencies = []
+        viewer.publish(b'.. include:: inc.rst\n', filename=filename,
+                       dependencies=dependencies)
+        self.assertEqual(dependencies, [included])
+
+    def test_publish_dependencies_of_broken_documents(self):
+        filename, included = self.make_include_tree()
+        with open(included, 'w') as f:
+            f.write('`oops\n')
+        viewer = RestViewer('.')
+        viewer.halt_level = 2
+        dependencies = []
+        with patch('sys.stderr', StringIO()):
+            html = viewer.publish(b'.. include:: inc.rst\n',
+                                  filename=filename, dependencies=dependencies)
+        self.assertIn('<title>SystemMessage</title>', html)
+        self.assertEqual(dependencies, [included])
+
+    def test_get_render_context_is_reused(self):
+        viewer = RestViewer('.')
+        context = viewer.get_render_context()
+        self.assertIs(viewer.get_render_context(), context)
+        viewer.pypi_strict = True
+        self.assertIsNot(viewer.get_render_context(), context)
+        self.assertIsNot(viewer.get_render_context({'x': 1}), context)
+
+    def test_get_render_context_when_stylesheet_changes(self):
+        viewer = RestViewer('.')
+        context = viewer.get_render_context()
+        context.stylesheet_stamps = (None, None)
+        self.assertTrue(context.is_stale())
+        self.assertIsNot(viewer.get_render_context(), context)
+
+    def test_get_render_context_forgets_old_contexts(self):
+        viewer = RestViewer('.')
+        for n in range(10):
+            viewer.get_render_context({'n': n})
+        self.assertLessEqual(len(viewer._render_contexts), 8)
+
+    def test_settings_key_includes_stylesheet_stamps(self):
+        viewer = RestViewer('.')
+        viewer.stylesheets = 'restview.css,nosuchfile.css'
+        stamps = viewer.settings_key()[-1]
+        self.assertEqual(len(stamps), 2)
+        self.assertIsNotNone(stamps[0])
+        self.assertIsNone(stamps[1])
+
+    def test_settings_key_stylesheet_urls(self):
+        viewer = RestViewer('.')
+        viewer.stylesheets = 'http://example.com/my.css'
+        self.assertEqual(viewer.settings_key()[-1], ())
+
+    def test_get_validators(self):
+        viewer = RestViewer('.')
+        self.assertEqual(viewer.get_validators(b'Hello', mtime=1),
+                         (None, None))
+        for data in [b'Hello', b'Bye']:
+            viewer.rest_to_html(data)
+            viewer.rest_to_html(data, {'x': 1})
+        etag, last_modified = viewer.get_validators(b'Hello', mtime=1)
+        self.assertRegex(etag, '^"[0-9a-f]{32}"$')
+        # The output of a command can change even if mtime stays the same
+        self.assertIsNone(last_modified)
+        self.assertEqual(viewer.get_validators(b'Hello', mtime=1)[0], etag)
+        self.assertNotEqual(viewer.get_validators(b'Hello', mtime=2)[0], etag)
+        self.assertNotEqual(viewer.get_validators(b'Bye', mtime=1)[0], etag)
+        self.assertNotEqual(
+            viewer.get_validators(b'Hello', {'x': 1}, mtime=1)[0], etag)
+        self.assertEqual(viewer.render_cache.hits, 0)
+
+    def test_get_validators_for_files(self):
+        viewer = RestViewer('.')
+        st = os.stat(__file__)
+        viewer.rest_to_html(b'Hello', filename=__file__, stat=st)
+        etag, last_modified = viewer.get_validators(
+            b'Hello', mtime=st.st_mtime, filename=__file__, stat=st)
+        self.assertEqual(last_modified, st.st_mtime)
+        # Files are identified by their size and mtime, not contents
+        self.assertEqual(
+            viewer.get_validators(b'Bye', mtime=st.st_mtime,
+                                  filename=__file__, stat=st),
+            (etag, last_modified))
+
+    def test_get_validators_for_included_files(self):
+        filename, included = self.make_include_tree()
+        os.utime(included, (1364808683, 1364808683))
+        os.utime(filename, (1364800000, 1364800000))
+        viewer = RestViewer('.')
+        st = os.stat(filename)
+        viewer.rest_to_html(b'.. include:: inc.rst\n', filename=filename,
+                            stat=st)
+        etag, last_modified = viewer.get_validators(
+            b'.. include:: inc.rst\n', mtime=st.st_mtime, filename=filename,
+            stat=st)
+        self.assertEqual(last_modified, 1364808683)
+        with open(included, 'w') as f:
+            f.write('second version\n')
+        # The cached page is out of date
+        self.assertEqual(
+            viewer.get_validators(b'.. include:: inc.rst\n',
+                                  mtime=st.st_mtime, filename=filename,
+                                  stat=st),
+            (None, None))
+        viewer.rest_to_html(b'.. include:: inc.rst\n', filename=filename,
+                            stat=st)
+        new_etag, new_last_modified = viewer.get_validators(
+            b'.. include:: inc.rst\n', mtime=st.st_mtime, filename=filename,
+            stat=st)
+        self.assertNotEqual(new_etag, etag)
+        self.assertGreater(new_last_modified, last_modified)
+
+    def test_link_stylesheets(self):
+        viewer = RestViewer('.')
+        viewer.link_stylesheets = True
+        html = viewer.rest_to_html(b'Hello')
+        links = re.findall(r'<link rel="stylesheet" href="/_static/(.*?)"',
+                           html)
+        self.assertEqual(len(links), 3)
+        self.assertNotIn('<style', html)
+        self.assertIn(b'html4css1.css', viewer.get_static_file(links[0]))
+        self.assertIn(b'ReSTview', viewer.get_static_file(links[1]))
+        self.assertIn(b'pre .hll', viewer.get_static_file(links[2]))
+        self.assertIsNone(viewer.get_static_file('nosuchfile.css'))
+
+    def test_link_stylesheets_are_named_by_contents(self):
+        viewer = RestViewer('.')
+        viewer.link_stylesheets = True
+        html = viewer.rest_to_html(b'Hello')
+        self.assertIn(viewer.get_render_context({'x': 1}).settings
+                      .restview_pygments_stylesheet, html)
+
+    def test_link_stylesheets_of_other_contexts(self):
+        viewer = RestViewer('.')
+        viewer.link_stylesheets = True
+        context = viewer.get_render_context({'x': 1})
+        context.static_files['extra.css'] = b'p {}'
+        self.assertEqual(viewer.get_static_file('extra.css'), b'p {}')
+
+    def test_link_stylesheets_urls(self):
+        viewer = RestViewer('.')
+        viewer.link_stylesheets = True
+        viewer.stylesheets = 'http://example.com/my.css'
+        html = viewer.rest_to_html(b'Hello')
+        self.assertIn('href="http://example.com/my.css"', html)
+        self.assertEqual(html.count('href="/_static/'), 1)
+
+    def test_settings_key_includes_link_stylesheets(self):
+        viewer = RestViewer('.')
+        key = viewer.settings_key()
+        viewer.link_stylesheets = True
+        self.assertNotEqual(viewer.settings_key(), key)
+
+    def test_rest_to_html_missing_stylesheet(self):
+        viewer = RestViewer('.')
+        viewer.stylesheets = 'nosuchfile.css'
+        with patch('sys.stderr', StringIO()):
+            html = viewer.rest_to_html(b'Hello')
+        self.assertIn('Cannot embed stylesheet', html)
+
+    def test_render_in_worker_process(self):
+        viewer = RestViewer('.')
+        viewer.halt_level = 2
+        viewer.render_workers = 1
+        try:
+            html = viewer.render(b'Hello, *world*!')
+            self.assertEqual(html, viewer.publish(b'Hello, *world*!'))
+            filename, included = self.make_include_tree()
+            dependencies = []
+            html = viewer.render(b'.. include:: inc.rst\n', filename=filename,
+                                 dependencies=dependencies)
+            self.assertIn('first version', html)
+            self.assertEqual(dependencies, [included])
+            with patch('sys.stderr', StringIO()):
+                html = viewer.render(b'`Hello', filename='hello.rst')
+            self.assertIn('<title>SystemMessage</title>', html)
+            self.assertIn('<span class="highlight">`Hello</span>', html)
+        finally:
+            viewer.render_pool.shutdown()
+
+    def test_render_in_worker_process_failure(self):
+        viewer = RestViewer('.')
+        viewer.render_workers = 1
+        viewer.render_pool = Mock()
+        viewer.render_pool.call.side_effect = RuntimeError('pool is broken')
+        with self.assertRaises(RenderFailure) as cm:
+            viewer.render(b'Hello')
+        html = cm.exception.html
+        self.assertIn('<title>RuntimeError</title>', html)
+        self.assertIn('pool is broken', html)
+
+    def test_render_timeout(self):
+        viewer = SlowRestViewer('.')
+        viewer.render_timeout = 0.5
+        viewer.render_workers = 1
+        with self.assertRaises(RenderFailure) as cm:
+            viewer.render(b'Hello')
+        html = cm.exception.html
+        self.assertIn('<title>RenderTimeout</title>', html)
+        self.assertIn('Rendering took longer than the time limit of 0.5 seconds.',
+                      html)
+        # The stuck worker got replaced
+        self.assertEqual(len(viewer.render_pool.idle), 1)
+        viewer.close()
+
+    def test_render_memory_limit(self):
+        viewer = RestViewer('.')
+        viewer.render_memory_limit = 100 * 1024 * 1024
+        pool = viewer.render_pool = Mock()
+        pool.call.side_effect = MemoryError
+        with self.assertRaises(RenderFailure) as cm:
+            viewer.render(b'Hello')
+        html = cm.exception.html
+        self.assertIn('<title>MemoryError</title>', html)
+        self.assertIn('Rendering needed more than the memory limit of 100 MB.',
+                      html)
+
+    def test_render_out_of_memory(self):
+        viewer = RestViewer('.')
+        with patch('docutils.core.publish_string', side_effect=MemoryError):
+            with self.assertRaises(RenderFailure) as cm:
+                viewer.render(b'Hello')
+        html = cm.exception.html
+        self.assertIn('<title>MemoryError</title>', html)
+        self.assertIn('Ran out of memory while rendering.', html)
+
+    def test_rest_to_html_does_not_cache_failures(self):
+        viewer = RestViewer('.')
+        viewer.render = Mock(side_effect=[
+            RenderFailure('<body>Too slow</body>'), '<body>Hello</body>'])
+        with self.assertRaises(RenderFailure) as cm:
+            viewer.rest_to_html(b'Hello', mtime=1234)
+        self.assertIn('Too slow', cm.exception.html)
+        self.assertIn("var mtime = '1234';", cm.exception.html)
+        html = viewer.rest_to_html(b'Hello', mtime=1234)
+        self.assertIn('Hello', html)
+        self.assertEqual(viewer.render.call_count, 2)
+
+    def test_render_worker_died(self):
+        viewer = RestViewer('.')
+        viewer.render_workers = 1
+        pool = viewer.render_pool = Mock()
+        pool.call.side_effect = concurrent.futures.BrokenExecutor(
+            'A render worker process died')
+        with self.assertRaises(RenderFailure) as cm:
+            viewer.render(b'Hello')
+        self.assertIn('<title>BrokenExecutor</title>', cm.exception.html)
+        self.assertEqual(pool.call.call_count, 1)
+
+    def test_get_render_pool(self):
+        viewer = RestViewer('.')
+        viewer.render_workers = 2
+        with patch('restview.restviewhttp.RenderWorkerPool') as rwp:
+            pool = viewer.get_render_pool()
+            self.assertIs(viewer.get_render_pool(), pool)
+        self.assertEqual(rwp.call_count, 1)
+        self.assertEqual(rwp.call_args[0][0], 2)
+
+    def test_listen_starts_render_pool(self):
+        viewer = RestViewer('.')
+        viewer.render_workers = 2
+        viewer.get_render_pool = Mock()
+        viewer.start_search_indexer = Mock()
+        viewer.listen()
+        viewer.render_pool = pool = Mock()
+        viewer.close()
+        self.assertEqual(viewer.get_render_pool.call_count, 1)
+        pool.shutdown.assert_called_once_with()
+        self.assertIsNone(viewer.render_pool)
+
+    def test_get_stats(self):
+        viewer = RestViewer('.')
+        self.assertEqual(viewer.get_stats()['pid'], os.getpid())
+        self.assertEqual(viewer.get_stats()['render_cache']['hits'], 0)
+        self.assertEqual(viewer.get_stats()['file_watcher']['files'], 0)
+        with viewer.parking('polling'):
+            self.assertEqual(viewer.get_stats()['parked_requests'],
+                             {'polling': 1, 'events': 0})
+        self.assertEqual(viewer.get_stats()['parked_requests'],
+                         {'polling': 0, 'events': 0})
+
+    def test_get_directory_index(self):
+        viewer = RestViewer('.')
+        index = viewer.get_directory_index('.')
+        self.assertEqual(index.root, os.path.abspath('.'))
+        self.assertIs(viewer.get_directory_index(os.path.abspath('.')), index)
+        self.assertEqual(list(viewer.get_stats()['directory_indexes']),
+                         [os.path.abspath('.')])
+
+    def make_check_tree(self):
+        tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        os.mkdir(os.path.join(tempdir, 'docs'))
+        with open(os.path.join(tempdir, 'docs', 'bad.rst'), 'w') as f:
+            f.write('Title\n=====\n\nSee `foo`_ and `bar`_.\n')
+        with open(os.path.join(tempdir, 'good.rst'), 'w') as f:
+            f.write('Title\n=====\n\nAll good.\n')
+        return tempdir
+
+    def test_check_file(self):
+        tempdir = self.make_check_tree()
+        viewer = RestViewer('.')
+        self.assertEqual(viewer.check_file(os.path.join(tempdir, 'good.rst')),
+                         [])
+        filename = os.path.join(tempdir, 'docs', 'bad.rst')
+        self.assertEqual(viewer.check_file(filename), [
+            '%s:4: (ERROR/3) Unknown target name: "foo".' % filename,
+            '%s:4: (ERROR/3) Unknown target name: "bar".' % filename,
+        ])
+
+    def test_check_file_report_level(self):
+        tempdir = self.make_check_tree()
+        viewer = RestViewer('.')
+        viewer.report_level = 4
+        filename = os.path.join(tempdir, 'docs', 'bad.rst')
+        self.assertEqual(viewer.check_file(filename), [])
+
+    def test_check_file_strict(self):
+        tempdir = self.make_check_tree()
+        viewer = RestViewer('.')
+        viewer.halt_level = 2
+        filename = os.path.join(tempdir, 'docs', 'bad.rst')
+        self.assertEqual(viewer.check_file(filename), [
+            '%s:4: (ERROR/3) Unknown target name: "foo".' % filename,
+        ])
+
+    def test_check_file_other_errors(self):
+        viewer = RestViewer('.')
+        viewer.convert = Mock(side_effect=ValueError("Output cleaning failed"))
+        self.assertEqual(viewer.check_file('README.rst'), [
+            'README.rst: ValueError: Output cleaning failed',
+        ])
+        viewer.convert = Mock(side_effect=ValueError("README.rst:7: oops"))
+        self.assertEqual(viewer.check_file('README.rst'), [
+            'README.rst:7: oops',
+        ])
+
+    def test_check_file_does_not_exist(self):
+        viewer = RestViewer('.')
+        self.assertEqual(viewer.check_file('nosuchfile.rst'), [
+            'nosuchfile.rst: No such file or directory',
+        ])
+
+    def test_check(self):
+        tempdir = self.make_check_tree()
+        viewer = RestViewer('.')
+        viewer.render_workers = 1
+        with patch('sys.stdout', StringIO()) as stdout:
+            self.assertFalse(viewer.check([tempdir]))
+        filename = os.path.join(tempdir, 'docs', 'bad.rst')
+        self.assertEqual(stdout.getvalue(),
+                         '%s:4: (ERROR/3) Unknown target name: "foo".\n'
+                         '%s:4: (ERROR/3) Unknown target name: "bar".\n'
+                         % (filename, filename))
+        with patch('sys.stdout', StringIO()) as stdout:
+            self.assertTrue(viewer.check([os.path.join(tempdir, 'good.rst')]))
+        self.assertEqual(stdout.getvalue(), '')
+
+    def test_build_page_file_does_not_exist(self):
+        viewer = RestViewer('.')
+        self.assertIsNone(viewer.build_page('nosuchfile.rst', 'out.html'))
+
+    def test_check_files_in_worker_processes(self):
+        tempdir = self.make_check_tree()
+        viewer = RestViewer('.')
+        viewer.render_workers = 2
+        filenames = [os.path.join(tempdir, 'good.rst'),
+                     os.path.join(tempdir, 'docs', 'bad.rst')]
+        results = list(viewer.check_files(filenames))
+        self.assertEqual([len(messages) for messages in results], [0, 2])
+
+    def make_search_tree(self):
+        tempdir = tempfile.mkdtemp(prefix='restview-test-')
+        self.addCleanup(shutil.rmtree, tempdir)
+        os.mkdir(os.path.join(tempdir, 'docs'))
+        with open(os.path.join(tempdir, 'docs', 'a b.rst'), 'w') as f:
+            f.write('Hello world, hello!')
+        with open(os.path.join(tempdir, 'README.rst'), 'w') as f:
+            f.write('Hello')
+        return tempdir
+
+    def test_start_search_indexer(self):
+        tempdir = self.make_search_tree()
+        viewer = RestViewer(tempdir)
+        viewer.search_refresh_interval = 60
+        viewer.start_search_indexer()
+        [(prefix, index)] = viewer.search_indexes
+        self.assertEqual(prefix, '')
+        self.assertEqual(index.max_size, viewer.search_index_size)
+        for n in range(100):
+            if index.ready:
+                break
+            time.sleep(0.05)  # pragma: nocover
+        self.assertEqual(index.search('world')[0], 1)
+        self.assertEqual(viewer.get_stats()['search_indexes'][tempdir]['documents'], 2)
+
+    def test_start_search_indexer_multiple_roots(self):
+        tempdir = self.make_search_tree()
+        viewer = RestViewer([os.path.join(tempdir, 'README.rst'),
+                             tempdir, os.path.join(tempdir, 'docs')])
+        viewer.run_search_indexer = Mock()
+        viewer.start_search_indexer()
+        viewer.search_thread.join()
+        self.assertEqual([prefix for prefix, index in viewer.search_indexes],
+                         ['1/', '2/'])
+        self.assertEqual(viewer.search_indexes[0][1].max_size,
+                         viewer.search_index_size // 2)
+        self.assertEqual(viewer.run_search_indexer.call_count, 1)
+
+    def test_start_search_indexer_nothing_to_index(self):
+        tempdir = self.make_search_tree()
+        viewer = RestViewer(os.path.join(tempdir, 'README.rst'))
+        viewer.start_search_indexer()
+        self.assertEqual(viewer.search_indexes, [])
+        viewer = RestViewer(tempdir, command='cat README.rst')
+        viewer.start_search_indexer()
+        self.assertEqual(viewer.search_indexes, [])
+        viewer = RestViewer(tempdir)
+        viewer.search_index_size = 0
+        viewer.start_search_indexer()
+        self.assertEqual(viewer.search_indexes, [])
+        self.assertIsNone(viewer.search_thread)
+
+    def test_search(self):
+        tempdir = self.make_search_tree()
+        viewer = RestViewer([tempdir, os.path.join(tempdir, 'docs')])
+        viewer.search_indexes = [
+            ('%d/' % idx, SearchIndex(viewer.get_directory_index(fn), 10**6))
+            for idx, fn in enumerate(viewer.root)]
+        for prefix, index in viewer.search_indexes:
+            index.refresh()
+        total, matches = viewer.search('hello')
+        self.assertEqual(total, 3)
+        self.assertEqual([href for href, index, relpath in matches],
+                         ['0/docs/a%20b.rst', '1/a%20b.rst', '0/README.rst'])
+        total, matches = viewer.search('hello', limit=1)
+        self.assertEqual(total, 3)
+        self.assertEqual(len(matches), 1)
+        href, index, relpath = matches[0]
+        self.assertEqual(index.snippet(relpath, 'world'),
+                         ('Hello', 'world', ', hello!'))
+
     @patch('readme_renderer.rst.clean', Mock(return_value=None))
     def test_rest_to_html_pypi_strict_clean_failure(self):
         # Certain versions of readme_renderer could return `None`
@@ -888,14 +4000,160 @@ class TestRestViewer(unittest.TestCase):
         )
 
 
+class TestSyntaxHighlightingHTMLTranslator(unittest.TestCase):
+
+    @patch.object(SyntaxHighlightingHTMLTranslator, 'highlight_cache',
+                  RenderCache(10**6))
+    def test_highlight_doctest(self):
+        highlight = SyntaxHighlightingHTMLTranslator.highlight_doctest
+        html = highlight('>>> 2 + 2\n4')
+        self.assertIn('<span class="gp">&gt;&gt;&gt; </span>', html)
+        self.assertIs(highlight('>>> 2 + 2\n4'), html)
+        cache = SyntaxHighlightingHTMLTranslator.highlight_cache
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    @patch.object(SyntaxHighlightingHTMLTranslator, 'highlight_cache',
+                  RenderCache(100))
+    def test_highlight_cache_is_bounded(self):
+        highlight = SyntaxHighlightingHTMLTranslator.highlight_doctest
+        for n in range(10):
+            highlight('>>> %d' % n)
+        cache = SyntaxHighlightingHTMLTranslator.highlight_cache
+        self.assertLessEqual(cache.size, 100)
+
+    def test_lexers_are_reused(self):
+        viewer = RestViewer('.')
+        with patch('pygments.lexers.PythonConsoleLexer') as lexer_class, \
+                patch('pygments.formatters.HtmlFormatter') as formatter_class:
+            html = viewer.rest_to_html(b'>>> 1\n1\n\n>>> 2\n2\n')
+        self.assertIn('<span class="mi">2</span>', html)
+        self.assertEqual(lexer_class.call_count, 0)
+        self.assertEqual(formatter_class.call_count, 0)
+
+
+class TestCachingLexer(unittest.TestCase):
+
+    @patch.object(CachingLexer, 'cache', RenderCache(10**6))
+    def test_tokens_are_cached(self):
+        tokens = list(CachingLexer('x = 1', 'python'))
+        self.assertIn((['n'], 'x'), tokens)
+        with patch('pygments.lex') as lex:
+            self.assertEqual(list(CachingLexer('x = 1', 'python')), tokens)
+        self.assertEqual(lex.call_count, 0)
+        self.assertEqual((CachingLexer.cache.hits, CachingLexer.cache.misses),
+                         (1, 1))
+
+    @patch.object(CachingLexer, 'cache', RenderCache(10**6))
+    def test_cache_key(self):
+        list(CachingLexer('x = 1', 'python'))
+        list(CachingLexer('x = 1', 'python', 'long'))
+        list(CachingLexer('x = 1', 'ruby'))
+        list(CachingLexer('x = 2', 'python'))
+        self.assertEqual(len(CachingLexer.cache), 4)
+
+    @patch.object(CachingLexer, 'cache', RenderCache(10**6))
+    def test_plain_text_is_not_cached(self):
+        self.assertEqual(list(CachingLexer('x = 1', '')), [([], 'x = 1')])
+        self.assertEqual(list(CachingLexer('x = 1', 'python', 'none')),
+                         [([], 'x = 1')])
+        self.assertEqual(CachingLexer.cache.stats()['misses'], 0)
+
+    @patch.object(CachingLexer, 'cache', RenderCache(1000))
+    def test_cache_is_bounded(self):
+        for n in range(10):
+            list(CachingLexer('x = %d' % n, 'python'))
+        self.assertLessEqual(CachingLexer.cache.size, 1000)
+        self.assertLess(len(CachingLexer.cache), 10)
+
+    @patch.object(CachingLexer, 'cache', RenderCache(10**6))
+    def test_code_directive(self):
+        viewer = RestViewer('.')
+        rst = b'.. code:: python\n   :number-lines:\n\n   x = 1\n'
+        html = viewer.rest_to_html(rst)
+        self.assertIn('<span class="n">x</span>', html)
+        self.assertIn('<span class="ln">1 </span>', html)
+        viewer.render_cache.max_size = 0
+        self.assertEqual(viewer.rest_to_html(rst), html)
+        self.assertEqual(CachingLexer.cache.hits, 1)
+
+    def test_docutils_is_not_patched(self):
+        # Importing restview (or rendering a document with it) doesn't change
+        # what other users of docutils in the same process get
+        body = docutils.parsers.rst.directives.body
+        self.assertIs(body.Lexer, docutils.utils.code_analyzer.Lexer)
+        RestViewer('.').rest_to_html(b'.. code:: python\n\n   x = 1\n')
+        self.assertIs(body.Lexer, docutils.utils.code_analyzer.Lexer)
+
+    def test_installed(self):
+        body = docutils.parsers.rst.directives.body
+        original = body.Lexer
+        with CachingLexer.installed():
+            self.assertIs(body.Lexer, CachingLexer)
+            with CachingLexer.installed():
+                self.assertIs(body.Lexer, CachingLexer)
+            # Another render is still going on
+            self.assertIs(body.Lexer, CachingLexer)
+        self.assertIs(body.Lexer, original)
+        self.assertEqual(CachingLexer.users, 0)
+
+
 class TestGlobals(unittest.TestCase):
 
+    @patch('restview.restviewhttp._worker_viewers', {})
+    def test_render_in_worker(self):
+        config = {'stylesheets': None, 'pypi_strict': False,
+                  'halt_level': None, 'report_level': None}
+        init_render_worker(RestViewer, config)
+        html, dependencies = render_in_worker(RestViewer, config, b'*Hi*',
+                                              None, 'hi.rst')
+        self.assertIn('<em>Hi</em>', html)
+        self.assertEqual(dependencies, [])
+        with patch('sys.stderr', StringIO()):
+            html, dependencies = render_in_worker(
+                RestViewer, dict(config, halt_level=2), b'`Hi', None, 'hi.rst')
+        self.assertIn('<title>SystemMessage</title>', html)
+
+    def test_run_render_worker(self):
+        conn, child_conn = multiprocessing.Pipe()
+        conn.send((divmod, (7, 2)))
+        conn.send((int, ('x', )))
+        conn.close()
+        initializer = Mock()
+        with patch.object(child_conn, 'send') as send:
+            run_render_worker(child_conn, initializer, (1, 2))
+        initializer.assert_called_once_with(1, 2)
+        self.assertEqual(send.call_args_list[0], call((True, (3, 1))))
+        ok, error = send.call_args_list[1][0][0]
+        self.assertFalse(ok)
+        self.assertIsInstance(error, ValueError)
+
+    @patch('restview.restviewhttp._worker_viewers', {})
+    def test_call_in_worker(self):
+        config = {'stylesheets': None, 'pypi_strict': False,
+                  'halt_level': None, 'report_level': None}
+        self.assertEqual(call_in_worker(RestViewer, config, 'check_file',
+                                        ('README.rst', )), [])
+
+    @unittest.skipIf(resource is None, "needs the resource module")
+    @patch('restview.restviewhttp._worker_viewers', {})
+    def test_init_render_worker_memory_limit(self):
+        config = {'stylesheets': None, 'pypi_strict': False,
+                  'halt_level': None, 'report_level': None}
+        with patch('resource.setrlimit') as setrlimit:
+            init_render_worker(RestViewer, config, memory_limit=1024)
+        setrlimit.assert_called_once_with(resource.RLIMIT_AS, (1024, 1024))
+
     def test_get_host_name(self):
         with patch('socket.gethostname', lambda: 'myhostname.local'):
             self.assertEqual(get_host_name(''), 'myhostname.local')
             self.assertEqual(get_host_name('0.0.0.0'), 'myhostname.local')
             self.assertEqual(get_host_name('localhost'), 'localhost')
 
+    def test_exit_on_signal(self):
+        with self.assertRaises(SystemExit) as cm:
+            exit_on_signal(signal.SIGTERM, None)
+        self.assertEqual(cm.exception.code, 143)
+
     def test_launch_browser(self):
         with patch('threading.Thread') as Thread:
             launch_browser('http://example.com')
@@ -919,11 +4177,18 @@ class TestMain(unittest.TestCase):
             raise TypeError("unexpected keyword arguments: %s"
                             % ", ".join(sorted(kw)))
         self._serve_called = False
+
+        def start_search_indexer(viewer):
+            # Don't index the current directory in the background
+            self.viewer = viewer
+
         with patch('sys.argv', ['restview'] + list(args)):
             with patch('sys.stdout', StringIO()) as stdout:
                 with patch('sys.stderr', StringIO()) as stderr:
                     with patch('restview.restviewhttp.launch_browser') as launch_browser:
-                        with patch.object(RestViewer, 'serve', self._serve):
+                        with patch.object(RestViewer, 'serve', self._serve), \
+                                patch.object(RestViewer, 'start_search_indexer',
+                                             start_search_indexer):
                             try:
                                 main()
                             except SystemExit as e:
@@ -954,6 +4219,49 @@ class TestMain(unittest.TestCase):
             'restview: error: specify a command (-e) or a file/directory, but not both',
             stderr)
 
+    def test_error_when_checking_a_command(self):
+        stdout, stderr = self.run_main('--check', '--long-description', rc=2)
+        self.assertEqual(
+            stderr.splitlines()[-1],
+            "restview: error: --check doesn't work with a command (-e)",
+            stderr)
+
+    def test_error_when_building_a_command(self):
+        stdout, stderr = self.run_main('--build', 'out', '-e', 'cat README.rst',
+                                       rc=2)
+        self.assertEqual(
+            stderr.splitlines()[-1],
+            "restview: error: --build doesn't work with a command (-e)",
+            stderr)
+
+    def test_error_when_building_with_linked_stylesheets(self):
+        stdout, stderr = self.run_main('--build', 'out', '--link-stylesheets',
+                                       'README.rst', rc=2)
+        self.assertEqual(
+            stderr.splitlines()[-1],
+            "restview: error: --build doesn't work with --link-stylesheets",
+            stderr)
+
+    def test_build(self):
+        with patch.object(SiteBuilder, 'build', return_value=True) as build:
+            stdout, stderr = self.run_main('--build', 'out', 'README.rst')
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(stdout, 'Rendered 0 pages (0 unchanged) into out\n')
+
+    def test_build_with_errors(self):
+        with patch.object(SiteBuilder, 'build', return_value=False):
+            self.run_main('--build', 'out', 'README.rst', rc=1)
+
+    def test_check(self):
+        with patch.object(RestViewer, 'check', return_value=True) as check:
+            self.run_main('--check', 'README.rst', 'CHANGES.rst', rc=0)
+        check.assert_called_once_with(['README.rst', 'CHANGES.rst'])
+        self.assertIsNone(getattr(self, 'viewer', None))
+
+    def test_check_finds_problems(self):
+        with patch.object(RestViewer, 'check', return_value=False):
+            self.run_main('--check', 'README.rst', rc=1)
+
     def test_all_is_well(self):
         self.run_main('.', serve_called=True, browser_launched=True)
 
@@ -990,6 +4298,69 @@ class TestMain(unittest.TestCase):
         self.run_main('.', '--css', 'my.css',
                       serve_called=True, browser_launched=True)
 
+    def test_link_stylesheets(self):
+        self.run_main('.', '--link-stylesheets',
+                      serve_called=True, browser_launched=True)
+        self.assertTrue(self.viewer.link_stylesheets)
+
+    def test_asyncio(self):
+        self.run_main('.', '--asyncio',
+                      serve_called=True, browser_launched=True)
+        self.assertIs(self.viewer.server_class, AsyncHTTPServer)
+
+    def test_request_limits(self):
+        self.run_main('.', '--threads', '4', '--queue-size', '8',
+                      '--max-waiting', '16',
+                      serve_called=True, browser_launched=True)
+        self.assertEqual(self.viewer.server.max_workers, 4)
+        self.assertEqual(self.viewer.server.max_queued, 8)
+        self.assertEqual(self.viewer.server.max_waiting, 16)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'), "needs SO_REUSEPORT")
+    def test_processes(self):
+        with patch.object(RestViewer, 'start_workers') as start_workers:
+            self.run_main('.', '--processes', '2',
+                          serve_called=True, browser_launched=True)
+        self.assertEqual(start_workers.call_count, 1)
+
+    def test_processes_not_supported(self):
+        with patch('restview.restviewhttp.socket', Mock(spec=[])):
+            stdout, stderr = self.run_main('.', '--processes', '2', rc=2)
+        self.assertEqual(stderr.splitlines()[-1],
+                         'restview: error: --processes is not supported on'
+                         ' this platform')
+
+    def test_render_memory_limit_not_supported(self):
+        with patch('restview.restviewhttp.resource', None):
+            stdout, stderr = self.run_main('.', '--render-memory-limit', '500',
+                                           rc=2)
+        self.assertEqual(stderr.splitlines()[-1],
+                         'restview: error: --render-memory-limit is not'
+                         ' supported on this platform')
+
+    def test_render_workers(self):
+        with patch.object(RestViewer, 'get_render_pool') as get_render_pool:
+            self.run_main('.', '--render-workers', '2',
+                          serve_called=True, browser_launched=True)
+        self.assertEqual(get_render_pool.call_count, 1)
+
+    @unittest.skipIf(resource is None, "needs the resource module")
+    def test_render_limits(self):
+        with patch.object(RestViewer, 'get_render_pool') as get_render_pool:
+            self.run_main('.', '--render-timeout', '10',
+                          '--render-memory-limit', '500',
+                          serve_called=True, browser_launched=True)
+        self.assertEqual(get_render_pool.call_count, 1)
+
+    def test_cache_size(self):
+        self.run_main('.', '--cache-size', '0',
+                      serve_called=True, browser_launched=True)
+
+    def test_search_index_size(self):
+        self.run_main('.', '--search-index-size', '5',
+                      serve_called=True, browser_launched=True)
+        self.assertEqual(self.viewer.search_index_size, 5 * 1024 * 1024)
+
 
 def grep(needle, haystack):
     for line in haystack.splitlines():
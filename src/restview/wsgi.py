@@ -0,0 +1,10 @@
+"""
+WSGI entry point to restview, e.g. ::
+
+    gunicorn --threads 8 'restview.wsgi:make_app("docs/")'
+
+"""
+from restview.restviewhttp import WSGIApplication, make_wsgi_app as make_app
+
+
+__all__ = ['WSGIApplication', 'make_app']